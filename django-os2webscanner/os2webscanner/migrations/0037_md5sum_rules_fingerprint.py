@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def delete_legacy_md5sums(apps, schema_editor):
+    # Sums stored before rules fingerprints can never match a fingerprint,
+    # and sums differing only in the old CPR flags would break the new
+    # unique constraint
+    Md5Sum = apps.get_model('os2webscanner', 'Md5Sum')
+    Md5Sum.objects.filter(rules_fingerprint='').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('os2webscanner', '0036_auto_20180619_1416'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='md5sum',
+            name='rules_fingerprint',
+            field=models.CharField(default='', max_length=32),
+        ),
+        migrations.RunPython(delete_legacy_md5sums,
+                             migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='md5sum',
+            unique_together=set([('md5', 'rules_fingerprint', 'organization')]),
+        ),
+        migrations.AddField(
+            model_name='conversionqueueitem',
+            name='md5',
+            field=models.CharField(blank=True, max_length=32, null=True, verbose_name='MD5'),
+        ),
+    ]
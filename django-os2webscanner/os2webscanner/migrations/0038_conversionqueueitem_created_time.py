@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('os2webscanner', '0037_md5sum_rules_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversionqueueitem',
+            name='created_time',
+            field=models.DateTimeField(auto_now_add=True, null=True, verbose_name='Oprettet'),
+        ),
+    ]
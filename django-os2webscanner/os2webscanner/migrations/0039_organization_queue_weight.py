@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('os2webscanner', '0038_conversionqueueitem_created_time'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organization',
+            name='queue_weight',
+            field=models.PositiveIntegerField(default=1, verbose_name='Vægt i konverteringskøen'),
+        ),
+    ]
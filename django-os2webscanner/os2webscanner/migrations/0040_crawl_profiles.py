@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('os2webscanner', '0039_organization_queue_weight'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webscanner',
+            name='crawl_profile',
+            field=models.CharField(choices=[('gentle', 'Skånsom'), ('default', 'Standard'), ('intranet-fast', 'Hurtig (intranet)')], default='default', max_length=32, verbose_name='Crawlprofil'),
+        ),
+        migrations.AddField(
+            model_name='webscan',
+            name='crawl_profile',
+            field=models.CharField(choices=[('gentle', 'Skånsom'), ('default', 'Standard'), ('intranet-fast', 'Hurtig (intranet)')], default='default', max_length=32, verbose_name='Crawlprofil'),
+        ),
+        migrations.AddField(
+            model_name='statistic',
+            name='crawl_settings',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
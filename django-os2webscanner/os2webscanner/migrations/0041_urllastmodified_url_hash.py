@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_urls(apps, schema_editor):
+    UrlLastModified = apps.get_model('os2webscanner', 'UrlLastModified')
+    for url_last_modified in UrlLastModified.objects.only('url').iterator():
+        UrlLastModified.objects.filter(pk=url_last_modified.pk).update(
+            url_hash=hashlib.md5(
+                url_last_modified.url.encode('utf-8')
+            ).hexdigest()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('os2webscanner', '0040_crawl_profiles'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='urllastmodified',
+            name='url_hash',
+            field=models.CharField(blank=True, default='', max_length=32, verbose_name='Url-hash'),
+        ),
+        migrations.RunPython(hash_urls, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='urllastmodified',
+            index_together=set([('scanner', 'url_hash')]),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('os2webscanner', '0041_urllastmodified_url_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='urllastmodified',
+            name='etag',
+            field=models.CharField(blank=True, default='', max_length=256, verbose_name='ETag'),
+        ),
+        migrations.AddField(
+            model_name='webscanner',
+            name='do_last_modified_check_conditional_get',
+            field=models.BooleanField(default=False, verbose_name='Brug betinget GET'),
+        ),
+        migrations.AddField(
+            model_name='webscan',
+            name='do_last_modified_check_conditional_get',
+            field=models.BooleanField(default=False, verbose_name='Brug betinget GET'),
+        ),
+    ]
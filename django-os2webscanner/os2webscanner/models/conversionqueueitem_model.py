@@ -13,6 +13,9 @@ class ConversionQueueItem(models.Model):
     file = models.CharField(max_length=4096, verbose_name='Fil')
     type = models.CharField(max_length=256, verbose_name='Type')
     page_no = models.IntegerField(null=True, verbose_name='Side')
+    # The MD5 sum of the file, if it was calculated when it was queued
+    md5 = models.CharField(max_length=32, null=True, blank=True,
+                           verbose_name='MD5')
 
     # Note that SUCCESS is indicated by just deleting the record
     NEW = "NEW"
@@ -35,23 +38,44 @@ class ConversionQueueItem(models.Model):
         blank=True, null=True, verbose_name='Proces starttidspunkt'
     )
 
+    created_time = models.DateTimeField(auto_now_add=True, null=True,
+                                        verbose_name='Oprettet')
+
     @property
     def file_path(self):
         """Return the full path to the conversion queue item's file."""
         return self.file
 
+    @property
+    def is_spooled(self):
+        """Whether the item's file is in the RAM-backed spool."""
+        spool_dir = self.url.scan.spool_dir
+        return bool(spool_dir) and self.file.startswith(spool_dir + os.sep)
+
     @property
     def tmp_dir(self):
-        """The path to the temporary dir associated with this queue item."""
-        return os.path.join(
-            self.url.scan.scan_dir,
-            'queue_item_%d' % (self.pk)
-        )
+        """The path to the temporary dir associated with this queue item.
+
+        The temporary dir is on disk even if the item's file is in the
+        RAM-backed spool, as the output of a conversion can be much larger
+        than its input.
+        """
+        return os.path.join(self.url.scan.scan_dir,
+                            'queue_item_%d' % (self.pk))
 
     def delete_tmp_dir(self):
-        """Delete the item's temp dir if it is writable."""
+        """Delete the item's temp dir if it is writable.
+
+        Also deletes the item's file if it is in the RAM-backed spool, to
+        free the memory right away.
+        """
         if os.access(self.tmp_dir, os.W_OK):
             shutil.rmtree(self.tmp_dir, True)
+        if self.is_spooled:
+            try:
+                os.remove(self.file)
+            except OSError:
+                pass
 
     class Meta:
         abstract = False
@@ -11,13 +11,14 @@ class Md5Sum(models.Model):
                                      null=False,
                                      verbose_name='Organisation')
     md5 = models.CharField(max_length=32, null=False, blank=False)
+    # The rules fingerprint of the scans which scanned the file
+    rules_fingerprint = models.CharField(max_length=32, default='')
     is_cpr_scan = models.BooleanField()
     is_check_mod11 = models.BooleanField()
     is_ignore_irrelevant = models.BooleanField()
 
     class Meta:
-        unique_together = ('md5', 'is_cpr_scan', 'is_check_mod11',
-                           'is_ignore_irrelevant', 'organization')
+        unique_together = ('md5', 'rules_fingerprint', 'organization')
 
     def __unicode__(self):
         return u"{0}: {1}".format(self.organization.name, self.md5)
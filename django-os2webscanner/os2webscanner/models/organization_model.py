@@ -15,6 +15,12 @@ class Organization(models.Model):
     do_use_groups = models.BooleanField(default=False,
                                         editable=settings.DO_USE_GROUPS)
     do_notify_all_scans = models.BooleanField(default=True)
+    # The organization's share of the queue processors, relative to other
+    # organizations with items in the conversion queue.
+    queue_weight = models.PositiveIntegerField(
+        default=1,
+        verbose_name='Vægt i konverteringskøen'
+    )
 
     name_whitelist = models.TextField(blank=True,
                                       default="",
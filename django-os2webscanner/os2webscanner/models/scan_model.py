@@ -18,6 +18,7 @@
 
 import os
 import shutil
+import hashlib
 import datetime
 
 from django.utils import timezone
@@ -162,11 +163,43 @@ class Scan(models.Model):
         text = [t for s, t in Scan.status_choices if self.status == s][0]
         return text
 
+    @property
+    def rules_fingerprint(self):
+        """A fingerprint of the settings which determine what is matched.
+
+        The fingerprint changes whenever one of the scan's rule settings,
+        white- or blacklists, or regex rules (including their patterns)
+        changes, so it can be used to detect stale compiled rules.
+        """
+        regex_rules = tuple(
+            (rule.pk, rule.name, rule.sensitivity,
+             tuple(sorted(p.pattern_string for p in rule.patterns.all())))
+            for rule in self.regex_rules.prefetch_related(
+                'patterns').order_by('pk')
+        )
+        configuration = (
+            self.do_cpr_scan, self.do_cpr_modulus11,
+            self.do_cpr_ignore_irrelevant, self.whitelisted_cprs,
+            self.do_name_scan, self.whitelisted_names, self.blacklisted_names,
+            self.do_address_scan, self.whitelisted_addresses,
+            self.blacklisted_addresses, regex_rules
+        )
+        return hashlib.md5(repr(configuration).encode('utf-8')).hexdigest()
+
     @property
     def scan_dir(self):
         """The directory associated with this scan."""
         return os.path.join(settings.VAR_DIR, 'scan_%s' % self.pk)
 
+    @property
+    def spool_dir(self):
+        """The directory of this scan in the RAM-backed spool, or None if
+        there is no spool."""
+        spool_dir = getattr(settings, 'SPOOL_DIR', None)
+        if not spool_dir:
+            return None
+        return os.path.join(spool_dir, 'scan_%s' % self.pk)
+
     @property
     def scan_log_dir(self):
         """Return the path to the scan log dir."""
@@ -284,6 +317,10 @@ class Scan(models.Model):
             if log:
                 print("Deleting scan directory: %s %s", self.scan_dir,
             shutil.rmtree(self.scan_dir, True))
+        if self.spool_dir and os.access(self.spool_dir, os.W_OK):
+            if log:
+                print("Deleting scan spool directory: %s" % self.spool_dir)
+            shutil.rmtree(self.spool_dir, True)
 
     @classmethod
     def cleanup_finished_scans(cls, scan_age, log=False):
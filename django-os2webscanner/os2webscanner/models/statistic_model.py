@@ -26,3 +26,6 @@ class Statistic(models.Model):
     files_failed_count = models.IntegerField(default=0)
 
     files_is_dir_count = models.IntegerField(default=0)
+
+    # The Scrapy settings the scan was crawled with, as JSON
+    crawl_settings = models.TextField(blank=True, default='')
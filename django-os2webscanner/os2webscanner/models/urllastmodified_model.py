@@ -1,3 +1,5 @@
+import hashlib
+
 from django.db import models
 
 from .scanner_model import Scanner
@@ -8,12 +10,27 @@ class UrlLastModified(models.Model):
     """A representation of a URL, its last-modifed date, and its links."""
 
     url = models.CharField(max_length=2048, verbose_name='Url')
+    # The MD5 of the URL, to look the URL up by
+    url_hash = models.CharField(max_length=32, blank=True, default='',
+                                verbose_name='Url-hash')
     last_modified = models.DateTimeField(blank=True, null=True,
                                          verbose_name='Last-modified')
+    etag = models.CharField(max_length=256, blank=True, default='',
+                            verbose_name='ETag')
     links = models.ManyToManyField("self", symmetrical=False,
                                    verbose_name='Links')
     scanner = models.ForeignKey(Scanner, null=False, verbose_name='WebScanner')
 
+    @staticmethod
+    def hash_url(url):
+        """Return the hash of the URL stored in url_hash."""
+        return hashlib.md5(url.encode('utf-8')).hexdigest()
+
+    def save(self, *args, **kwargs):
+        """Save the object, keeping url_hash up to date."""
+        self.url_hash = self.hash_url(self.url)
+        super().save(*args, **kwargs)
+
     def __unicode__(self):
         """Return the URL and last modified date."""
         return "<%s %s>" % (self.url, self.last_modified)
@@ -21,3 +38,6 @@ class UrlLastModified(models.Model):
     def __str__(self):
         """Return the URL and last modified date."""
         return "<%s %s>" % (self.url, self.last_modified)
+
+    class Meta:
+        index_together = [('scanner', 'url_hash')]
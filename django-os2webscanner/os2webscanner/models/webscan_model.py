@@ -22,6 +22,7 @@ from io import StringIO
 from django.db import models
 
 from .scan_model import Scan
+from .webscanner_model import WebScanner
 
 
 class WebScan(Scan):
@@ -49,9 +50,19 @@ class WebScan(Scan):
         verbose_name='Brug HTTP HEAD request'
     )
 
+    do_last_modified_check_conditional_get = models.BooleanField(
+        default=False,
+        verbose_name='Brug betinget GET'
+    )
+
     do_collect_cookies = models.BooleanField(default=False,
                                              verbose_name='Saml cookies')
 
+    crawl_profile = models.CharField(max_length=32,
+                                     choices=WebScanner.crawl_profile_choices,
+                                     default=WebScanner.DEFAULT,
+                                     verbose_name='Crawlprofil')
+
     # Statistics
     # TODO: Add field for sitemap.xml url count
 
@@ -77,7 +88,10 @@ class WebScan(Scan):
             do_last_modified_check=scanner.do_last_modified_check,
             do_last_modified_check_head_request=scanner.
                 do_last_modified_check_head_request,
+            do_last_modified_check_conditional_get=scanner.
+                do_last_modified_check_conditional_get,
             do_collect_cookies=scanner.do_collect_cookies,
+            crawl_profile=scanner.crawl_profile,
             columns=scanner.columns,
             output_spreadsheet_file=scanner.output_spreadsheet_file,
             do_cpr_replace=scanner.do_cpr_replace,
@@ -39,11 +39,31 @@ class WebScanner(Scanner):
         default=True,
         verbose_name='Brug HTTP HEAD request'
     )
+    do_last_modified_check_conditional_get = models.BooleanField(
+        default=False,
+        verbose_name='Brug betinget GET'
+    )
     do_collect_cookies = models.BooleanField(
         default=False,
         verbose_name='Saml cookies'
     )
 
+    # Crawl profiles - the Scrapy settings of each are in CRAWL_PROFILES
+    GENTLE = 'gentle'
+    DEFAULT = 'default'
+    INTRANET_FAST = 'intranet-fast'
+
+    crawl_profile_choices = (
+        (GENTLE, 'Skånsom'),
+        (DEFAULT, 'Standard'),
+        (INTRANET_FAST, 'Hurtig (intranet)'),
+    )
+
+    crawl_profile = models.CharField(max_length=32,
+                                     choices=crawl_profile_choices,
+                                     default=DEFAULT,
+                                     verbose_name='Crawlprofil')
+
     def create_scan(self):
         from .webscan_model import WebScan
         return WebScan.create(self)
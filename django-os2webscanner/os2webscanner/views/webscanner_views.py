@@ -19,7 +19,8 @@ class WebScannerCreate(ScannerCreate):
               'do_name_scan', 'do_ocr', 'do_address_scan',
               'do_link_check', 'do_external_link_check', 'do_collect_cookies',
               'do_last_modified_check', 'do_last_modified_check_head_request',
-              'regex_rules', 'recipients']
+              'do_last_modified_check_conditional_get',
+              'crawl_profile', 'regex_rules', 'recipients']
 
     def get_success_url(self):
         """The URL to redirect to after successful creation."""
@@ -36,7 +37,8 @@ class WebScannerUpdate(ScannerUpdate):
               'do_name_scan', 'do_ocr', 'do_address_scan',
               'do_link_check', 'do_external_link_check', 'do_collect_cookies',
               'do_last_modified_check', 'do_last_modified_check_head_request',
-              'regex_rules', 'recipients']
+              'do_last_modified_check_conditional_get',
+              'crawl_profile', 'regex_rules', 'recipients']
 
     def get_success_url(self):
         """The URL to redirect to after successful update."""
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+
+"""Benchmark reading image dimensions from headers against identify.
+
+Reads the dimensions of the given image files, or of images in each of the
+supported formats generated with ImageMagick if no files are given, first
+with ImageMagick's identify command, as for the OCR size check before, and
+then from the image headers. Reports the time taken and whether the
+dimensions are the same.
+
+Usage: benchmark_images.py [image file ...]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+import django
+
+# Include the Django app and the scanner
+base_dir = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(base_dir + "/webscanner_site")
+sys.path.append(base_dir + "/scrapy-webscanner")
+os.environ["DJANGO_SETTINGS_MODULE"] = "webscanner.settings"
+django.setup()
+
+from scanner.processors.image_header import read_image_header
+
+# Sizes of the generated images, including some below the OCR minimums
+sizes = ((1, 1), (6, 200), (63, 63), (64, 7), (640, 480), (2480, 3508))
+formats = ('png', 'gif', 'jpg', 'tif', 'bmp')
+
+
+def identify_dimensions(file_path):
+    """Return the dimensions of the image according to identify."""
+    try:
+        dimensions = subprocess.check_output(
+            ["identify", "-format", "%wx%h", file_path]
+        )
+    except subprocess.CalledProcessError:
+        return None
+    return tuple(int(dim.strip()) for dim in
+                 dimensions.decode('utf-8').split("x"))
+
+
+def header_dimensions(file_path):
+    """Return the dimensions of the image according to its header."""
+    header = read_image_header(file_path)
+    return header[1:] if header is not None else None
+
+
+def generate_images(tmp_dir):
+    """Generate images of each format and size, returning their paths."""
+    file_paths = []
+    for extension in formats:
+        for width, height in sizes:
+            file_path = os.path.join(tmp_dir, "%dx%d.%s" % (
+                width, height, extension
+            ))
+            subprocess.check_call([
+                "convert", "-size", "%dx%d" % (width, height),
+                "plasma:", file_path
+            ])
+            file_paths.append(file_path)
+    return file_paths
+
+
+def run_benchmark(file_paths, repeat):
+    """Run the benchmark on the files and print the results."""
+    start = time.time()
+    for i in range(repeat):
+        identified = [identify_dimensions(f) for f in file_paths]
+    identify_time = time.time() - start
+
+    start = time.time()
+    for i in range(repeat):
+        read = [header_dimensions(f) for f in file_paths]
+    header_time = time.time() - start
+
+    for file_path, a, b in zip(file_paths, identified, read):
+        if a != b:
+            print("%s: identify %s, header %s" % (
+                os.path.basename(file_path), a, b))
+    count = len(file_paths) * repeat
+    print("%d images  identify %7.3f s (%.2f ms/image)  "
+          "header %7.3f s (%.4f ms/image)  %.0fx  %s" % (
+              count, identify_time, 1000 * identify_time / count,
+              header_time, 1000 * header_time / count,
+              identify_time / header_time,
+              "same dimensions" if identified == read
+              else "DIFFERENT DIMENSIONS"))
+
+
+def main():
+    """Run the benchmark on the given files or on generated images."""
+    if len(sys.argv) > 1:
+        run_benchmark(sys.argv[1:], 1)
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            run_benchmark(generate_images(tmp_dir), 10)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
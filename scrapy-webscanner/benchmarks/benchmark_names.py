@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+
+"""Benchmark the name rule on name-dense texts.
+
+Executes the name rule on generated texts consisting mostly of names, like
+member lists and payroll exports, and compares it with the previous
+implementation which removed each full name from the text with replace()
+before looking for standalone names. Reports the time taken and how many
+matches differ. They differ where replace() removed an earlier occurrence
+of a full name's text, e.g. "Medlem Ajo" from "Medlem Ajoula", instead of
+the name itself.
+
+Usage: benchmark_names.py [text file ...]
+"""
+
+import os
+import sys
+import time
+import random
+import collections
+
+import django
+
+# Include the Django app and the scanner
+base_dir = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(base_dir + "/webscanner_site")
+sys.path.append(base_dir + "/scrapy-webscanner")
+os.environ["DJANGO_SETTINGS_MODULE"] = "webscanner.settings"
+django.setup()
+
+import regex
+
+from os2webscanner.models.sensitivity_level import Sensitivity
+
+from scanner.items import MatchItem
+from scanner.rules.name import NameRule, _name
+
+
+class ReplaceNameRule(NameRule):
+
+    """The name rule, removing full names from the text with replace()."""
+
+    def finish(self, context):
+        """Check for standalone names in the text not matched so far."""
+        unmatched_text = context.text
+        for match_item in context.matches:
+            unmatched_text = unmatched_text.replace(
+                match_item['matched_data'], "", 1
+            )
+        name_regex = regex.compile(_name)
+        for m in name_regex.finditer(unmatched_text, overlapped=False):
+            matched = m.group(0)
+            if self._is_name(matched.upper(), self.all_names):
+                context.matches.append(
+                    MatchItem(matched_data=matched,
+                              sensitivity=Sensitivity.LOW)
+                )
+
+
+def generate_text(size):
+    """Generate about size characters of text, mostly names."""
+    first_names, last_names = NameRule.load_indexes()
+    first_names = [n.title() for n in list(first_names)[:5000]]
+    last_names = [n.title() for n in list(last_names)[:5000]]
+    rnd = random.Random(42)
+    lines = []
+    length = 0
+    while length < size:
+        choice = rnd.random()
+        if choice < 0.6:
+            line = '%s %s' % (rnd.choice(first_names),
+                              rnd.choice(last_names))
+        elif choice < 0.8:
+            line = '%s %s %s' % (rnd.choice(first_names),
+                                 rnd.choice(first_names),
+                                 rnd.choice(last_names))
+        elif choice < 0.9:
+            line = 'Medlem %s' % rnd.choice(last_names)
+        else:
+            line = '%s;%d;%s' % (rnd.choice(first_names),
+                                 rnd.randint(1, 100000),
+                                 rnd.choice(last_names))
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines)
+
+
+def summarize(matches):
+    """Return the matched data and sensitivities, for comparison."""
+    return collections.Counter(
+        (m['matched_data'], m['sensitivity']) for m in matches
+    )
+
+
+def run_benchmark(name, text, rule, replace_rule):
+    """Run the benchmark on one text and print the results."""
+    start = time.time()
+    replace_matches = replace_rule.execute(text)
+    replace_time = time.time() - start
+
+    start = time.time()
+    matches = rule.execute(text)
+    span_time = time.time() - start
+
+    summary = summarize(matches)
+    replace_summary = summarize(replace_matches)
+    differences = sum(((summary - replace_summary) +
+                       (replace_summary - summary)).values())
+    print("%-30s %9d chars %6d matches  replace %7.3f s  spans %7.3f s  "
+          "%6.1fx  %d differ" % (
+              name[-30:], len(text), len(matches), replace_time, span_time,
+              replace_time / span_time, differences))
+
+
+def main():
+    """Run the benchmark on the given files or on generated texts."""
+    rule = NameRule()
+    replace_rule = ReplaceNameRule()
+    if len(sys.argv) > 1:
+        for file_name in sys.argv[1:]:
+            with open(file_name, encoding='utf-8', errors='replace') as f:
+                run_benchmark(file_name, f.read(), rule, replace_rule)
+    else:
+        for size in (10000, 100000, 1000000, 3000000):
+            run_benchmark('generated', generate_text(size), rule,
+                          replace_rule)
+
+
+if __name__ == '__main__':
+    main()
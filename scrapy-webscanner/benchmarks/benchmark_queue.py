@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+
+"""Benchmark the conversion queue backends.
+
+Queues a number of dummy items for a throwaway scan and lets a number of
+worker processes claim and acknowledge them in batches with each backend,
+reporting throughput and claim latency. The scan and its items are deleted
+afterwards.
+
+Usage: benchmark_queue.py [number of items] [number of workers] [batch size]
+"""
+
+import os
+import sys
+import time
+import multiprocessing
+
+import django
+
+# Include the Django app and the scanner
+base_dir = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(base_dir + "/webscanner_site")
+sys.path.append(base_dir + "/scrapy-webscanner")
+os.environ["DJANGO_SETTINGS_MODULE"] = "webscanner.settings"
+django.setup()
+
+from django import db
+
+from os2webscanner.models.conversionqueueitem_model import ConversionQueueItem
+from os2webscanner.models.scan_model import Scan
+from os2webscanner.models.url_model import Url
+
+from scanner.processors.queue_backend import QueueBackend
+
+# Item type which no real queue processor will claim
+item_type = 'benchmark'
+
+
+def worker(backend_name, batch_size, results):
+    """Claim and acknowledge items until the queue is empty."""
+    # Don't share the parent's database connection
+    db.connection.close()
+    backend = QueueBackend.backends_by_name[backend_name]()
+    latencies = []
+    while True:
+        start = time.time()
+        items = backend.claim_batch(item_type, os.getpid(), batch_size)
+        if not items:
+            break
+        latencies.append(time.time() - start)
+        backend.ack_batch(items)
+    results.put(latencies)
+
+
+def run_benchmark(backend_name, number_of_items, number_of_workers,
+                  batch_size):
+    """Run the benchmark for one backend and print the results."""
+    scan = Scan()
+    scan.save()
+    url = Url(url='benchmark://queue', scan=scan)
+    url.save()
+    ConversionQueueItem.objects.bulk_create(
+        ConversionQueueItem(url=url, file='/dev/null', type=item_type,
+                            status=ConversionQueueItem.NEW)
+        for _ in range(number_of_items)
+    )
+    db.connections.close_all()
+
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=worker, args=(backend_name, batch_size, results))
+        for _ in range(number_of_workers)
+    ]
+    start = time.time()
+    for p in processes:
+        p.start()
+    latencies = []
+    for _ in processes:
+        latencies.extend(results.get())
+    for p in processes:
+        p.join()
+    elapsed = time.time() - start
+
+    scan.delete()
+
+    latencies.sort()
+    if latencies:
+        median = latencies[len(latencies) // 2]
+        p95 = latencies[int(len(latencies) * 0.95)]
+    else:
+        median = p95 = 0
+    print("%-10s %6d items %3d workers batch %3d %9.1f items/s "
+          "claim median %6.2f ms p95 %6.2f ms" % (
+              backend_name, number_of_items, number_of_workers, batch_size,
+              number_of_items / elapsed, median * 1000, p95 * 1000))
+
+
+def main():
+    """Run the benchmark for all backends."""
+    number_of_items = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    number_of_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    for backend_name in sorted(QueueBackend.backends_by_name):
+        run_benchmark(backend_name, number_of_items, number_of_workers,
+                      batch_size)
+
+
+if __name__ == '__main__':
+    main()
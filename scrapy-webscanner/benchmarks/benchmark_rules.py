@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+
+"""Benchmark executing the rules one at a time against a single pass.
+
+Executes the CPR, name and address rules and a few regex rules on each of
+the given text files, or on a generated text if no files are given, first
+one rule at a time and then in a single pass with the RuleEngine's combined
+pattern, and reports the time taken and whether the matches are the same.
+
+With the regex module, the single pass is the slower of the two, about 0.9
+times the speed of the rules one at a time on 10 kB of generated text and
+0.35 to 0.4 times on 100 kB and more. Scanning the text with the combined
+pattern alone takes longer than the finditers of all the patterns
+together, as an alternation can't skip ahead to where each of its
+alternatives may start, the way a single pattern with a literal or a
+character class first can. So RULE_ENGINE_SINGLE_PASS is off by default.
+
+Usage: benchmark_rules.py [text file ...]
+"""
+
+import os
+import sys
+import time
+import random
+import collections
+
+import django
+
+# Include the Django app and the scanner
+base_dir = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.append(base_dir + "/webscanner_site")
+sys.path.append(base_dir + "/scrapy-webscanner")
+os.environ["DJANGO_SETTINGS_MODULE"] = "webscanner.settings"
+django.setup()
+
+from scanner.rules.cpr import CPRRule
+from scanner.rules.name import NameRule
+from scanner.rules.address import AddressRule
+from scanner.rules.regexrule import RegexRule
+from scanner.rules.engine import RuleEngine
+
+# Stand-in for the RegexPattern objects of a regex rule
+PatternString = collections.namedtuple('PatternString', 'pattern_string')
+
+
+class PatternStrings(list):
+
+    """Stand-in for the patterns queryset of a regex rule."""
+
+    def all(self):
+        return self
+
+
+def get_rules():
+    """Return the rules to benchmark."""
+    return [
+        CPRRule(do_modulus11=True, ignore_irrelevant=True),
+        NameRule(),
+        AddressRule(),
+        RegexRule('Email', PatternStrings([
+            PatternString(r'[\w.+-]+@[\w-]+\.[\w.]+')
+        ]), 1),
+        RegexRule('Phone', PatternStrings([
+            PatternString(r'\+45 ?\d{8}'),
+            PatternString(r'\btlf\.? ?\d{8}\b'),
+        ]), 1),
+    ] + [
+        RegexRule(word.title(), PatternStrings([
+            PatternString(r'\b%s\w*' % word)
+        ]), 1)
+        for word in ('sygdom', 'diagnose', 'behandling', 'medicin',
+                     'journal', 'misbrug', 'straf', 'religion')
+    ]
+
+
+def generate_text(size):
+    """Generate about size characters of text with things to match."""
+    first_names, last_names = NameRule.load_indexes()
+    street_names = AddressRule.load_indexes()
+    first_names = [n.title() for n in list(first_names)[:2000]]
+    last_names = [n.title() for n in list(last_names)[:2000]]
+    street_names = [n.title() for n in list(street_names)[:2000]]
+    words = ('og i at det en den til er som på de med han af for ikke der '
+             'var mig sig men et har om vi min havde ham hun nu over da '
+             'fra du ud sin dem os op man hans hvor eller hvad skal selv '
+             'her alle vil blev kunne ind når være dog noget ville jo '
+             'deres efter ned skulle denne end dette mit også under have '
+             'dig anden hende mine alt meget sit sine vor mod disse hvis '
+             'din nogle hos blive mange ad bliver hendes været thi jer '
+             'sådan behandling journal sygdom').split()
+    rnd = random.Random(42)
+    parts = []
+    length = 0
+    while length < size:
+        choice = rnd.random()
+        if choice < 0.02:
+            part = '%02d%02d%02d-%04d' % (rnd.randint(1, 28),
+                                          rnd.randint(1, 12),
+                                          rnd.randint(0, 99),
+                                          rnd.randint(0, 9999))
+        elif choice < 0.06:
+            part = '%s %s' % (rnd.choice(first_names),
+                              rnd.choice(last_names))
+        elif choice < 0.08:
+            part = '%s %d, %d %s' % (rnd.choice(street_names),
+                                     rnd.randint(1, 200),
+                                     rnd.randint(1000, 9999),
+                                     rnd.choice(last_names))
+        elif choice < 0.09:
+            part = 'tlf. %08d' % rnd.randint(0, 99999999)
+        elif choice < 0.1:
+            part = '%s@example.dk.' % rnd.choice(words)
+        elif choice < 0.15:
+            part = rnd.choice(words).title()
+        else:
+            part = rnd.choice(words)
+        parts.append(part)
+        length += len(part) + 1
+    return ' '.join(parts)
+
+
+def summarize(results):
+    """Return the matched data of the results by rule name, for comparison.
+    """
+    return dict(
+        (rule.name, sorted(m['matched_data'] for m in matches))
+        for rule, matches in results.items()
+    )
+
+
+def run_benchmark(name, text, rules, engine):
+    """Run the benchmark on one text and print the results."""
+    start = time.time()
+    separate_results = dict((rule, rule.execute(text)) for rule in rules)
+    separate_time = time.time() - start
+
+    start = time.time()
+    engine_results = engine.execute(text)
+    engine_time = time.time() - start
+
+    same = summarize(separate_results) == summarize(engine_results)
+    print("%-30s %9d chars %6d matches  per rule %7.3f s  "
+          "single pass %7.3f s  %5.2fx  %s" % (
+              name[-30:], len(text),
+              sum(len(m) for m in engine_results.values()),
+              separate_time, engine_time, separate_time / engine_time,
+              "same matches" if same else "DIFFERENT MATCHES"))
+
+
+def main():
+    """Run the benchmark on the given files or on generated texts."""
+    rules = get_rules()
+    engine = RuleEngine(rules, single_pass=True)
+    if len(sys.argv) > 1:
+        for file_name in sys.argv[1:]:
+            with open(file_name, encoding='utf-8', errors='replace') as f:
+                run_benchmark(file_name, f.read(), rules, engine)
+    else:
+        for size in (10000, 100000, 1000000):
+            run_benchmark('generated', generate_text(size), rules, engine)
+
+
+if __name__ == '__main__':
+    main()
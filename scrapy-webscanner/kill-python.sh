@@ -1,4 +0,0 @@
-#!/bin/bash
-
-kill -9 `pidof python`
-
@@ -17,14 +17,19 @@
 
 """Start up and manage queue processors to ensure they stay running.
 
-Starts up multiple instances of each processor.
-Restarts processors if they die or if they get stuck processing a single
-item for too long.
+Starts a queue processor for each type, which forks workers processing the
+queue, see Zygote, and scales the number of workers of each type to the
+backlog of its queue.
+Restarts processors as soon as they die, and kills the programs run by a
+worker, or stops the worker, if it stops making progress on an item, as
+told by its heartbeats, or gets stuck processing a single item for too
+long. Its processor then forks a new worker.
 """
 
 import os
 import shutil
 import sys
+import select
 import subprocess
 import time
 import signal
@@ -47,6 +52,12 @@ os.umask(0o007)
 from os2webscanner.models.conversionqueueitem_model import ConversionQueueItem
 from os2webscanner.models.scan_model import Scan
 
+from scanner.rules.name import NameRule
+from scanner.rules.address import AddressRule
+from scanner.processors.autoscaler import Autoscaler
+from scanner.processors.heartbeat import (HeartbeatMonitor, process_table,
+                                          descendants)
+
 
 var_dir = settings.VAR_DIR
 
@@ -55,15 +66,37 @@ log_dir = os.path.join(var_dir, "logs")
 if not os.path.exists(log_dir):
     os.makedirs(log_dir)
 
-processes_per_type = 8
+# The default (minimum, maximum) number of workers of a type
+default_processes_per_type = (1, 8)
+
+# Seconds between scaling the number of workers
+scaling_interval = 30
+
+status_file = os.path.join(var_dir, "process_manager_status.json")
 
 processing_timeout = timedelta(minutes=10)
 
+# Seconds to wait for heartbeats or processes exiting between checks
+check_interval = 1
+# Seconds between the checks which query the database
+stuck_check_interval = 60
+scan_check_interval = 30
+cleanup_interval = 60
+ocr_check_interval = 10
+
+# Seconds a stopped process or worker has to exit before it is killed
+stop_timeout = 30
+
 process_types = ('html', 'libreoffice', 'ocr', 'pdf', 'zip', 'text', 'csv')
 
 process_map = {}
 process_list = []
 
+# Maps the pids of the workers which have been stopped to when
+stopping_workers = {}
+
+heartbeat_monitor = None
+
 
 def stop_process(p):
     """Stop the process."""
@@ -74,18 +107,33 @@ def stop_process(p):
     phandle = p['process_handle']
     del p['process_handle']
     pid = phandle.pid
+    workers = children(pid)
     # If running, stop it
     if phandle.poll() is None:
         print("Terminating process %s" % p['name'])
         phandle.terminate()
-        phandle.wait()
+        try:
+            phandle.wait(stop_timeout)
+        except subprocess.TimeoutExpired:
+            print("Killing process %s" % p['name'])
+            phandle.kill()
+            phandle.wait()
+    # Kill the workers left behind if the process was killed
+    for worker in workers:
+        try:
+            os.kill(worker, signal.SIGKILL)
+        except OSError:
+            pass
     # Remove pid from process map
     if pid in process_map:
         del process_map[pid]
-    # Set any ongoing queue-items for this process id to failed
+    if heartbeat_monitor is not None:
+        for worker in workers:
+            heartbeat_monitor.forget(worker)
+    # Set any ongoing queue-items of the workers to failed
     ongoing_items = ConversionQueueItem.objects.filter(
         status=ConversionQueueItem.PROCESSING,
-        process_id=pid
+        process_id__in=[pid] + workers
     )
     # Remove the temp directories for the failed queue items
     for item in ongoing_items:
@@ -134,6 +182,7 @@ def start_process(p):
 
     process_handle = subprocess.Popen(
         p['program_args'],
+        stdin=subprocess.PIPE,
         stdout=log_fh,
         stderr=log_fh
     )
@@ -152,6 +201,7 @@ def start_process(p):
     p['process_handle'] = process_handle
     p['pid'] = pid
     process_map[pid] = p
+    set_workers(p, p['workers'])
 
 
 def restart_process(processdata):
@@ -160,10 +210,223 @@ def restart_process(processdata):
     start_process(processdata)
 
 
+def add_process(ptype, workers):
+    """Add the process of the given type, running the number of workers."""
+    program = [
+        'python',
+        os.path.join(base_dir, 'scrapy-webscanner',
+                     'process_queue.py'),
+        ptype
+    ]
+    # Libreoffice takes the homedir name as second arg
+    if "libreoffice" == ptype:
+        program.append(ptype + '{worker}')
+    p = {'program_args': program, 'name': ptype, 'type': ptype,
+         'workers': workers}
+    process_map[ptype] = p
+    process_list.append(p)
+    start_process(p)
+
+
+def set_workers(p, workers):
+    """Tell the process how many workers to run."""
+    p['workers'] = workers
+    try:
+        p['process_handle'].stdin.write(b'%d\n' % workers)
+        p['process_handle'].stdin.flush()
+    except OSError:
+        # The process has exited, and is told again when restarted
+        pass
+
+
+def children(pid):
+    """Return the pids of the children of the process."""
+    return [child for child, (parent, cpu_time) in process_table().items()
+            if parent == pid]
+
+
+def worker_process(pid, table):
+    """Return the process the worker with the given pid was forked by, or
+    None if it isn't a worker."""
+    parent = table.get(pid, (None, 0))[0]
+    if parent is None:
+        return None
+    return process_map.get(parent)
+
+
+def stop_worker(pid):
+    """Stop the worker, which its process replaces with a new one.
+
+    It is killed if it hasn't exited stop_timeout seconds later.
+    """
+    if pid in stopping_workers:
+        return
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        return
+    stopping_workers[pid] = time.time()
+
+
+def scale_processes(autoscaler):
+    """Start processes or change their number of workers to reach the
+    autoscaler's targets.
+
+    Surplus workers are retired by their process, i.e. exit after their
+    current items.
+    """
+    running = dict((p['type'], p['workers']) for p in process_list)
+
+    targets = autoscaler.scale(running)
+
+    for ptype, target in targets.items():
+        p = process_map.get(ptype)
+        if p is None:
+            add_process(ptype, target)
+        elif target != p['workers']:
+            print("Scaling process %s from %d to %d workers" % (
+                p['name'], p['workers'], target
+            ))
+            set_workers(p, target)
+
+
+def check_processes():
+    """Restart processes which have terminated, and kill the stopped
+    workers which haven't exited in time."""
+    for pdata in list(process_list):
+        if pdata['process_handle'].poll() is not None:
+            print(("Process %s has terminated, restarting it" % (
+                pdata['name']
+            )))
+            restart_process(pdata)
+
+    table = process_table()
+    for pid, stopped in list(stopping_workers.items()):
+        if worker_process(pid, table) is None:
+            # Exited, or no longer ours
+            del stopping_workers[pid]
+        elif time.time() - stopped > stop_timeout:
+            print("Killing worker with pid %s" % pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            del stopping_workers[pid]
+
+
+def check_stalled_processes():
+    """Handle processes which have stopped making progress on an item.
+
+    Kills the programs run by the worker, like tesseract or LibreOffice,
+    so the conversion fails and the worker moves on, or stops the worker if
+    it runs no programs.
+    """
+    table = process_table()
+    for state in heartbeat_monitor.stalled():
+        pid = state['pid']
+        p = worker_process(pid, table)
+        heartbeat_monitor.forget(pid)
+        if p is None:
+            continue
+        item = ConversionQueueItem.objects.filter(pk=state['item']).first()
+        if item is not None:
+            item.url.scan.log_occurrence(
+                "PROCESS STALLED: type <{0}>, URL: {1}".format(
+                    item.type,
+                    item.url.url
+                )
+            )
+        programs = descendants(state['worker'], table)
+        if programs:
+            print("Worker with pid %s has stalled, killing %s" % (
+                pid, " ".join(str(program) for program in programs)
+            ))
+            for program in programs:
+                try:
+                    os.kill(program, signal.SIGKILL)
+                except OSError:
+                    pass
+        else:
+            print("Worker with pid %s of process %s has stalled, "
+                  "stopping it" % (pid, p['name']))
+            stop_worker(pid)
+
+
+def check_stuck_items():
+    """Stop workers which have been processing an item for too long, and
+    fail items of workers which are gone."""
+    stuck_processes = ConversionQueueItem.objects.filter(
+        status=ConversionQueueItem.PROCESSING,
+        process_start_time__lt=(
+            timezone.localtime(timezone.now()) - processing_timeout
+        ),
+    )
+
+    table = process_table()
+    for p in stuck_processes:
+        pid = p.process_id
+        stuck_process = worker_process(pid, table)
+        if stuck_process is not None:
+            print("Worker with pid %s of process %s is stuck, stopping "
+                  "it" % (pid, stuck_process['name']))
+            stop_worker(pid)
+        else:
+            p.status = ConversionQueueItem.FAILED
+            try:
+                p.url.scan.log_occurrence(
+                    "PROCESS STUCK: type <{0}>, URL: {1}".format(
+                        p.type,
+                        p.url.url
+                    )
+                )
+            except:
+                p.url.scan.log_occurrence(
+                    "PROCESS STUCK: url <{0}>".format(
+                        p.url.url,
+                    )
+                )
+            # Clean up failed conversion temp dir
+            if os.access(p.tmp_dir, os.W_OK):
+                shutil.rmtree(p.tmp_dir, True)
+            p.save()
+            # Clean up failed conversion temp dir
+            p.delete_tmp_dir()
+
+
+def check_scans():
+    """Mark running scans whose process has died as failed."""
+    try:
+        with transaction.atomic():
+            running_scans = Scan.objects.filter(
+                status=Scan.STARTED
+            ).select_for_update(nowait=True)
+            for scan in running_scans:
+                if not scan.pid:
+                    continue
+                try:
+                    # Check if process is still running
+                    os.kill(scan.pid, 0)
+                except OSError:
+                    scan.status = Scan.FAILED
+                    scan.log_occurrence(
+                        "SCAN FAILED: Process died"
+                    )
+                    scanner = scan.scanner
+                    scanner.is_running = False
+                    scanner.save()
+                    scan.save()
+    except (DatabaseError, IntegrityError) as ex:
+        print('Error occured while trying to kill process %s' % scan.pid)
+        print('Error message %s' % ex)
+        pass
+
+
 def exit_handler(signum=None, frame=None):
     """Handle process manager exit signals by stopping all processes."""
     for p in process_list:
         stop_process(p)
+    if heartbeat_monitor is not None:
+        heartbeat_monitor.close()
     sys.exit(1)
 
 
@@ -175,102 +438,66 @@ def main():
     # Delete all inactive scan's queue items to start with
     Scan.cleanup_finished_scans(timedelta(days=10000), log=True)
 
-    for ptype in process_types:
-        for i in range(processes_per_type):
-            name = '%s%d' % (ptype, i)
-            program = [
-                'python',
-                os.path.join(base_dir, 'scrapy-webscanner',
-                             'process_queue.py'),
-                ptype
-            ]
-            # Libreoffice takes the homedir name as second arg
-            if "libreoffice" == ptype:
-                program.append(name)
-            p = {'program_args': program, 'name': name}
-            process_map[name] = p
-            process_list.append(p)
+    # Build the name and street name indexes before starting the processors,
+    # so they only have to map them into memory.
+    NameRule.load_indexes()
+    AddressRule.load_indexes()
+
+    processes_per_type = getattr(settings, 'PROCESS_MANAGER_PROCESSES', {})
+    autoscaler = Autoscaler(
+        dict((ptype, processes_per_type.get(ptype,
+                                            default_processes_per_type))
+             for ptype in process_types),
+        getattr(settings, 'PROCESS_MANAGER_MAX_PROCESSES', None),
+        status_file
+    )
+    global heartbeat_monitor
+    heartbeat_monitor = HeartbeatMonitor()
 
-    for p in process_list:
-        start_process(p)
+    # Wake up from select when a process exits
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_read, False)
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    last_run = {}
+
+    def due(check, interval):
+        """Return whether it is time to run the check again."""
+        if time.time() - last_run.get(check, 0) < interval:
+            return False
+        last_run[check] = time.time()
+        return True
 
     while True:
         sys.stdout.flush()
         sys.stderr.flush()
-        db.reset_queries()
-        for pdata in process_list:
-            if pdata['process_handle'].poll() is not None:
-                print(("Process %s has terminated, restarting it" % (
-                    pdata['name']
-                )))
-                restart_process(pdata)
-
-        stuck_processes = ConversionQueueItem.objects.filter(
-            status=ConversionQueueItem.PROCESSING,
-            process_start_time__lt=(
-                timezone.localtime(timezone.now()) - processing_timeout
-            ),
-        )
-
-        for p in stuck_processes:
-            pid = p.process_id
-            if pid in process_map:
-                print("Process with pid %s is stuck, restarting" % pid)
-                stuck_process = process_map[pid]
-                restart_process(stuck_process)
-            else:
-                p.status = ConversionQueueItem.FAILED
-                try:
-                    p.url.scan.log_occurrence(
-                        "PROCESS STUCK: type <{0}>, URL: {1}".format(
-                            p.type,
-                            p.url.url
-                        )
-                    )
-                except:
-                    p.url.scan.log_occurrence(
-                        "PROCESS STUCK: url <{0}>".format(
-                            p.url.url,
-                        )
-                    )
-                # Clean up failed conversion temp dir
-                if os.access(p.tmp_dir, os.W_OK):
-                    shutil.rmtree(p.tmp_dir, True)
-                p.save()
-                # Clean up failed conversion temp dir
-                p.delete_tmp_dir()
-
+        select.select([heartbeat_monitor, wakeup_read], [], [],
+                      check_interval)
         try:
-            with transaction.atomic():
-                running_scans = Scan.objects.filter(
-                    status=Scan.STARTED
-                ).select_for_update(nowait=True)
-                for scan in running_scans:
-                    if not scan.pid:
-                        continue
-                    try:
-                        # Check if process is still running
-                        os.kill(scan.pid, 0)
-                    except OSError:
-                        scan.status = Scan.FAILED
-                        scan.log_occurrence(
-                            "SCAN FAILED: Process died"
-                        )
-                        scanner = scan.scanner
-                        scanner.is_running = False
-                        scanner.save()
-                        scan.save()
-        except (DatabaseError, IntegrityError) as ex:
-            print('Error occured while trying to kill process %s' % scan.pid)
-            print('Error message %s' % ex)
+            os.read(wakeup_read, 4096)
+        except BlockingIOError:
             pass
+        heartbeat_monitor.receive()
 
-        # Cleanup finished scans from the last minute
-        Scan.cleanup_finished_scans(timedelta(minutes=1), log=True)
-
-        Scan.pause_non_ocr_conversions_on_scans_with_too_many_ocr_items()
+        check_processes()
+        check_stalled_processes()
 
-        time.sleep(10)
+        db.reset_queries()
+        if due('scaling', scaling_interval):
+            scale_processes(autoscaler)
+        if due('stuck', stuck_check_interval):
+            check_stuck_items()
+        if due('scans', scan_check_interval):
+            check_scans()
+        if due('cleanup', cleanup_interval):
+            # Cleanup scans finished since the last cleanup
+            Scan.cleanup_finished_scans(
+                timedelta(seconds=2 * cleanup_interval), log=True
+            )
+        if due('ocr', ocr_check_interval):
+            Scan.pause_non_ocr_conversions_on_scans_with_too_many_ocr_items()
 
 
 try:
@@ -17,7 +17,13 @@
 
 """Program which processes the queue of the given type (argument 1).
 
-Pass extra arguments to the processor after the first argument.
+Pass extra arguments to the processor after the first argument. They are
+formatted with the number of the worker, see Zygote.
+
+The queue is processed by workers forked from this process, which has
+Django, the processors and the rules loaded, see Zygote. A worker exits
+when it needs recycling and is replaced by a new one. The number of
+workers, one to begin with, is read from lines written to standard input.
 """
 
 import os
@@ -31,18 +37,19 @@ os.environ["DJANGO_SETTINGS_MODULE"] = "webscanner.settings"
 django.setup()
 
 from scanner.processors.processor import Processor
+from scanner.processors.prefork import Zygote
+from scanner.rules.name import NameRule
+from scanner.rules.address import AddressRule
+# Preload the scanner, which processors import when they process items
+from scanner.scanner.scanner import Scanner  # noqa
 
-pid = os.getpid()
+# Map the name and street name indexes into memory once, for all children
+NameRule.load_indexes()
+AddressRule.load_indexes()
 
 queued_processor = Processor.processor_by_type(sys.argv[1])
 
-setup_args = [pid]
-if len(sys.argv) > 2:
-    setup_args.extend(sys.argv[2:])
+setup_args = sys.argv[2:]
 
 if queued_processor is not None:
-    queued_processor.setup_queue_processing(*setup_args)
-    try:
-        queued_processor.process_queue()
-    except KeyboardInterrupt:
-        pass
+    Zygote(queued_processor, setup_args, control=sys.stdin.fileno()).run()
@@ -19,6 +19,7 @@ from urllib.parse import urlparse
 
 import os
 import sys
+import json
 import django
 
 # Include the Django app
@@ -40,10 +41,12 @@ from scanner.spiders.sitemap import SitemapURLGathererSpider
 
 from scrapy.exceptions import DontCloseSpider
 
+from django.conf import settings as django_settings
 from django.utils import timezone
 from django.core.exceptions import MultipleObjectsReturned
 
 from scanner.scanner.scanner import Scanner
+from scanner.rulepool import RulePool
 from os2webscanner.models.scan_model import Scan
 from os2webscanner.models.statistic_model import Statistic
 from os2webscanner.models.conversionqueueitem_model import ConversionQueueItem
@@ -65,9 +68,6 @@ def signal_handler(signal, frame):
     reactor.stop()
 
 
-signal.signal(signal.SIGINT | signal.SIGTERM, signal_handler)
-
-
 class ScannerApp:
     """A scanner application which can be run."""
 
@@ -83,21 +83,66 @@ class ScannerApp:
         self.scan_object = Scan.objects.get(pk=self.scan_id)
         self.scan_object.set_scan_status_start()
         self.scanner = Scanner(self.scan_id)
+        self.rule_pool = None
 
     def run(self):
         """Run the scanner, blocking until finished."""
         settings = get_project_settings()
+        if hasattr(self.scan_object, 'webscan'):
+            self.apply_crawl_profile(settings)
 
         self.crawler_process = CrawlerProcess(settings)
 
-        if hasattr(self.scan_object, 'webscan'):
-            self.start_webscan_crawlers()
-        else:
-            self.start_filescan_crawlers()
+        workers = getattr(django_settings, 'RULE_POOL_WORKERS', None)
+        if workers != 0:
+            self.rule_pool = RulePool(self.scan_id, workers)
+
+        try:
+            if hasattr(self.scan_object, 'webscan'):
+                self.start_webscan_crawlers()
+            else:
+                self.start_filescan_crawlers()
+        finally:
+            if self.rule_pool is not None:
+                self.rule_pool.close()
 
         # Update scan status
         self.scan_object.set_scan_status_done()
 
+    def apply_crawl_profile(self, settings):
+        """Apply the scan's crawl profile to the Scrapy settings.
+
+        The effective values of the settings the profiles can change are
+        recorded in the scan's statistics.
+        """
+        profiles = django_settings.CRAWL_PROFILES
+        profile = self.scan_object.webscan.crawl_profile
+        if profile not in profiles:
+            logging.warning('Unknown crawl profile {0}, using default'.format(
+                profile)
+            )
+            profile = 'default'
+        settings.setdict(profiles[profile], priority='spider')
+
+        names = set()
+        for profile_settings in profiles.values():
+            names.update(profile_settings)
+        effective = dict((name, settings.get(name)) for name in names)
+        effective['CRAWL_PROFILE'] = profile
+        logging.info('Crawl settings: {0}'.format(effective))
+
+        try:
+            statistics, created = Statistic.objects.get_or_create(
+                scan=self.scan_object
+            )
+        except MultipleObjectsReturned:
+            logging.error('Multiple statistics objects found for scan job {}'.format(
+                self.scan_id)
+            )
+            return
+        statistics.crawl_settings = json.dumps(effective, sort_keys=True)
+        statistics.save()
+
     def start_filescan_crawlers(self):
         self.sitemap_spider = None
         self.scanner_spider = self.setup_scanner_spider()
@@ -235,9 +280,17 @@ class ScannerApp:
     def handle_idle(self, spider):
         """Handle when the spider is idle.
 
-        Keep it open if there are still queue items to be processed.
+        Keep it open if there are still queue items to be processed, or
+        URLs waiting to be stored and scanned.
         """
         logging.debug("Spider Idle...")
+        if spider.writer.pending:
+            logging.info(
+                "Keeping spider alive: %d entries waiting to be stored" %
+                spider.writer.pending
+            )
+            raise DontCloseSpider
+
         # Keep spider alive if there are still queue items to be processed
         remaining_queue_items = ConversionQueueItem.objects.filter(
             status__in=[ConversionQueueItem.NEW,
@@ -255,5 +308,10 @@ class ScannerApp:
             logging.info("No more active processors, closing spider...")
 
 
-scanner_app = ScannerApp()
-scanner_app.run()
+if __name__ == '__main__':
+    # The rule pool's workers import this module to set up Django, so only
+    # run the scan when run as a script
+    signal.signal(signal.SIGINT | signal.SIGTERM, signal_handler)
+
+    scanner_app = ScannerApp()
+    scanner_app.run()
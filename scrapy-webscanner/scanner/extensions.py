@@ -0,0 +1,209 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+"""Extensions for the scanner."""
+
+import time
+import weakref
+import logging
+
+from twisted.internet import task
+from scrapy import signals
+
+from django.conf import settings as django_settings
+from django.db.models import Count
+
+from os2webscanner.models.conversionqueueitem_model import ConversionQueueItem
+
+# Maps crawlers to the reasons they are paused for
+_pause_reasons = weakref.WeakKeyDictionary()
+
+
+def pause(crawler, reason):
+    """Pause the crawl for the reason.
+
+    The crawl stays paused until it has been resumed for every reason it
+    was paused for, so extensions don't resume each other's pauses.
+    """
+    reasons = _pause_reasons.setdefault(crawler, set())
+    if not reasons:
+        crawler.engine.pause()
+    reasons.add(reason)
+
+
+def resume(crawler, reason):
+    """Resume the crawl paused for the reason."""
+    reasons = _pause_reasons.get(crawler, set())
+    reasons.discard(reason)
+    if not reasons:
+        crawler.engine.unpause()
+
+
+class ConversionQueueBackpressure(object):
+
+    """Pauses the crawl while the scan's conversion queue is too long.
+
+    Every check_interval seconds, counts the scan's items waiting in the
+    conversion queue by type. If a type has more items than its high
+    watermark, the crawler stops scheduling new downloads, and it starts
+    again when all types are back below their low watermarks. Downloads in
+    progress are finished, and other scans carry on, as their crawlers only
+    look at their own queue items.
+
+    The watermarks are configured per processor type with the
+    CONVERSION_QUEUE_WATERMARKS setting.
+    """
+
+    check_interval = 5
+
+    def __init__(self, crawler):
+        """Initialize the extension for the crawler."""
+        self.crawler = crawler
+        self.scan = None
+        self.task = None
+        # The types above their high watermark and not yet below their low
+        self.full_types = set()
+        self.paused_time = None
+        crawler.signals.connect(self.spider_opened,
+                                signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed,
+                                signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Create the extension for the crawler."""
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        """Start checking the queue, if the spider feeds it."""
+        if spider.name != 'scanner':
+            return
+        self.scan = spider.scanner.scan_object
+        self.task = task.LoopingCall(self.check, spider)
+        self.task.start(self.check_interval, now=False)
+
+    def spider_closed(self, spider):
+        """Stop checking the queue."""
+        if self.task is not None and self.task.running:
+            self.task.stop()
+
+    def watermarks(self, item_type):
+        """Return the (high, low) watermarks of the type."""
+        watermarks = getattr(django_settings, 'CONVERSION_QUEUE_WATERMARKS',
+                             {})
+        return watermarks.get(item_type,
+                              watermarks.get('default', (None, None)))
+
+    def queue_lengths(self):
+        """Return the number of the scan's waiting items by type."""
+        return dict(ConversionQueueItem.objects.filter(
+            url__scan=self.scan,
+            status=ConversionQueueItem.NEW
+        ).values_list('type').annotate(Count('pk')))
+
+    def get_full_types(self, queue_lengths, full_types):
+        """Return the types whose queues are too long.
+
+        A type is too long above its high watermark, and stays too long
+        until it is below its low watermark again.
+        """
+        result = set()
+        for item_type, length in queue_lengths.items():
+            high, low = self.watermarks(item_type)
+            if high is None:
+                continue
+            if length > high or (item_type in full_types and length > low):
+                result.add(item_type)
+        return result
+
+    def check(self, spider):
+        """Pause or resume the crawl according to the queue lengths."""
+        queue_lengths = self.queue_lengths()
+        full_types = self.get_full_types(queue_lengths, self.full_types)
+        stats = self.crawler.stats
+        if full_types and not self.full_types:
+            logging.info(
+                "Pausing crawl, too many conversion queue items: %s" % (
+                    ", ".join("%s %d" % (t, queue_lengths[t])
+                              for t in sorted(full_types))
+                )
+            )
+            pause(self.crawler, 'conversion_queue')
+            self.paused_time = time.time()
+            stats.inc_value('conversion_queue/pauses', spider=spider)
+        elif not full_types and self.full_types:
+            paused = time.time() - self.paused_time
+            logging.info("Resuming crawl after %.0f s" % paused)
+            resume(self.crawler, 'conversion_queue')
+            stats.inc_value('conversion_queue/paused_seconds', int(paused),
+                            spider=spider)
+        self.full_types = full_types
+
+
+class RulePoolBackpressure(object):
+
+    """Pauses the crawl while the spider's rule pool is saturated.
+
+    Every check_interval seconds, looks at the jobs of the RulePool the
+    spider's writer hands HTML and text to. When the pool is saturated, the
+    crawler stops scheduling new downloads, and it starts again when half
+    of the pool's jobs are done, so pages aren't downloaded faster than the
+    rules can be executed on them.
+    """
+
+    check_interval = 0.5
+
+    def __init__(self, crawler):
+        """Initialize the extension for the crawler."""
+        self.crawler = crawler
+        self.task = None
+        self.paused_time = None
+        crawler.signals.connect(self.spider_opened,
+                                signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed,
+                                signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Create the extension for the crawler."""
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        """Start checking the pool, if the spider uses one."""
+        writer = getattr(spider, 'writer', None)
+        if writer is None or writer.pool is None:
+            return
+        self.task = task.LoopingCall(self.check, spider, writer.pool)
+        self.task.start(self.check_interval, now=False)
+
+    def spider_closed(self, spider):
+        """Stop checking the pool."""
+        if self.task is not None and self.task.running:
+            self.task.stop()
+
+    def check(self, spider, pool):
+        """Pause or resume the crawl according to the pool's jobs."""
+        stats = self.crawler.stats
+        if self.paused_time is None and pool.saturated:
+            logging.debug("Pausing crawl, rule pool saturated")
+            pause(self.crawler, 'rule_pool')
+            self.paused_time = time.time()
+            stats.inc_value('rule_pool/pauses', spider=spider)
+        elif (self.paused_time is not None
+              and pool.jobs <= pool.max_jobs // 2):
+            paused = time.time() - self.paused_time
+            resume(self.crawler, 'rule_pool')
+            self.paused_time = None
+            stats.inc_value('rule_pool/paused_seconds', paused, spider=spider)
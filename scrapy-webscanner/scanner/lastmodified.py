@@ -0,0 +1,224 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+"""An in-memory index of the last-modified dates stored for a scanner."""
+
+import logging
+
+from django import db
+from django.db import transaction
+from django.db.models import Case, CharField, DateTimeField, Value, When
+
+from os2webscanner.models.urllastmodified_model import UrlLastModified
+
+
+class LastModifiedIndex(object):
+
+    """The UrlLastModified objects of a scanner, held in memory.
+
+    All the scanner's objects are loaded at once, and kept as the id,
+    last-modified date and ETag of each, keyed by the binary MD5 of the
+    URL. Changes
+    are made in memory at once and buffered for the database: new objects
+    are inserted with a single INSERT and changed dates and ETags are
+    updated with a single UPDATE when batch_size changes are waiting, and
+    when the index is flushed.
+
+    Changed links are buffered too, as the complete set of targets of each
+    URL, so a page stored more than once in a batch is only written once.
+    They are stored by comparing them with the stored links of all the
+    batch's URLs, loaded with a single SELECT, and removing the old ones
+    with a single DELETE and inserting the new ones in bulk.
+    """
+
+    batch_size = 500
+
+    def __init__(self, scanner):
+        """Initialize the index for the Scanner model object."""
+        self.scanner = scanner
+        # Maps URL hashes to [id, last-modified date, ETag] lists
+        self.entries = {}
+        # New objects and changed dates waiting to be stored, keyed by the
+        # URL hash
+        self.new_objects = {}
+        self.changed = set()
+        # Maps URL hashes to the sets of hashes of their new link targets
+        self.new_links = {}
+
+    @staticmethod
+    def key(url):
+        """Return the key of the (canonical) URL."""
+        return bytes.fromhex(UrlLastModified.hash_url(url))
+
+    def load(self):
+        """Load the scanner's objects from the database."""
+        rows = UrlLastModified.objects.filter(
+            scanner=self.scanner
+        ).values_list('pk', 'url_hash', 'last_modified', 'etag')
+        for pk, url_hash, last_modified, etag in rows.iterator():
+            self.entries[bytes.fromhex(url_hash)] = [pk, last_modified, etag]
+        logging.info("Loaded %d last-modified dates" % len(self.entries))
+
+    def __contains__(self, url):
+        return self.key(url) in self.entries
+
+    def get_last_modified(self, url):
+        """Return the last-modified date stored for the URL, if any."""
+        entry = self.entries.get(self.key(url))
+        return entry[1] if entry is not None else None
+
+    def get_etag(self, url):
+        """Return the ETag stored for the URL, or '' if none."""
+        entry = self.entries.get(self.key(url))
+        return entry[2] if entry is not None else ''
+
+    def get_id(self, url):
+        """Return the id of the URL's object, or None if it has none.
+
+        If the object has yet to be inserted, the index is flushed first.
+        """
+        key = self.key(url)
+        if key in self.new_objects:
+            self.flush()
+        entry = self.entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def add(self, url):
+        """Make sure the URL has an object, without a last-modified date if
+        it is new."""
+        if url not in self:
+            self.set_last_modified(url, None)
+
+    def set_last_modified(self, url, last_modified, etag=None):
+        """Store the last-modified date of the URL, and its ETag, if given.
+        """
+        key = self.key(url)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = [None, last_modified, etag or '']
+            self.new_objects[key] = UrlLastModified(
+                url=url, url_hash=key.hex(), last_modified=last_modified,
+                etag=entry[2], scanner=self.scanner
+            )
+        else:
+            entry[1] = last_modified
+            if etag is not None:
+                entry[2] = etag
+            if key in self.new_objects:
+                self.new_objects[key].last_modified = entry[1]
+                self.new_objects[key].etag = entry[2]
+            else:
+                self.changed.add(key)
+        self.flush_if_full()
+
+    def get_links(self, url):
+        """Return the URLs of the links stored for the URL."""
+        key = self.key(url)
+        if key in self.new_links:
+            self.flush()
+        url_id = self.get_id(url)
+        if url_id is None:
+            return []
+        return UrlLastModified.links.through.objects.filter(
+            from_urllastmodified_id=url_id
+        ).values_list('to_urllastmodified__url', flat=True)
+
+    def set_links(self, url, target_urls):
+        """Store the URLs the URL links to, replacing those stored.
+
+        The URL and its targets get objects if they don't have any.
+        """
+        self.add(url)
+        for target_url in target_urls:
+            self.add(target_url)
+        self.new_links[self.key(url)] = set(
+            self.key(target_url) for target_url in target_urls
+        )
+        self.flush_if_full()
+
+    def flush_if_full(self):
+        """Flush the index if batch_size changes are waiting."""
+        if (len(self.new_objects) + len(self.changed) + len(self.new_links)
+                >= self.batch_size):
+            self.flush()
+
+    def flush(self):
+        """Store the buffered changes in the database."""
+        if not self.new_objects and not self.changed and not self.new_links:
+            return
+        with transaction.atomic():
+            if self.new_objects:
+                objects = list(self.new_objects.values())
+                if db.connection.features.can_return_ids_from_bulk_insert:
+                    UrlLastModified.objects.bulk_create(objects)
+                else:
+                    for url_last_modified in objects:
+                        url_last_modified.save()
+                for key, url_last_modified in self.new_objects.items():
+                    self.entries[key][0] = url_last_modified.pk
+            if self.changed:
+                entries = [self.entries[key] for key in self.changed]
+                UrlLastModified.objects.filter(
+                    pk__in=[pk for pk, last_modified, etag in entries]
+                ).update(
+                    last_modified=Case(
+                        *[When(pk=pk, then=Value(last_modified))
+                          for pk, last_modified, etag in entries],
+                        output_field=DateTimeField()
+                    ),
+                    etag=Case(
+                        *[When(pk=pk, then=Value(etag))
+                          for pk, last_modified, etag in entries],
+                        output_field=CharField()
+                    )
+                )
+            if self.new_links:
+                self.store_links()
+        logging.debug("Stored %d new and %d changed last-modified dates and "
+                      "the links of %d URLs" % (
+                          len(self.new_objects), len(self.changed),
+                          len(self.new_links)
+                      ))
+        self.new_objects = {}
+        self.changed = set()
+        self.new_links = {}
+
+    def store_links(self):
+        """Replace the stored links of the URLs with new links."""
+        through_model = UrlLastModified.links.through
+        # Maps the ids of the URLs to the ids of the targets yet to be linked
+        missing = dict(
+            (self.entries[key][0],
+             set(self.entries[target][0] for target in targets))
+            for key, targets in self.new_links.items()
+        )
+        stale = []
+        rows = through_model.objects.filter(
+            from_urllastmodified_id__in=list(missing)
+        ).values_list('pk', 'from_urllastmodified_id',
+                      'to_urllastmodified_id')
+        for pk, source_id, target_id in rows.iterator():
+            if target_id in missing[source_id]:
+                missing[source_id].remove(target_id)
+            else:
+                stale.append(pk)
+        if stale:
+            through_model.objects.filter(pk__in=stale).delete()
+        through_model.objects.bulk_create([
+            through_model(from_urllastmodified_id=source_id,
+                          to_urllastmodified_id=target_id)
+            for source_id, target_ids in missing.items()
+            for target_id in target_ids
+        ], batch_size=1000)
@@ -35,8 +35,9 @@ from scrapy.exceptions import IgnoreRequest
 from scrapy.utils.httpobj import urlparse_cached
 from scrapy.utils.url import canonicalize_url
 
-from email.utils import parsedate_tz, mktime_tz
-from os2webscanner.models.urllastmodified_model import UrlLastModified
+from email.utils import parsedate_tz, mktime_tz, formatdate
+
+from .lastmodified import LastModifiedIndex
 
 from django.conf import settings as django_settings
 
@@ -206,50 +207,31 @@ class LastModifiedLinkStorageMiddleware(object):
         if not getattr(spider, "do_last_modified_check", False):
             return result
         last_modified_header = response.headers.get("Last-Modified", None)
-        if last_modified_header is None:
+        if last_modified_header is None and not (
+                getattr(spider, "do_last_modified_check_conditional_get",
+                        False)
+                and response.headers.get("ETag", None) is not None):
             # We don't need to store the links, since the page has no
-            # Last-Modified header.
+            # Last-Modified header (or ETag to make a conditional GET with).
             return result
 
         source_url = canonicalize_url(response.request.url)
-        try:
-            url_last_modified = UrlLastModified.objects.get(
-                url=source_url,
-                scanner=self.get_scanner_object(spider)
-            )
-        except UrlLastModified.DoesNotExist:
+        index = spider.last_modified_index
+        if source_url not in index:
             # We never stored the URL for the original request: this
             # shouldn't happen.
             return result
 
-        logging.debug("Updating links for %s" % url_last_modified)
+        logging.debug("Updating links for %s" % source_url)
 
-        # Clear existing links
-        url_last_modified.links.clear()
-
-        # Update links
+        target_urls = []
         for r in result:
             if isinstance(r, Request):
                 if spider.is_offsite(r) or spider.is_excluded(r):
                     continue
-                target_url = canonicalize_url(r.url)
-                # Get or create a URL last modified object
-                try:
-                    link = UrlLastModified.objects.get(
-                        url=target_url,
-                        scanner=self.get_scanner_object(spider)
-                    )
-                except UrlLastModified.DoesNotExist:
-                    # Create new link
-                    link = UrlLastModified(
-                        url=target_url,
-                        last_modified=None,
-                        scanner=self.get_scanner_object(spider)
-                    )
-                    link.save()
-                # Add the link to the URL last modified object
-                url_last_modified.links.add(link)
-                logging.debug("Added link %s" % link)
+                target_urls.append(canonicalize_url(r.url))
+        # Stored with the next batch of changes
+        index.set_links(source_url, target_urls)
         return result
 
     def get_scanner_object(self, spider):
@@ -268,7 +250,15 @@ class LastModifiedCheckMiddleware(object):
     transferring too much data before we know if a URL has been updated),
     then check the Last-Modified header before issuing a new request.
 
-    Last-modified dates are stored in the database.
+    Or, in conditional GET mode, send the stored Last-Modified date and
+    ETag of the URL with the GET request as If-Modified-Since and
+    If-None-Match headers, and treat a 304 Not Modified response as an
+    unmodified page. So modified pages take a single request, and
+    unmodified ones aren't transferred.
+
+    Last-modified dates are stored in the database, and looked up in a
+    LastModifiedIndex of the scanner's dates, loaded when the spider opens
+    and kept as the spider's last_modified_index.
     """
 
     def __init__(self, crawler):
@@ -279,10 +269,34 @@ class LastModifiedCheckMiddleware(object):
     @classmethod
     def from_crawler(cls, crawler):
         """Instantiate the middleware."""
-        return cls(crawler)
+        o = cls(crawler)
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def spider_opened(self, spider):
+        """Load the scanner's last-modified dates."""
+        if not getattr(spider, 'do_last_modified_check', False):
+            return
+        spider.last_modified_index = LastModifiedIndex(
+            self.get_scanner_object(spider)
+        )
+        spider.last_modified_index.load()
+
+    def spider_closed(self, spider):
+        """Store the changed last-modified dates."""
+        index = getattr(spider, 'last_modified_index', None)
+        if index is not None:
+            index.flush()
 
     def process_request(self, request, spider):
         """Process a spider request."""
+        if (getattr(spider, 'do_last_modified_check_conditional_get', False)
+                and getattr(spider, 'do_last_modified_check', False)
+                and not request.meta.get('skip_modified_check', False)
+                and request.method == "GET"):
+            self.add_conditional_headers(request, spider)
+            return None
         # Make the request into a HEAD request instead of a GET request,
         # if the spider says we should and if we haven't
         # already checked the last modified date.
@@ -305,6 +319,11 @@ class LastModifiedCheckMiddleware(object):
         # if do_last_modified_check equals True, last_modified is disabled.
         if not getattr(spider, 'do_last_modified_check', False):
             return response
+        if (response.status == 304
+                and request.meta.get('conditional_get', False)):
+            logging.debug("Page not modified %s" % response)
+            self.stats.inc_value('last_modified_check/pages_not_modified')
+            self.skip_unmodified(request, response, spider)
         # We only handle HTTP status OK responses
         if response.status != 200:
             return response
@@ -332,49 +351,60 @@ class LastModifiedCheckMiddleware(object):
                 return response
 
         else:
-            # Add requests for all the links that we know were on the
-            # page the last time we visited it.
-            if hasattr(spider.scanner.scan_object, 'webscan'):
-                links = self.get_stored_links(response.url, spider)
-                for link in links:
-                    req = Request(link.url,
-                                  callback=request.callback,
-                                  errback=request.errback,
-                                  headers={"referer": response.url})
-                    logging.debug("Adding request %s" % req)
-                    self.crawler.engine.crawl(req, spider)
-            # Ignore the request, since the content has not been modified
-            self.stats.inc_value('last_modified_check/pages_skipped')
-            raise IgnoreRequest
+            self.skip_unmodified(request, response, spider)
+
+    def skip_unmodified(self, request, response, spider):
+        """Skip the unmodified page by raising IgnoreRequest.
+
+        Adds requests for all the links that we know were on the page the
+        last time we visited it first.
+        """
+        if hasattr(spider.scanner.scan_object, 'webscan'):
+            links = self.get_stored_links(response.url, spider)
+            for link in links:
+                req = Request(link,
+                              callback=request.callback,
+                              errback=request.errback,
+                              headers={"referer": response.url})
+                logging.debug("Adding request %s" % req)
+                self.crawler.engine.crawl(req, spider)
+        # Ignore the request, since the content has not been modified
+        self.stats.inc_value('last_modified_check/pages_skipped')
+        raise IgnoreRequest
+
+    def add_conditional_headers(self, request, spider):
+        """Make the request conditional on the URL's stored Last-Modified
+        date and ETag, if any."""
+        # Validators of another URL may have been copied from a redirected
+        # request
+        for header in ('If-Modified-Since', 'If-None-Match'):
+            request.headers.pop(header, None)
+        request.meta['conditional_get'] = False
+
+        url = canonicalize_url(request.url)
+        index = spider.last_modified_index
+        last_modified = index.get_last_modified(url)
+        etag = index.get_etag(url)
+        if last_modified is not None:
+            request.headers['If-Modified-Since'] = formatdate(
+                last_modified.timestamp(), usegmt=True
+            )
+            request.meta['conditional_get'] = True
+        if etag:
+            request.headers['If-None-Match'] = etag.encode('latin-1')
+            request.meta['conditional_get'] = True
 
     def get_stored_links(self, url, spider):
-        """Return the links that have been stored for this URL."""
-        url = canonicalize_url(url)
-        try:
-            url_last_modified = UrlLastModified.objects.get(
-                url=url, scanner=self.get_scanner_object(spider))
-            return url_last_modified.links.all()
-        except UrlLastModified.DoesNotExist:
-            return []
+        """Return the URLs of the links that have been stored for this URL.
+        """
+        return spider.last_modified_index.get_links(canonicalize_url(url))
 
     def get_stored_last_modified_date(self, url, spider):
         """Return the last modified date that has been stored for this URL."""
-        url_last_modified_object = self.get_stored_last_modified_object(url,
-                                                                        spider)
-        if url_last_modified_object is not None:
-            return url_last_modified_object.last_modified
-        else:
-            return None
-
-    def get_stored_last_modified_object(self, url, spider):
-        """Return the UrlLastModified object for the given URL."""
-        url = canonicalize_url(url)
-        try:
-            url_last_modified = UrlLastModified.objects.get(
-                url=url, scanner=self.get_scanner_object(spider))
-            return url_last_modified
-        except UrlLastModified.DoesNotExist:
+        index = getattr(spider, 'last_modified_index', None)
+        if index is None:
             return None
+        return index.get_last_modified(canonicalize_url(url))
 
     def get_scanner_object(self, spider):
         """Return the spider's scanner object."""
@@ -386,7 +416,17 @@ class LastModifiedCheckMiddleware(object):
         We check against the database here.
         If the response has been modified, we update the database.
         If there is no stored last modified date, we save one.
+        In conditional GET mode, the response's ETag is stored too, and a
+        changed ETag means the response has been modified.
         """
+        etag = None
+        if getattr(spider, 'do_last_modified_check_conditional_get', False):
+            etag_header = response.headers.get("ETag", None)
+            # ETags too long to store are of no use
+            if etag_header is not None and len(etag_header) <= 256:
+                # Header values are bytes, and needn't be UTF-8
+                etag = etag_header.decode('latin-1')
+
         if hasattr(spider.scanner.scan_object, 'filescan'):
             try:
                 # Removes unneeded prefix
@@ -454,37 +494,44 @@ class LastModifiedCheckMiddleware(object):
                     logging.debug("Last modified %s" % last_modified)
 
         if last_modified is not None:
-            # Check against the database
+            # Check against the stored dates
             canonical_url = canonicalize_url(response.url)
-            try:
-                url_last_modified = UrlLastModified.objects.get(
-                    url=canonical_url,
-                    scanner=self.get_scanner_object(spider)
-                )
-                stored_last_modified = url_last_modified.last_modified
+            index = spider.last_modified_index
+            if canonical_url in index:
+                stored_last_modified = index.get_last_modified(canonical_url)
                 logging.info("Comparing header %s against stored %s" % (
                     last_modified, stored_last_modified))
                 if (stored_last_modified is not None
                         and last_modified == stored_last_modified):
+                    stored_etag = index.get_etag(canonical_url)
+                    if etag is not None and etag != stored_etag:
+                        index.set_last_modified(canonical_url, last_modified,
+                                                etag)
+                        # A new ETag means new content, even if the date is
+                        # the same, e.g. after edits within a second
+                        return bool(stored_etag)
                     return False
                 else:
-                    # Update last-modified date in database
-                    url_last_modified.last_modified = last_modified
-                    url_last_modified.save()
+                    # Update last-modified date
+                    index.set_last_modified(canonical_url, last_modified,
+                                            etag)
                     return True
-            except UrlLastModified.DoesNotExist:
+            else:
                 logging.debug("No stored Last-Modified header found.")
-                url_last_modified = UrlLastModified(
-                    url=canonical_url,
-                    last_modified=last_modified,
-                    scanner=self.get_scanner_object(spider)
-                )
-                logging.debug("Saving new last-modified value %s" %
-                            url_last_modified)
-                url_last_modified.save()
+                logging.debug("Saving new last-modified value %s for %s" %
+                              (last_modified, canonical_url))
+                index.set_last_modified(canonical_url, last_modified, etag)
                 return True
         else:
             # If there is no Last-Modified header, we have to assume it has
             # been modified.
             logging.debug('No Last-Modified header found at all.')
+            if etag is not None:
+                # Store the ETag for the next conditional GET
+                canonical_url = canonicalize_url(response.url)
+                index = spider.last_modified_index
+                index.set_last_modified(
+                    canonical_url, index.get_last_modified(canonical_url),
+                    etag
+                )
             return True
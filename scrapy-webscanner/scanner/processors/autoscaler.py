@@ -0,0 +1,199 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+"""Scaling of the number of queue processors to the conversion queue."""
+
+import os
+import json
+import math
+import datetime
+import collections
+
+from django.db.models import Q, Count, Min
+from django.utils import timezone
+
+from os2webscanner.models.conversionqueueitem_model import ConversionQueueItem
+
+from .utils import datetime_print
+
+
+def host_stats():
+    """Return the number of CPUs, the load average and available memory.
+
+    The available memory is a fraction of the total memory, or None if it
+    can't be determined.
+    """
+    cpus = os.cpu_count() or 1
+    load = os.getloadavg()[0]
+    memory = None
+    try:
+        meminfo = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0])
+        memory = meminfo['MemAvailable'] / meminfo['MemTotal']
+    except (IOError, KeyError, ValueError, ZeroDivisionError):
+        pass
+    return {'cpus': cpus, 'load': load, 'memory': memory}
+
+
+class Autoscaler(object):
+
+    """Decides how many queue processors of each type to run.
+
+    Each type gets a processor per items_per_process items waiting in its
+    queue, within the type's (minimum, maximum) bounds. If the oldest item
+    has waited longer than max_item_age seconds, the type gets at least one
+    processor more than it has. All types get their minimum; the rest of the
+    max_processes budget goes to the types with the most items waiting per
+    processor first.
+
+    Processors are only added while the host has headroom, i.e. the load
+    average is below max_load per CPU and at least min_memory of the memory
+    is available, and are removed one at a time, so a short lull doesn't
+    stop processors which are needed again right after.
+
+    The decisions are logged and, along with the queue and host statistics
+    they were based on, written as JSON to status_file.
+    """
+
+    items_per_process = 20
+    max_item_age = 300
+    max_load = 1.5
+    min_memory = 0.1
+
+    def __init__(self, bounds, max_processes=None, status_file=None):
+        """Initialize the autoscaler.
+
+        bounds maps each processor type to the (minimum, maximum) number of
+        processors of that type. max_processes defaults to two per CPU.
+        """
+        self.bounds = bounds
+        self.max_processes = max_processes or 2 * (os.cpu_count() or 1)
+        self.status_file = status_file
+        self.decisions = collections.deque(maxlen=50)
+
+    def queue_stats(self):
+        """Return the number of waiting items and the age of the oldest.
+
+        Returns a dict mapping each processor type to a (number of items,
+        age in seconds or None) tuple. Items of scans whose non-OCR
+        conversions are paused are not counted.
+        """
+        rows = ConversionQueueItem.objects.filter(
+            Q(type='ocr') | Q(url__scan__pause_non_ocr_conversions=False),
+            status=ConversionQueueItem.NEW
+        ).values('type').annotate(
+            backlog=Count('pk'), oldest=Min('created_time')
+        )
+        now = timezone.now()
+        stats = {}
+        for row in rows:
+            age = None
+            if row['oldest'] is not None:
+                age = (now - row['oldest']).total_seconds()
+            stats[row['type']] = (row['backlog'], age)
+        return stats
+
+    def targets(self, running, queue, host):
+        """Return the number of processors to run of each type.
+
+        running maps each type to the number of processors running, and
+        queue and host are as returned by queue_stats and host_stats.
+        """
+        headroom = host['load'] < self.max_load * host['cpus'] and (
+            host['memory'] is None or host['memory'] >= self.min_memory
+        )
+
+        desired = {}
+        for ptype, (minimum, maximum) in self.bounds.items():
+            backlog, age = queue.get(ptype, (0, None))
+            current = running.get(ptype, 0)
+            wanted = int(math.ceil(backlog / self.items_per_process))
+            if backlog and age is not None and age > self.max_item_age:
+                wanted = max(wanted, current + 1)
+            if not headroom:
+                wanted = min(wanted, current)
+            # Remove processors one at a time
+            wanted = max(wanted, current - 1)
+            desired[ptype] = max(minimum, min(maximum, wanted))
+
+        targets = dict((ptype, minimum)
+                       for ptype, (minimum, maximum) in self.bounds.items())
+        budget = self.max_processes - sum(targets.values())
+        while budget > 0:
+            candidates = [ptype for ptype in targets
+                          if targets[ptype] < desired[ptype]]
+            if not candidates:
+                break
+            ptype = max(candidates, key=lambda t: (
+                queue.get(t, (0, None))[0] / (targets[t] + 1)
+            ))
+            targets[ptype] += 1
+            budget -= 1
+        return targets
+
+    def scale(self, running):
+        """Return the number of processors to run of each type, logging
+        changes and writing the status file."""
+        queue = self.queue_stats()
+        host = host_stats()
+        targets = self.targets(running, queue, host)
+
+        for ptype in sorted(targets):
+            current = running.get(ptype, 0)
+            if targets[ptype] != current:
+                backlog, age = queue.get(ptype, (0, None))
+                decision = (
+                    "Scaling %s processors from %d to %d (%d items waiting, "
+                    "oldest %s s, load %.2f on %d CPUs, memory available %s)"
+                    % (ptype, current, targets[ptype], backlog,
+                       "%.0f" % age if age is not None else "-",
+                       host['load'], host['cpus'],
+                       "%.0f%%" % (100 * host['memory'])
+                       if host['memory'] is not None else "-")
+                )
+                datetime_print(decision)
+                self.decisions.append(
+                    '{0} : {1}'.format(datetime.datetime.now(), decision)
+                )
+
+        if self.status_file:
+            self.write_status(running, targets, queue, host)
+        return targets
+
+    def write_status(self, running, targets, queue, host):
+        """Write the state of the autoscaler to the status file."""
+        status = {
+            'time': datetime.datetime.now().isoformat(),
+            'host': host,
+            'max_processes': self.max_processes,
+            'types': dict(
+                (ptype, {
+                    'running': running.get(ptype, 0),
+                    'target': targets[ptype],
+                    'minimum': self.bounds[ptype][0],
+                    'maximum': self.bounds[ptype][1],
+                    'backlog': queue.get(ptype, (0, None))[0],
+                    'oldest_age': queue.get(ptype, (0, None))[1],
+                }) for ptype in targets
+            ),
+            'decisions': list(self.decisions),
+        }
+        tmp_file = self.status_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(status, f, indent=2)
+        os.rename(tmp_file, self.status_file)
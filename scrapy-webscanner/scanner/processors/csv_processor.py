@@ -20,6 +20,7 @@ from os2webscanner.models.sensitivity_level import Sensitivity
 
 from ..scanner.scanner import Scanner
 from .processor import Processor
+from .match_sink import MatchSink
 from .text import TextProcessor
 
 import os
@@ -44,14 +45,26 @@ class CSVProcessor(Processor):
             os.remove(item.file_path)
         return result
 
-    def process(self, data, url_object):
+    def process_stream(self, read, url_object, page_no=None):
+        """Process the CSV read in pieces.
+
+        Only CSV files which don't need annotation/replacement are scanned
+        in pieces, as plain text.
+        """
+        scanner = Scanner.for_scan(url_object.scan)
+        if not scanner.scan_object.output_spreadsheet_file:
+            return self.text_processor.process_stream(read, url_object,
+                                                      page_no)
+        return self.process(read(), url_object, page_no)
+
+    def process(self, data, url_object, page_no=None):
         """Process the CSV, by executing rules and saving matches."""
-        scanner = Scanner(url_object.scan.pk)
+        scanner = Scanner.for_scan(url_object.scan)
         # print "*** 1 ***"
         # If we don't have to do any annotation/replacement, treat it like a
         # normal text file for efficiency
         if not scanner.scan_object.output_spreadsheet_file:
-            return self.text_processor.process(data, url_object)
+            return self.text_processor.process(data, url_object, page_no)
 
         # Check if scan is limited to certain columns.
         columns = scanner.scan_object.columns
@@ -90,6 +103,8 @@ class CSVProcessor(Processor):
                                    dialect)
         first_row = True
         header_row = []
+        # Matches are stored in bulk once all rows have been scanned
+        sink = MatchSink(url_object, page_no)
         for row in reader:
             warnings_in_row = []
             if first_row:
@@ -109,9 +124,7 @@ class CSVProcessor(Processor):
                 matches = scanner.execute_rules(row[i])
                 for match in matches:
                     # Save matches
-                    match['url'] = url_object
-                    match['scan'] = url_object.scan
-                    match.save()
+                    sink.add(match)
 
                     warnings_in_row.append((match['matched_rule'], i))
 
@@ -150,6 +163,7 @@ class CSVProcessor(Processor):
             ) for warning in warnings_in_row)
             row.append(annotation)
             rows.append(row)
+        sink.flush()
 
         # print "*** 4 ***"
         # Write to output file
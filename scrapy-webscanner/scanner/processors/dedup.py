@@ -0,0 +1,168 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+"""Detection of files which have already been scanned, by their MD5 sums."""
+
+import time
+
+from django.db import IntegrityError
+from django.conf import settings
+
+from os2webscanner.models.md5sum_model import Md5Sum
+
+
+class BloomFilter(object):
+
+    """A Bloom filter of MD5 sums.
+
+    Tells whether an MD5 sum may have been added to the filter, with about
+    1% false positives as long as no more than capacity sums are added, and
+    no false negatives.
+    """
+
+    bits_per_item = 10
+    hash_count = 7
+
+    def __init__(self, capacity):
+        """Initialize an empty filter for up to capacity MD5 sums."""
+        self.capacity = capacity
+        self.size = capacity * self.bits_per_item
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, md5):
+        """Return the bit positions of the MD5 sum (a hex string)."""
+        # The MD5 sum is already uniformly distributed, so its two halves
+        # serve as the hash functions for double hashing.
+        h1 = int(md5[:16], 16)
+        h2 = int(md5[16:], 16) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, md5):
+        """Add the MD5 sum to the filter."""
+        for position in self._positions(md5):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, md5):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(md5))
+
+
+class DedupService(object):
+
+    """Keeps track of the files scanned for each organization.
+
+    Files are identified by their MD5 sum and are known per organization and
+    rule configuration (the scan's rules fingerprint), so a file is scanned
+    again when the rules change.
+
+    Each process keeps a Bloom filter of the known MD5 sums per organization
+    and rule configuration, so unknown files, which are most files, can be
+    told apart without asking the database. Sums stored by other processes
+    are added to the filter every refresh_interval seconds; until then, a
+    file scanned by another process may be scanned again.
+    """
+
+    # Seconds between loading new MD5 sums from the database
+    refresh_interval = 60
+    # Minimum capacity of a filter
+    min_capacity = 64 * 1024
+
+    # Maps (organization id, rules fingerprint) to a [filter, id of the last
+    # loaded Md5Sum, time of the last refresh] list
+    _filters = {}
+    # Maps a scan id to a (rules fingerprint, time) tuple
+    _fingerprints = {}
+
+    @classmethod
+    def rules_fingerprint(cls, scan):
+        """Return the scan's rules fingerprint, cached for a while."""
+        cached = cls._fingerprints.get(scan.pk)
+        now = time.time()
+        if cached is not None and now - cached[1] < cls.refresh_interval:
+            return cached[0]
+        fingerprint = scan.rules_fingerprint
+        cls._fingerprints[scan.pk] = (fingerprint, now)
+        return fingerprint
+
+    @classmethod
+    def _filter(cls, organization_id, fingerprint):
+        """Return the filter of MD5 sums, loading new sums if it is time."""
+        key = (organization_id, fingerprint)
+        entry = cls._filters.get(key)
+        now = time.time()
+        if entry is not None and now - entry[2] < cls.refresh_interval:
+            return entry[0]
+
+        if entry is None:
+            entry = [BloomFilter(cls.min_capacity), 0, now]
+            cls._filters[key] = entry
+        new_sums = Md5Sum.objects.filter(
+            organization_id=organization_id,
+            rules_fingerprint=fingerprint,
+            pk__gt=entry[1]
+        ).order_by('pk').values_list('pk', 'md5')
+        for pk, md5 in new_sums.iterator():
+            entry[0].add(md5)
+            entry[1] = pk
+        entry[2] = now
+
+        if entry[0].count > entry[0].capacity:
+            # Too full to be useful; start over with a larger filter
+            del cls._filters[key]
+            cls.min_capacity = max(cls.min_capacity, 2 * entry[0].count)
+            return cls._filter(organization_id, fingerprint)
+        return entry[0]
+
+    @classmethod
+    def is_known(cls, md5, scan):
+        """Return whether the file with the given MD5 sum has been scanned
+        by the organization with the scan's rules."""
+        if not settings.DO_USE_MD5:
+            return False
+        organization_id = scan.scanner.organization_id
+        fingerprint = cls.rules_fingerprint(scan)
+        if md5 not in cls._filter(organization_id, fingerprint):
+            return False
+        # Possibly a false positive
+        return Md5Sum.objects.filter(
+            organization_id=organization_id,
+            md5=md5,
+            rules_fingerprint=fingerprint,
+        ).exists()
+
+    @classmethod
+    def store(cls, md5, scan):
+        """Remember that the file with the given MD5 sum has been scanned by
+        the organization with the scan's rules."""
+        if not settings.DO_USE_MD5:
+            return
+        organization_id = scan.scanner.organization_id
+        fingerprint = cls.rules_fingerprint(scan)
+        md5_sum = Md5Sum(
+            organization_id=organization_id,
+            md5=md5,
+            rules_fingerprint=fingerprint,
+            is_cpr_scan=scan.do_cpr_scan,
+            is_check_mod11=scan.do_cpr_modulus11,
+            is_ignore_irrelevant=scan.do_cpr_ignore_irrelevant,
+        )
+        try:
+            md5_sum.save()
+        except IntegrityError:
+            # This happens, we now know - but is not actually an error.
+            pass
+        cls._filter(organization_id, fingerprint).add(md5)
@@ -0,0 +1,231 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+"""Heartbeats from queue processors to the process manager."""
+
+import os
+import json
+import time
+import socket
+import threading
+
+from django.conf import settings
+
+_clock_ticks = os.sysconf('SC_CLK_TCK')
+
+
+def socket_path():
+    """Return the path of the process manager's heartbeat socket."""
+    return os.path.join(settings.VAR_DIR, 'process_manager.sock')
+
+
+def process_table():
+    """Return a dict mapping the pid of each process to its parent's pid and
+    CPU time in seconds."""
+    table = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                stat = f.read()
+        except IOError:
+            # The process has exited
+            continue
+        # The command name may contain spaces, so split after it
+        fields = stat[stat.rfind(')') + 2:].split()
+        table[int(name)] = (
+            int(fields[1]),
+            (int(fields[11]) + int(fields[12])) / _clock_ticks
+        )
+    return table
+
+
+def thread_cpu_times():
+    """Return a dict mapping the thread id of each thread of this process to
+    its CPU time in seconds."""
+    times = {}
+    for name in os.listdir('/proc/self/task'):
+        try:
+            with open('/proc/self/task/%s/stat' % name) as f:
+                stat = f.read()
+        except IOError:
+            # The thread has exited
+            continue
+        fields = stat[stat.rfind(')') + 2:].split()
+        times[int(name)] = (int(fields[11]) + int(fields[12])) / _clock_ticks
+    return times
+
+
+def descendants(pid, table):
+    """Return the pids of the descendants of the process."""
+    children = {}
+    for child, (parent, cpu_time) in table.items():
+        children.setdefault(parent, []).append(child)
+    result = []
+    pending = list(children.get(pid, ()))
+    while pending:
+        child = pending.pop()
+        result.append(child)
+        pending.extend(children.get(child, ()))
+    return result
+
+
+class Heartbeat(object):
+
+    """Sends heartbeats from a queue processor to the process manager.
+
+    A thread sends a heartbeat every interval seconds with the process id
+    the processor works under, the queue item it is processing, if any, and
+    its progress, i.e. the CPU time used by the processor and the programs
+    it runs, like tesseract and LibreOffice, and the bytes read and written
+    by the programs. The heartbeat thread's own CPU time and reads of /proc
+    are left out, so an idle processor makes no progress. If the process
+    manager isn't listening, the heartbeats are lost.
+    """
+
+    interval = 1
+
+    def __init__(self, pid, item_type):
+        """Initialize heartbeats for the processor with the given pid."""
+        self.pid = pid
+        self.item_type = item_type
+        self.item = None
+        # The id of the heartbeat thread, once it runs
+        self.tid = None
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        """Start sending heartbeats."""
+        self.thread.start()
+
+    def progress(self):
+        """Return the CPU time used by this process, except the heartbeat
+        thread, and its descendants, and the number of bytes read and
+        written by the descendants."""
+        table = process_table()
+        cpu_time = sum(seconds for tid, seconds in thread_cpu_times().items()
+                       if tid != self.tid)
+        io_bytes = 0
+        for pid in descendants(os.getpid(), table):
+            cpu_time += table.get(pid, (None, 0))[1]
+            try:
+                with open('/proc/%d/io' % pid) as f:
+                    for line in f:
+                        key, value = line.split(':')
+                        if key in ('rchar', 'wchar'):
+                            io_bytes += int(value)
+            except IOError:
+                pass
+        return [cpu_time, io_bytes]
+
+    def beat(self):
+        """Send a heartbeat."""
+        message = json.dumps({
+            'pid': self.pid,
+            'worker': os.getpid(),
+            'type': self.item_type,
+            'item': self.item,
+            'progress': self.progress(),
+        }).encode('utf-8')
+        try:
+            self.socket.sendto(message, socket_path())
+        except OSError:
+            # The process manager isn't running
+            pass
+
+    def run(self):
+        """Send heartbeats until the process exits."""
+        self.tid = int(os.readlink('/proc/thread-self').split('/')[-1])
+        while True:
+            self.beat()
+            time.sleep(self.interval)
+
+
+class HeartbeatMonitor(object):
+
+    """Receives heartbeats from queue processors and detects stalls.
+
+    A processor has stalled if it has been processing the same item without
+    making progress for stall_timeout seconds, while still sending
+    heartbeats. A processor which doesn't send heartbeats, e.g. because it
+    is busy holding the interpreter lock, is not judged.
+    """
+
+    stall_timeout = 30
+    # Seconds after which a processor's last heartbeat is too old to judge by
+    heartbeat_timeout = 5
+
+    def __init__(self):
+        """Listen for heartbeats on the heartbeat socket."""
+        path = socket_path()
+        if os.path.exists(path):
+            os.remove(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(path)
+        self.socket.setblocking(False)
+        # Maps pids to the state of the processors
+        self.processors = {}
+
+    def fileno(self):
+        """Return the file descriptor of the socket, for select."""
+        return self.socket.fileno()
+
+    def receive(self, now=None):
+        """Receive the waiting heartbeats."""
+        while True:
+            try:
+                data = self.socket.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                message = json.loads(data.decode('utf-8'))
+            except ValueError:
+                continue
+            self.update(message, now or time.time())
+
+    def update(self, message, now):
+        """Update the state of the processor which sent the heartbeat."""
+        state = self.processors.get(message['pid'])
+        if (state is None or state['item'] != message['item']
+                or state['worker'] != message['worker']
+                or state['progress'] != message['progress']):
+            progress_time = now
+        else:
+            progress_time = state['progress_time']
+        self.processors[message['pid']] = dict(
+            message, progress_time=progress_time, time=now
+        )
+
+    def forget(self, pid):
+        """Forget the processor, e.g. because it has been restarted."""
+        self.processors.pop(pid, None)
+
+    def stalled(self, now=None):
+        """Return the states of the stalled processors."""
+        now = now or time.time()
+        return [state for state in self.processors.values()
+                if state['item'] is not None
+                and now - state['time'] < self.heartbeat_timeout
+                and now - state['progress_time'] > self.stall_timeout]
+
+    def close(self):
+        """Stop listening for heartbeats."""
+        self.socket.close()
+        try:
+            os.remove(socket_path())
+        except OSError:
+            pass
@@ -53,7 +53,7 @@ class HTMLProcessor(Processor):
             os.remove(item.file_path)
         return result
 
-    def process(self, data, url_object):
+    def process(self, data, url_object, page_no=None):
         """Process HTML data.
 
         Replaces entities and removes tags (except comments) before
@@ -61,14 +61,23 @@ class HTMLProcessor(Processor):
         """
         logging.info("Process HTML %s" % url_object.url)
         try:
-            encoding, data = get_codec_and_string(data)
-            # Remove style tags to avoid false positives from inline styles
-            data = remove_tags_with_content(data, which_ones=('style',))
+            text = self.extract_text(data)
         except UnicodeDecodeError as ude:
             logging.error('UnicodeDecodeError in handle_error_method: {}'.format(ude))
             logging.error('Error happened for file: {}'.format(url_object.url))
             return False
 
+        return self.text_processor.process(text, url_object, page_no)
+
+    def extract_text(self, data):
+        """Return the text of the HTML data for the rules to be executed on.
+
+        Raises UnicodeDecodeError if the data can't be decoded.
+        """
+        encoding, data = get_codec_and_string(data)
+        # Remove style tags to avoid false positives from inline styles
+        data = remove_tags_with_content(data, which_ones=('style',))
+
         # Convert HTML entities to their unicode representation
         entity_replaced_html = replace_entities(data)
 
@@ -78,9 +87,7 @@ class HTMLProcessor(Processor):
 
         # Replace tags with <> character to make sure text processor
         # doesn't match across tag boundaries.
-        replace_tags_text = _html_tag_re.sub('<>', collapsed_html)
-
-        return self.text_processor.process(replace_tags_text, url_object)
+        return _html_tag_re.sub('<>', collapsed_html)
 
 
 Processor.register_processor(HTMLProcessor.item_type, HTMLProcessor)
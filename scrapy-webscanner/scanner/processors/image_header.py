@@ -0,0 +1,144 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+"""Reading the type and dimensions of images from their headers."""
+
+import struct
+
+# JPEG start of frame markers, which are followed by the dimensions
+_jpeg_sof_markers = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+# TIFF tags of the image width and height
+_tiff_image_width = 256
+_tiff_image_length = 257
+
+# The sizes of the known BMP info headers, which tell them from text files
+# starting with "BM"
+_bmp_header_sizes = (12, 40, 52, 56, 64, 108, 124)
+
+
+def _png_header(f, head):
+    # The IHDR chunk always comes first
+    if head[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', head[16:24])
+
+
+def _gif_header(f, head):
+    return struct.unpack('<HH', head[6:10])
+
+
+def _bmp_header(f, head):
+    header_size, = struct.unpack('<I', head[14:18])
+    if header_size not in _bmp_header_sizes:
+        return None
+    if header_size == 12:
+        # OS/2 1.x bitmap
+        return struct.unpack('<HH', head[18:22])
+    width, height = struct.unpack('<ii', head[18:26])
+    # The height is negative for top-down bitmaps
+    return width, abs(height)
+
+
+def _jpeg_header(f, head):
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        # Skip padding before the marker
+        while byte == b'\xff':
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = ord(byte)
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            # Markers without a segment
+            continue
+        data = f.read(2)
+        if len(data) < 2:
+            return None
+        length, = struct.unpack('>H', data)
+        if marker in _jpeg_sof_markers:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack('>HH', data[1:5])
+            return width, height
+        f.seek(length - 2, 1)
+
+
+def _tiff_header(f, head):
+    endian = '<' if head[:2] == b'II' else '>'
+    ifd_offset, = struct.unpack(endian + 'I', head[4:8])
+    f.seek(ifd_offset)
+    data = f.read(2)
+    if len(data) < 2:
+        return None
+    entry_count, = struct.unpack(endian + 'H', data)
+    width = height = None
+    for i in range(entry_count):
+        entry = f.read(12)
+        if len(entry) < 12:
+            break
+        tag, field_type = struct.unpack(endian + 'HH', entry[:4])
+        if field_type == 3:
+            # SHORT
+            value, = struct.unpack(endian + 'H', entry[8:10])
+        elif field_type == 4:
+            # LONG
+            value, = struct.unpack(endian + 'I', entry[8:12])
+        else:
+            continue
+        if tag == _tiff_image_width:
+            width = value
+        elif tag == _tiff_image_length:
+            height = value
+    if width is None or height is None:
+        return None
+    return width, height
+
+
+# (signature, MIME type, header reader) for each of the supported formats
+_formats = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png', _png_header),
+    (b'GIF87a', 'image/gif', _gif_header),
+    (b'GIF89a', 'image/gif', _gif_header),
+    (b'\xff\xd8', 'image/jpeg', _jpeg_header),
+    (b'II*\x00', 'image/tiff', _tiff_header),
+    (b'MM\x00*', 'image/tiff', _tiff_header),
+    (b'BM', 'image/bmp', _bmp_header),
+)
+
+
+def read_image_header(file_path):
+    """Return the MIME type, width and height of an image file.
+
+    Supports PNG, GIF, JPEG, TIFF and BMP images, reading only as much of
+    the file as needed to find the dimensions. Returns None if the file is
+    not an image of one of these types or its header is broken.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            head = f.read(32)
+            for signature, mime_type, reader in _formats:
+                if head.startswith(signature):
+                    if len(head) < 26:
+                        return None
+                    dimensions = reader(f, head)
+                    if dimensions is None:
+                        return None
+                    return (mime_type,) + tuple(dimensions)
+    except (IOError, struct.error):
+        pass
+    return None
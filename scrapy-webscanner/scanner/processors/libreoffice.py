@@ -17,9 +17,11 @@
 import mimetypes
 
 from .processor import Processor
+from .office_server import OfficeServer
 import os
 import os.path
-import subprocess
+import sys
+import signal
 import random
 import hashlib
 from django.conf import settings
@@ -37,6 +39,8 @@ class LibreOfficeProcessor(Processor):
 
     Allows setting of the "home" directory for the libreoffice program,
     so that multiple libreoffice conversions can be run simultaneously.
+    Conversions are done by a long-lived LibreOffice instance per home
+    directory, see OfficeServer.
     """
 
     item_type = "libreoffice"
@@ -45,11 +49,14 @@ class LibreOfficeProcessor(Processor):
         """Initialize the processor, setting an empty home directory."""
         super(Processor, self).__init__()
         self.home_dir = None
+        self.office_server = None
 
     def setup_home_dir(self):
         """Make a random unique home directory for LibreOffice."""
         while True:
-            self.instance_name = hashlib.md5(str(random.random())).hexdigest()
+            self.instance_name = hashlib.md5(
+                str(random.random()).encode('utf-8')
+            ).hexdigest()
             home_dir = os.path.join(home_root_dir, self.instance_name)
 
             if not os.path.exists(home_dir):
@@ -63,6 +70,9 @@ class LibreOfficeProcessor(Processor):
         self.env['HOME'] = self.home_dir
         if not os.path.exists(self.home_dir):
             os.makedirs(self.home_dir)
+        if self.office_server is not None:
+            self.office_server.stop()
+        self.office_server = OfficeServer(self.home_dir, self.env)
 
     def setup_queue_processing(self, pid, *args):
         """Setup the home directory as the first argument."""
@@ -70,6 +80,14 @@ class LibreOfficeProcessor(Processor):
             pid, *args
         )
         self.set_home_dir(os.path.join(home_root_dir, args[0]))
+        # Stop the office in teardown_queue_processing when the queue
+        # processor is stopped
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    def teardown_queue_processing(self):
+        """Stop the LibreOffice instance of the processor, if any."""
+        if self.office_server is not None:
+            self.office_server.stop()
 
     def handle_spider_item(self, data, url_object):
         """Add the item to the queue."""
@@ -82,7 +100,7 @@ class LibreOfficeProcessor(Processor):
     def convert(self, item, tmp_dir):
         """Convert the item."""
         if self.home_dir is None:
-            self.setup_homedir()
+            self.setup_home_dir()
 
         # TODO: Use the mime-type detected by the scanner
         mime_type, encoding = mimetypes.guess_type(item.file_path)
@@ -95,7 +113,7 @@ class LibreOfficeProcessor(Processor):
             output_filter = "csv"
         else:
             # Default to converting to HTML
-            output_filter = "htm:HTML"
+            output_filter = "html"
 
         if output_filter == "csv":
             # TODO: Input type to filter mapping?
@@ -104,20 +122,19 @@ class LibreOfficeProcessor(Processor):
                 os.path.basename(item.file_path).split(".")[0] + ".csv"
             )
 
-            return_code = subprocess.call([
-                project_dir + "/scrapy-webscanner/unoconv", "-f", output_filter, "-e",
-                'FilterOptions="59,34,0,1"', "-o", output_file,
-                item.file_path
-            ], env=self.env)
+            return self.office_server.convert([
+                "-f", output_filter, "-e", 'FilterOptions="59,34,0,1"',
+                "-o", output_file, item.file_path
+            ])
         else:
             # HTML
-            return_code = subprocess.call([
-                "libreoffice", "--headless",
-                "--convert-to", output_filter,
-                item.file_path, "--outdir", tmp_dir
-            ], env=self.env)
-
-        return return_code == 0
+            output_file = os.path.join(
+                tmp_dir,
+                os.path.basename(item.file_path).split(".")[0] + ".html"
+            )
+            return self.office_server.convert([
+                "-f", output_filter, "-o", output_file, item.file_path
+            ])
 
 
 Processor.register_processor(LibreOfficeProcessor.item_type,
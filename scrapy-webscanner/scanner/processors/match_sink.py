@@ -0,0 +1,104 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+"""Buffered storage of matches."""
+
+import threading
+import contextlib
+
+from os2webscanner.models.match_model import Match
+
+# Matches whose storing is deferred, per thread
+_deferred = threading.local()
+
+
+class MatchSink(object):
+
+    """Collects the matches found in a document and stores them in bulk.
+
+    Matches are buffered and written with a single INSERT when the buffer
+    reaches batch_size matches, and when the sink is flushed or closed. Use
+    it as a context manager to flush it at the end of the document:
+
+        with MatchSink(url_object) as sink:
+            for match in scanner.execute_rules(text):
+                sink.add(match)
+
+    The matches of many documents can be stored together by adding them in
+    a deferred block, see deferred.
+    """
+
+    batch_size = 500
+
+    def __init__(self, url_object, page_no=None):
+        """Initialize the sink for matches in the given URL."""
+        self.url_object = url_object
+        self.page_no = page_no
+        self.matches = []
+
+    def add(self, match):
+        """Add the MatchItem to the sink.
+
+        Sets the URL, the scan and, if given, the page number of the match.
+        """
+        match['url'] = self.url_object
+        match['scan'] = self.url_object.scan
+        if self.page_no:
+            match['page_no'] = self.page_no
+        self.matches.append(match.instance)
+        if len(self.matches) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Store the buffered matches in the database.
+
+        In a deferred block, the matches are stored at the end of the block.
+        """
+        if self.matches:
+            deferred = getattr(_deferred, 'matches', None)
+            if deferred is not None:
+                deferred.extend(self.matches)
+            else:
+                Match.objects.bulk_create(self.matches)
+            self.matches = []
+
+    @classmethod
+    @contextlib.contextmanager
+    def deferred(cls):
+        """Defer storing the matches of the sinks flushed in the block.
+
+        All the matches flushed by the current thread in the block are
+        stored together at the end of it, in INSERTs of batch_size matches.
+        """
+        if getattr(_deferred, 'matches', None) is not None:
+            # Already deferred by an enclosing block
+            yield
+            return
+        _deferred.matches = []
+        try:
+            yield
+        finally:
+            matches = _deferred.matches
+            _deferred.matches = None
+            if matches:
+                Match.objects.bulk_create(matches, batch_size=cls.batch_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Matches found before an error are stored anyway, as they would
+        # have been when they were saved one at a time.
+        self.flush()
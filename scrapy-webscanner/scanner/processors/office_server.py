@@ -0,0 +1,202 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+"""A long-lived headless LibreOffice instance to convert documents with."""
+
+import os
+import time
+import socket
+import signal
+import subprocess
+
+from django.conf import settings
+
+from .utils import datetime_print
+
+unoconv = os.path.join(settings.PROJECT_DIR, "scrapy-webscanner", "unoconv")
+
+
+def _free_port():
+    """Return a local TCP port which is not in use."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+class OfficeServer(object):
+
+    """A headless LibreOffice instance listening on a local socket.
+
+    Starting LibreOffice takes several seconds, so instead of starting it
+    for each document, one instance is kept running per home directory and
+    documents are converted by unoconv clients connecting to it over UNO.
+
+    Before each conversion the server is health checked, i.e. the office
+    process must be running and accepting connections, and it is restarted
+    if it isn't. It is also restarted if a conversion times out, since the
+    office is then most likely hung, and after max_conversions conversions
+    to keep its memory usage down.
+
+    The process id of the office is written to a file in the home
+    directory, so an office left behind by a killed queue processor is
+    stopped when the next one using the same home directory starts its
+    own.
+    """
+
+    # Seconds to wait for the office to accept connections after starting
+    start_timeout = 60
+    # Seconds a single conversion may take before the office is restarted
+    conversion_timeout = 300
+    # Number of conversions after which the office is restarted
+    max_conversions = 500
+
+    def __init__(self, home_dir, env):
+        """Initialize the server for the given home dir and environment."""
+        self.home_dir = home_dir
+        self.env = env
+        self.pid_file = os.path.join(home_dir, "office.pid")
+        self.process = None
+        self.port = None
+        self.conversions = 0
+
+    @property
+    def connection(self):
+        """The UNO connection string of the office."""
+        return "socket,host=127.0.0.1,port=%d;urp;StarOffice.ComponentContext" % (
+            self.port
+        )
+
+    def start(self):
+        """Start the office and wait until it accepts connections.
+
+        Returns True if the office was started.
+        """
+        self.stop_stale()
+        self.port = _free_port()
+        # The office runs in its own process group, so the processes it
+        # starts can be stopped along with it.
+        try:
+            self.process = subprocess.Popen([
+                "libreoffice", "--headless", "--invisible", "--nocrashreport",
+                "--nodefault", "--nofirststartwizard", "--nologo",
+                "--norestore", "--accept=%s" % self.connection
+            ], env=self.env, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL, start_new_session=True)
+        except OSError as e:
+            datetime_print("Could not start LibreOffice: %s" % e)
+            return False
+        with open(self.pid_file, "w") as f:
+            f.write(str(self.process.pid))
+        self.conversions = 0
+
+        deadline = time.time() + self.start_timeout
+        while time.time() < deadline:
+            if self.is_healthy():
+                datetime_print("Started LibreOffice, pid %s, port %s" % (
+                    self.process.pid, self.port
+                ))
+                return True
+            if self.process.poll() is not None:
+                break
+            time.sleep(0.5)
+        datetime_print("LibreOffice did not start in %s" % self.home_dir)
+        self.stop()
+        return False
+
+    def stop(self):
+        """Stop the office and the processes it started."""
+        if self.process is not None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self.process.wait()
+            self.process = None
+        if os.path.exists(self.pid_file):
+            os.remove(self.pid_file)
+
+    def stop_stale(self):
+        """Stop an office left behind in the home directory, if any."""
+        try:
+            with open(self.pid_file) as f:
+                pid = int(f.read())
+        except (IOError, ValueError):
+            return
+        try:
+            with open("/proc/%d/cmdline" % pid, "rb") as f:
+                is_office = b"office" in f.read()
+        except IOError:
+            is_office = False
+        if is_office:
+            datetime_print("Stopping stale LibreOffice, pid %s" % pid)
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        os.remove(self.pid_file)
+
+    def restart(self):
+        """Stop the office and start a new one."""
+        self.stop()
+        return self.start()
+
+    def is_healthy(self):
+        """Return whether the office is running and accepts connections."""
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            socket.create_connection(('127.0.0.1', self.port), 1).close()
+        except socket.error:
+            return False
+        return True
+
+    def ensure_running(self):
+        """Start or restart the office if it is not healthy.
+
+        Returns True if the office is running.
+        """
+        if self.conversions >= self.max_conversions:
+            return self.restart()
+        if not self.is_healthy():
+            if self.process is not None:
+                datetime_print("LibreOffice is not responding, restarting")
+            return self.restart()
+        return True
+
+    def convert(self, args):
+        """Run unoconv with the given arguments against the office.
+
+        Returns True if the conversion succeeded.
+        """
+        if not self.ensure_running():
+            return False
+        self.conversions += 1
+        try:
+            return_code = subprocess.call(
+                [unoconv, "--no-launch", "--connection", self.connection] +
+                args, env=self.env, timeout=self.conversion_timeout
+            )
+        except subprocess.TimeoutExpired:
+            datetime_print("Conversion timed out, restarting LibreOffice")
+            self.restart()
+            return False
+        if return_code != 0 and not self.is_healthy():
+            # The office died during the conversion; restart it for the
+            # next one.
+            self.restart()
+        return return_code == 0
@@ -15,19 +15,50 @@
 # source municipalities ( http://www.os2web.dk/ )
 """PDF Processors."""
 
+import io
 import shutil
 import os
 import regex
 
+from django.conf import settings
+
 from .processor import Processor
+from .text import TextProcessor
 from subprocess import Popen, PIPE, DEVNULL, call, TimeoutExpired
 
 
+def read_pages(f):
+    """Yield the text of each page in the output of pdftotext.
+
+    pdftotext ends each page with a form feed character.
+    """
+    page = []
+    for line in f:
+        parts = line.split('\f')
+        for part in parts[:-1]:
+            page.append(part)
+            yield ''.join(page)
+            page = []
+        page.append(parts[-1])
+    if ''.join(page).strip():
+        yield ''.join(page)
+
+
 class PDFProcessor(Processor):
 
-    """Processor for PDF documents using pdftohtml."""
+    """Processor for PDF documents using pdftotext or pdftohtml.
+
+    By default, the text of each page is extracted with pdftotext and
+    scanned directly, so matches get the number of the page they were found
+    on. If the PDF_DIRECT_TEXT_EXTRACTION setting is False, the PDF is
+    converted to HTML with pdftohtml instead, which is then queued for the
+    HTML processor.
+
+    Images are only extracted for OCR if the scan does OCR.
+    """
 
     item_type = "pdf"
+    text_processor = TextProcessor()
 
     def handle_spider_item(self, data, url_object):
         """Add the item to the queue."""
@@ -38,12 +69,46 @@ class PDFProcessor(Processor):
         return super().convert_queue_item(item)
 
     def convert(self, item, tmp_dir):
-        """Convert the item using pdftohtml."""
+        """Convert the item."""
         # Move file to temp dir before conversion
         new_file_path = os.path.join(tmp_dir, os.path.basename(item.file_path))
         if item.file_path != new_file_path:
             shutil.move(item.file_path, tmp_dir)
 
+        if getattr(settings, 'PDF_DIRECT_TEXT_EXTRACTION', True):
+            return self.extract_text(item, new_file_path, tmp_dir)
+        return self.convert_to_html(item, new_file_path)
+
+    def extract_text(self, item, file_path, tmp_dir):
+        """Scan the text of each page and extract images for OCR.
+
+        The text is read from pdftotext as it is extracted, a page at a
+        time. If the scan does OCR, the images are extracted to the temp
+        dir, named with their page numbers, to be queued for OCR.
+        """
+        p = Popen(["pdftotext", "-enc", "UTF-8", file_path, "-"],
+                  stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL)
+        with io.TextIOWrapper(p.stdout, encoding='utf-8',
+                              errors='replace') as f:
+            for page_no, text in enumerate(read_pages(f), 1):
+                if text.strip():
+                    self.text_processor.process(text, item.url, page_no)
+        if p.wait() != 0:
+            print('pdftotext conversion error: return code %s' % p.returncode)
+            return False
+
+        return_code = 0
+        if item.url.scan.do_ocr:
+            return_code = call([
+                "pdfimages", "-png", "-p", file_path,
+                os.path.join(tmp_dir, "image")
+            ], stdin=DEVNULL)
+
+        os.remove(file_path)
+        return return_code == 0
+
+    def convert_to_html(self, item, new_file_path):
+        """Convert the item to HTML using pdftohtml."""
         extra_options = []
         if not item.url.scan.do_ocr:
             # Ignore images in PDFs if no OCR scanning will be done
@@ -0,0 +1,287 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+"""Forking queue processors from a preloaded parent process."""
+
+import os
+import sys
+import time
+import select
+import signal
+import traceback
+
+from django import db
+
+from .processor import get_memory_usage
+from .utils import datetime_print
+
+
+class Zygote(object):
+
+    """Runs workers processing the queue in children forked from this process.
+
+    The parent process has Django set up and the processors and rules
+    imported, so a worker forked from it starts processing right away and
+    shares the parent's memory copy-on-write. There is one zygote per
+    processor type, which keeps the given number of workers running. When
+    a worker exits, i.e. when the processor decides it should be recycled,
+    a new one is forked. The zygote also retires workers which use more
+    than the processor's max_memory or have run for longer than its
+    max_lifetime.
+
+    Each worker processes queue items under its own process id, so the
+    process manager finds the worker of a stuck item by its pid. When a
+    worker has exited, the items it was processing are failed with the
+    processor's teardown_worker. String setup arguments are formatted with
+    the number of the worker, the lowest number not used by another worker,
+    e.g. 'libreoffice{worker}' gives each worker its own home directory.
+
+    The number of workers is read from lines written to the control file
+    descriptor, if any. Surplus workers are retired, i.e. exit once they
+    have processed their current items, youngest first.
+
+    SIGUSR1 retires the zygote: all workers are retired, and the zygote
+    exits after them. SIGTERM and SIGINT stop the workers and the zygote.
+    """
+
+    # Seconds a worker must live before another is forked right away
+    min_lifetime = 5
+    # Seconds stopped workers have to exit before they are killed
+    stop_timeout = 20
+    # Seconds between checks of the workers
+    check_interval = 1
+
+    def __init__(self, processor, setup_args, workers=1, control=None):
+        """Initialize the zygote for the processor and its setup arguments.
+
+        Runs the given number of workers, until told otherwise on the
+        control file descriptor.
+        """
+        self.processor = processor
+        self.setup_args = setup_args
+        self.workers = workers
+        self.control = control
+        self.control_buffer = b''
+        self.pid = os.getpid()
+        # Maps the pid of each worker to its number, start time and whether
+        # it is retiring
+        self.children = {}
+        # Don't fork workers before this time
+        self.fork_after = 0
+        self.retiring = False
+
+    def run(self):
+        """Fork workers processing the queue until stopped or retired."""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGUSR1, self.retire)
+        while True:
+            self.reap()
+            if self.retiring:
+                if not self.children:
+                    break
+            else:
+                self.recycle()
+                self.scale()
+            self.wait()
+        datetime_print("Retired")
+
+    def wait(self):
+        """Wait for check_interval seconds, reading the number of workers
+        from the control file descriptor if anything is written to it."""
+        if self.control is None:
+            time.sleep(self.check_interval)
+            return
+        readable = select.select([self.control], [], [],
+                                 self.check_interval)[0]
+        if not readable:
+            return
+        data = os.read(self.control, 4096)
+        if not data:
+            # Closed, so keep the current number of workers
+            self.control = None
+            return
+        lines = (self.control_buffer + data).split(b'\n')
+        self.control_buffer = lines.pop()
+        for line in lines:
+            try:
+                self.workers = int(line)
+            except ValueError:
+                datetime_print("Invalid number of workers: %r" % line)
+
+    def reap(self):
+        """Forget the workers which have exited and fail their items."""
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            child = self.children.pop(pid, None)
+            if child is None:
+                continue
+
+            if os.WIFSIGNALED(status):
+                datetime_print("Worker %d killed by signal %d" % (
+                    pid, os.WTERMSIG(status)
+                ))
+            elif os.WEXITSTATUS(status) != 0:
+                datetime_print("Worker %d exited with status %d" % (
+                    pid, os.WEXITSTATUS(status)
+                ))
+            elif child['retiring']:
+                datetime_print("Worker %d has retired" % pid)
+            else:
+                datetime_print("Worker %d has been recycled" % pid)
+            lifetime = time.time() - child['started']
+            if lifetime < self.min_lifetime:
+                # Don't fork in a tight loop if the workers die right away
+                self.fork_after = max(
+                    self.fork_after,
+                    time.time() + self.min_lifetime - lifetime
+                )
+            try:
+                self.processor.teardown_worker(pid)
+            except Exception:
+                traceback.print_exc()
+
+    def recycle(self):
+        """Retire the workers which use too much memory or are too old."""
+        now = time.time()
+        for pid, child in self.children.items():
+            if child['retiring']:
+                continue
+            memory = get_memory_usage(pid)
+            if (now - child['started'] > self.processor.max_lifetime
+                    or (memory is not None
+                        and memory > self.processor.max_memory)):
+                datetime_print("Recycling worker %d" % pid)
+                self.retire_child(pid)
+
+    def scale(self):
+        """Fork or retire workers to run the wanted number of them."""
+        active = sorted((pid for pid, child in self.children.items()
+                         if not child['retiring']),
+                        key=lambda pid: self.children[pid]['started'])
+        surplus = len(active) - self.workers
+        if surplus > 0:
+            for pid in active[-surplus:]:
+                datetime_print("Retiring worker %d" % pid)
+                self.retire_child(pid)
+        elif surplus < 0 and time.time() >= self.fork_after:
+            for i in range(-surplus):
+                self.fork()
+
+    def fork(self):
+        """Fork a worker, numbered with the lowest free number."""
+        numbers = set(child['worker'] for child in self.children.values())
+        worker = 0
+        while worker in numbers:
+            worker += 1
+        # The workers must not share the parent's database connection
+        db.connections.close_all()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.run_child(worker)
+        self.children[pid] = {
+            'worker': worker,
+            'started': time.time(),
+            'retiring': False,
+        }
+        if self.retiring:
+            # Retired while forking
+            self.retire_child(pid)
+
+    def run_child(self, worker):
+        """Run the queue processor in the worker with the given number.
+
+        Never returns.
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        # SIGUSR1 is still handled by retire
+        self.processor.retiring = self.retiring
+        status = 1
+        try:
+            setup_args = [arg.format(worker=worker) if isinstance(arg, str)
+                          else arg for arg in self.setup_args]
+            self.processor.setup_queue_processing(os.getpid(), *setup_args)
+            self.processor.process_queue()
+            status = 0
+        except KeyboardInterrupt:
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                self.processor.teardown_queue_processing()
+            except BaseException:
+                traceback.print_exc()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # Skip the parent's exit handlers and buffers
+            os._exit(status)
+
+    def retire(self, signum=None, frame=None):
+        """Let the workers finish their current items, then exit."""
+        if os.getpid() != self.pid:
+            # In a worker
+            self.processor.retiring = True
+            return
+        self.retiring = True
+        for pid in list(self.children):
+            self.retire_child(pid)
+
+    def retire_child(self, pid):
+        """Let the worker finish its current items, then exit."""
+        self.children[pid]['retiring'] = True
+        try:
+            os.kill(pid, signal.SIGUSR1)
+        except OSError:
+            pass
+
+    def stop(self, signum=None, frame=None):
+        """Stop the workers and exit.
+
+        The items the workers were processing are left to the process
+        manager, which fails them once the zygote has exited.
+        """
+        if os.getpid() != self.pid:
+            # Forked, but the worker hasn't installed its own handlers yet
+            os._exit(0)
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        deadline = time.time() + self.stop_timeout
+        while self.children:
+            for pid in list(self.children):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                        if time.time() < deadline:
+                            continue
+                        os.kill(pid, signal.SIGKILL)
+                        os.waitpid(pid, 0)
+                except OSError:
+                    pass
+                del self.children[pid]
+            time.sleep(0.1)
+        sys.exit(0)
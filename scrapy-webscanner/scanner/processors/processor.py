@@ -16,26 +16,30 @@
 """Processors."""
 
 
-import time
-import datetime
 import os
+import time
+import resource
 import mimetypes
 import sys
 import magic
+import regex
 import codecs
-import random
 import subprocess
 import hashlib
 import logging
 import traceback
 
-from django.db import transaction, IntegrityError, DatabaseError
 from django import db
-from django.utils import timezone
 from django.conf import settings
 
 from os2webscanner.models.conversionqueueitem_model import ConversionQueueItem
-from os2webscanner.models.md5sum_model import Md5Sum
+
+from .queue_backend import QueueBackend
+from .dedup import DedupService
+from .image_header import read_image_header
+from .spool import Spool
+from .heartbeat import Heartbeat
+from .utils import datetime_print
 
 
 # Minimum width and height an image must have to be scanned
@@ -45,6 +49,9 @@ MIN_OCR_DIMENSION_BOTH = 7
 # scanned
 MIN_OCR_DIMENSION_EITHER = 64
 
+# The page number in the name of an image extracted from a PDF
+_ocr_page_no_regex = regex.compile(r"-(\d+)[_-]\d+\.\w+$")
+
 
 def get_md5_sum(data):
     """Helper function to calculate md5 sum."""
@@ -54,25 +61,38 @@ def get_md5_sum(data):
     return md5
 
 
+def get_file_md5_sum(file_path, chunk_size=64 * 1024):
+    """Calculate the md5 sum of a file, reading it in chunks."""
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
 def get_ocr_page_no(ocr_file_name):
     "Get page number from image file to be OCR'ed."
 
-    # xyz*-d+_d+.png
-    # HACK ALERT: This depends on the output from pdftohtml.
-    try:
-        page_no = int(ocr_file_name.split('_')[-2].split('-')[-1])
-    except IndexError:
+    # xyz*-d+_d+.png from pdftohtml or xyz*-d+-d+.png from pdfimages -p
+    # HACK ALERT: This depends on the output from pdftohtml and pdfimages.
+    m = _ocr_page_no_regex.search(ocr_file_name)
+    if m is None:
         # Non-PDF-extracted file
-        page_no = None
-    return page_no
+        return None
+    return int(m.group(1))
 
 
 def get_image_dimensions(file_path):
     """Return an image's dimensions as a tuple containing width and height.
 
-    Uses the "identify" command from ImageMagick to retrieve the information.
-    If there is a problem getting the information, returns None.
+    Reads the dimensions from the image header, or uses the "identify"
+    command from ImageMagick for images of other types than PNG, GIF, JPEG,
+    TIFF and BMP. If there is a problem getting the information, returns
+    None.
     """
+    header = read_image_header(file_path)
+    if header is not None:
+        return header[1:]
     try:
         dimensions = subprocess.check_output(["identify", "-format", "%wx%h",
                                               file_path])
@@ -84,8 +104,20 @@ def get_image_dimensions(file_path):
                  )
 
 
-def datetime_print(line_to_print):
-    print('{0} : {1}'.format(datetime.datetime.now(), line_to_print))
+def get_memory_usage(pid=None):
+    """Return the resident memory of the process in bytes.
+
+    Defaults to the current process. Returns None if the memory of another
+    process can't be determined, e.g. because it has exited.
+    """
+    try:
+        with open('/proc/%s/statm' % (pid or 'self')) as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        if pid is not None:
+            return None
+        # The peak instead, which is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
 
 
 class Processor(object):
@@ -103,8 +135,16 @@ class Processor(object):
     processors_by_type = {}
     processor_instances = {}
 
-    documents_to_process = 10
+    # A queue processor exits to be replaced by a fresh one when it uses
+    # more than max_memory bytes or has run for more than max_lifetime
+    # seconds, so leaked memory is given back. Its zygote also retires the
+    # queue processors it forked when they pass these limits.
+    max_memory = 512 * 1024 * 1024
+    max_lifetime = 60 * 60
     pid = None
+    # Set when the queue processor should exit after its current items,
+    # without being replaced
+    retiring = False
 
     @classmethod
     def processor_by_type(cls, processor_type):
@@ -130,43 +170,28 @@ class Processor(object):
         """
         return settings.VAR_DIR
 
-    def is_md5_known(self, data, scan):
-        """Decide if we know a given file by calculating its MD5."""
+    @property
+    def batch_size(self):
+        """The number of queue items to claim at a time.
 
-        if settings.DO_USE_MD5:
-            md5 = get_md5_sum(data)
-            exists = Md5Sum.objects.filter(
-                organization=scan.scanner.organization,
-                md5=md5,
-                is_cpr_scan=scan.do_cpr_scan,
-                is_check_mod11=scan.do_cpr_modulus11,
-                is_ignore_irrelevant=scan.do_cpr_ignore_irrelevant,
-            ).count() > 0
-        else:
-            exists = False
+        Configured per processor type with the CONVERSION_QUEUE_BATCH_SIZES
+        setting. Defaults to one item at a time.
+        """
+        batch_sizes = getattr(settings, 'CONVERSION_QUEUE_BATCH_SIZES', {})
+        return batch_sizes.get(self.item_type, 1)
 
-        return exists
+    @property
+    def queue_backend(self):
+        """Return the backend for the conversion queue."""
+        return QueueBackend.get_backend()
 
-    def store_md5(self, data, scan):
+    def is_md5_known(self, md5, scan):
+        """Decide if we already know a file by its MD5 sum."""
+        return DedupService.is_known(md5, scan)
 
-        """
-        Store MD5 sum for these scan parameters & data.
-        """
-        if settings.DO_USE_MD5:
-            md5str = get_md5_sum(data)
-
-            md5 = Md5Sum(
-                organization=scan.scanner.organization,
-                md5=md5str,
-                is_cpr_scan=scan.do_cpr_scan,
-                is_check_mod11=scan.do_cpr_modulus11,
-                is_ignore_irrelevant=scan.do_cpr_ignore_irrelevant,
-            )
-            try:
-                md5.save()
-            except IntegrityError:
-                # This happens, we now know - but is not actually an error.
-                pass
+    def store_md5(self, md5, scan):
+        """Store the MD5 sum of a file scanned with the scan's rules."""
+        DedupService.store(md5, scan)
 
     def handle_spider_item(self, data, url_object):
         """Process an item from a spider. Must be overridden.
@@ -189,17 +214,19 @@ class Processor(object):
         """Add an item to the conversion queue.
 
         The data will be saved to a temporary file and added to the
-        conversion queue for later processing.
+        conversion queue for later processing. Small files are saved in the
+        RAM-backed spool, see Spool.
         """
         # Write data to a temporary file
         # Get temporary directory
         if not isinstance(data, bytes):
             data = data.encode('utf-8')
 
-        if self.is_md5_known(data, url_object.scan):
+        md5 = get_md5_sum(data)
+        if self.is_md5_known(md5, url_object.scan):
             return True
 
-        tmp_dir = url_object.tmp_dir
+        tmp_dir = Spool.tmp_dir(url_object, len(data))
         if not os.path.exists(tmp_dir):
             os.makedirs(tmp_dir)
         file_name = os.path.basename(url_object.url)
@@ -220,8 +247,10 @@ class Processor(object):
             type=self.mimetype_to_processor_type(url_object.mime_type),
             url=url_object,
             status=ConversionQueueItem.NEW,
+            md5=md5,
         )
         new_item.save()
+        self.queue_backend.notify(new_item.type)
         return True
 
     def process_file(self, file_path, url, page_no=None):
@@ -235,6 +264,15 @@ class Processor(object):
                 if encoding == 'unknown-8bit':
                     encoding = 'iso-8859-1'
 
+                if os.path.getsize(file_path) > settings.STREAMING_SCAN_SIZE:
+                    # Scan large files in pieces instead of reading them
+                    # into memory. Undecodable bytes are replaced, as we
+                    # can't start over with another encoding halfway.
+                    with open(file_path, "r", encoding=encoding,
+                              errors='replace', newline='') as f:
+                        self.process_stream(f.read, url, page_no)
+                    return True
+
                 f = codecs.open(file_path, "r", encoding=encoding)
             else:
                 f = open(file_path, "rb")
@@ -257,7 +295,7 @@ class Processor(object):
 
             if type(data) is not str:
                 data = data.decode('utf-8')
-            self.process(data, url)
+            self.process(data, url, page_no)
         except Exception as e:
             url.scan.log_occurrence(
                 "process_file failed for url {0}: {1}".format(url.url, str(e))
@@ -271,34 +309,85 @@ class Processor(object):
         # TODO: Increment process file count.
         return True
 
+    def process_stream(self, read, url_object, page_no=None):
+        """Process text read in pieces with the read function.
+
+        By default, reads the whole text and calls self.process. Processors
+        which can scan text in pieces override this.
+        """
+        return self.process(read(), url_object, page_no)
+
     def setup_queue_processing(self, pid, *args):
         """Setup the queue processor with additional arguments."""
         self.pid = pid
 
+    def teardown_queue_processing(self):
+        """Clean up after processing the queue, before the process exits."""
+        pass
+
+    def teardown_worker(self, pid):
+        """Fail the items of the queue processor with the given pid.
+
+        Called by the zygote when a queue processor it forked has exited, so
+        the items it was processing, if it died, aren't left claimed.
+        """
+        items = list(ConversionQueueItem.objects.filter(
+            status=ConversionQueueItem.PROCESSING,
+            process_id=pid
+        ))
+        for item in items:
+            item.url.scan.log_occurrence(
+                "QUEUE STOPPING: type <{0}>, URL: {1}".format(
+                    item.type,
+                    item.url.url
+                )
+            )
+        self.queue_backend.fail_batch(items)
+
+    def needs_recycling(self, started):
+        """Return whether the queue processor, started at the given time,
+        should exit to be replaced by a fresh one, or retire."""
+        return (self.retiring
+                or time.time() - started > self.max_lifetime
+                or get_memory_usage() > self.max_memory)
+
     def process_queue(self):
-        """Process items in the queue in an infinite loop.
+        """Process items in the queue until the processor needs recycling.
 
-        If there are no items to process, waits 1 second before trying
-        to get the next queue item.
+        Claims up to batch_size items at a time and marks them as done or
+        failed together after processing them. If there are no items to
+        process, waits for new items before trying again.
         """
         datetime_print("Starting processing queue items of type %s, pid %s" % (
             self.item_type, self.pid
         ))
         sys.stdout.flush()
+        started = time.time()
         executions = 0
+        heartbeat = Heartbeat(self.pid, self.item_type)
+        heartbeat.start()
 
-        while executions < self.documents_to_process:
+        while not self.needs_recycling(started):
             # Prevent memory leak in standalone scripts
             if settings.DEBUG:
                 db.reset_queries()
-            item = self.get_next_queue_item()
-            if item is None:
-                time.sleep(2)
-            else:
+            items = self.get_next_queue_items(self.batch_size)
+            if not items:
+                # Nothing to do, so drop compiled rules for finished scans.
+                # Imported here to avoid a circular import.
+                from ..scanner.scanner import Scanner
+                Scanner.evict_finished_scans()
+                self.queue_backend.wait(self.item_type, 2)
+                continue
+
+            succeeded = []
+            failed = []
+            for item in items:
+                heartbeat.item = item.pk
                 result = self.handle_queue_item(item)
+                heartbeat.item = None
                 executions = executions + 1
                 if not result:
-                    item.status = ConversionQueueItem.FAILED
                     lm = "CONVERSION ERROR: file <{0}>, type <{1}>, URL: {2}"
                     lm2 = "CONVERSION ERROR: type <{0}>, URL: {1}"
                     tb = traceback.format_exc()
@@ -315,10 +404,9 @@ class Processor(object):
                     if settings.DEBUG:
                         item.url.scan.log_occurrence(tb)
 
-                    item.save()
-                    item.delete_tmp_dir()
+                    failed.append(item)
                 else:
-                    item.delete()
+                    succeeded.append(item)
 
                 try:
                     datetime_print("(%s): %s" % (
@@ -330,59 +418,28 @@ class Processor(object):
 
                 sys.stdout.flush()
 
-    @transaction.atomic
+            self.queue_backend.ack_batch(succeeded)
+            self.queue_backend.fail_batch(failed)
+
+        datetime_print("Recycling queue processor after %d items, %d s and "
+                       "using %d MB of memory" % (
+                           executions, time.time() - started,
+                           get_memory_usage() // (1024 * 1024)
+                       ))
+
     def get_next_queue_item(self):
         """Get the next item in the queue.
 
         Returns None if there is nothing in the queue.
         """
-        result = None
+        return self.queue_backend.claim(self.item_type, self.pid)
 
-        while result is None:
-            try:
-                with transaction.atomic():
-                    new_items_queryset = ConversionQueueItem.objects.filter(
-                        type=self.item_type,
-                        status=ConversionQueueItem.NEW
-                    )
-
-                    if self.item_type != "ocr":
-                        # If this is not an OCR processor, include only scans
-                        # where non-OCR conversions are not paused
-                        new_items_queryset = new_items_queryset.filter(
-                            url__scan__pause_non_ocr_conversions=False
-                        )
+    def get_next_queue_items(self, count):
+        """Get up to count items from the queue.
 
-                    # Get scans with pending items of the wanted type
-                    scans = new_items_queryset.values('url__scan').distinct()
-
-                    # Pick a random scan
-                    random_scan_pk = random.choice(scans)['url__scan']
-
-                    # Get the first unprocessed item of the wanted type and
-                    # from a random scan
-                    result = new_items_queryset.filter(
-                        url__scan=random_scan_pk).select_for_update(
-                        nowait=True)[0]
-
-                    # Change status of the found item
-                    ltime = timezone.localtime(timezone.now())
-                    result.status = ConversionQueueItem.PROCESSING
-                    result.process_id = self.pid
-                    result.process_start_time = ltime
-                    result.save()
-            except (DatabaseError, IntegrityError) as e:
-                # Database transaction failed, we just try again
-                datetime_print('Error message {0}'.format(e))
-                datetime_print('Transaction failed while getting queue item of type {0}'.format(
-                    self.item_type)
-                )
-                result = None
-            except IndexError:
-                # Nothing in the queue, return None
-                result = None
-                break
-        return result
+        Returns an empty list if there is nothing in the queue.
+        """
+        return self.queue_backend.claim_batch(self.item_type, self.pid, count)
 
     def convert_queue_item(self, item):
         """Convert a queue item and add converted files to the queue.
@@ -391,11 +448,12 @@ class Processor(object):
         self.convert to run the actual conversion. After converting,
         adds all files produced in the conversion directory to the queue.
         """
-        with open(item.file_path, "rb") as f:
-            data = f.read()
-            if self.is_md5_known(data, item.url.scan):
-                # Already processed this file, nothing more to do
-                return True
+        # The MD5 sum of files from the spider is calculated when they are
+        # queued; files from conversions are hashed here.
+        md5 = item.md5 or get_file_md5_sum(item.file_path)
+        if self.is_md5_known(md5, item.url.scan):
+            # Already processed this file, nothing more to do
+            return True
 
         tmp_dir = item.tmp_dir
         if not os.path.exists(tmp_dir):
@@ -404,7 +462,7 @@ class Processor(object):
         result = self.convert(item, tmp_dir)
         if result:
             # Conversion successful, store MD5 sum.
-            self.store_md5(data, item.url.scan)
+            self.store_md5(md5, item.url.scan)
 
             if os.path.exists(item.file_path):
                 os.remove(item.file_path)
@@ -425,6 +483,7 @@ class Processor(object):
     def add_processed_files(self, item, tmp_dir):
         """Recursively add all files in the temp dir to the queue."""
         ignored_ocr_count = 0
+        queued_types = set()
         for root, dirnames, filenames in os.walk(tmp_dir):
             for fname in filenames:
                 # TODO: How do we decide which types are supported?
@@ -433,8 +492,14 @@ class Processor(object):
                     mime_type, encoding = mimetypes.guess_type(fname)
                     file_path = os.path.join(root, fname)
                     if mime_type is None:
-                        # Guess the mime type from the file contents
-                        mime_type = self.mime_magic.from_file(file_path)
+                        # Guess the mime type from the file contents,
+                        # looking at the header for the common image types
+                        # first
+                        header = read_image_header(file_path)
+                        if header is not None:
+                            mime_type = header[0]
+                        else:
+                            mime_type = self.mime_magic.from_file(file_path)
                     processor_type = Processor.mimetype_to_processor_type(
                         mime_type)
 
@@ -471,11 +536,14 @@ class Processor(object):
                             new_item.page_no = get_ocr_page_no(fname)
 
                         new_item.save()
+                        queued_types.add(processor_type)
                     else:
                         os.remove(file_path)
 
                 except ValueError:
                     continue
+        for processor_type in queued_types:
+            self.queue_backend.notify(processor_type)
         if ignored_ocr_count > 0:
             datetime_print("Ignored %d extracted images because the dimensions were"
                   "small (width AND height must be >= %d) AND (width OR "
@@ -507,6 +575,12 @@ class Processor(object):
         'text/csv': 'csv',
 
         'application/zip': 'zip',
+        'application/x-zip-compressed': 'zip',
+        'application/x-tar': 'zip',
+        'application/gzip': 'zip',
+        'application/x-gzip': 'zip',
+        'application/x-bzip2': 'zip',
+        'application/x-xz': 'zip',
 
         'application/pdf': 'pdf',
 
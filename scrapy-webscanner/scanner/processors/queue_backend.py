@@ -0,0 +1,310 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+"""Backends for the conversion queue.
+
+A backend hands out (claims) ConversionQueueItems to queue processors and
+records the outcome of processing them. Claiming an item sets its status to
+PROCESSING along with the process id and start time, acknowledging it
+deletes it, and failing it sets its status to FAILED and removes its
+temporary directory.
+"""
+
+import time
+import select
+
+from django.db import connection, transaction, IntegrityError, DatabaseError
+from django.utils import timezone
+from django.conf import settings
+
+from os2webscanner.models.conversionqueueitem_model import ConversionQueueItem
+from os2webscanner.models.url_model import Url
+from os2webscanner.models.scan_model import Scan
+
+from .scheduler import FairScheduler
+from .utils import datetime_print
+
+
+class QueueBackend(object):
+
+    """Represents a backend for the conversion queue.
+
+    Provides a central place to register backends. The backend to use is
+    selected with the CONVERSION_QUEUE_BACKEND setting.
+    """
+
+    backends_by_name = {}
+    backend_instance = None
+
+    # How many times a scan is chosen to claim items from, if the chosen
+    # scan's items have all been claimed by other processors in the meantime
+    claim_attempts = 3
+
+    def __init__(self):
+        """Initialize the backend."""
+        self.scheduler = FairScheduler()
+
+    @classmethod
+    def register_backend(cls, name, backend):
+        """Register the backend class under the given name."""
+        cls.backends_by_name[name] = backend
+
+    @classmethod
+    def get_backend(cls):
+        """Return the configured backend.
+
+        The instance returned is always the same instance.
+        """
+        if cls.backend_instance is None:
+            name = getattr(settings, 'CONVERSION_QUEUE_BACKEND', 'database')
+            cls.backend_instance = cls.backends_by_name[name]()
+        return cls.backend_instance
+
+    def claim(self, item_type, pid):
+        """Claim the next item of the given type.
+
+        Returns None if there is nothing in the queue.
+        """
+        items = self.claim_batch(item_type, pid, 1)
+        return items[0] if items else None
+
+    def claim_batch(self, item_type, pid, batch_size):
+        """Claim up to batch_size items of the given type in one transaction.
+
+        Returns an empty list if there is nothing in the queue.
+        """
+        raise NotImplementedError
+
+    def ack(self, item):
+        """Mark the item as successfully processed."""
+        self.ack_batch([item])
+
+    def ack_batch(self, items):
+        """Mark the items as successfully processed, deleting them."""
+        if items:
+            ConversionQueueItem.objects.filter(
+                pk__in=[item.pk for item in items]
+            ).delete()
+
+    def fail(self, item):
+        """Mark the item as failed."""
+        self.fail_batch([item])
+
+    def fail_batch(self, items):
+        """Mark the items as failed and remove their temp dirs."""
+        if not items:
+            return
+        ConversionQueueItem.objects.filter(
+            pk__in=[item.pk for item in items]
+        ).update(status=ConversionQueueItem.FAILED)
+        for item in items:
+            item.status = ConversionQueueItem.FAILED
+            item.delete_tmp_dir()
+
+    def wait(self, item_type, timeout):
+        """Wait up to timeout seconds for new items of the given type."""
+        time.sleep(timeout)
+
+    def notify(self, item_type):
+        """Notify waiting processors that items of the given type exist."""
+        pass
+
+    def new_items(self, item_type):
+        """Return a queryset of the claimable items of the given type."""
+        new_items_queryset = ConversionQueueItem.objects.filter(
+            type=item_type,
+            status=ConversionQueueItem.NEW
+        )
+
+        if item_type != "ocr":
+            # If this is not an OCR processor, include only scans
+            # where non-OCR conversions are not paused
+            new_items_queryset = new_items_queryset.filter(
+                url__scan__pause_non_ocr_conversions=False
+            )
+        return new_items_queryset
+
+
+class DatabaseQueueBackend(QueueBackend):
+
+    """Queue backend which polls the database using the ORM.
+
+    Picks a scan among the scans with pending items with the FairScheduler
+    and locks the first items from that scan, retrying if the locks can't
+    be acquired. If the chosen scan has no items left, the scheduler
+    chooses again, up to claim_attempts times.
+    """
+
+    @transaction.atomic
+    def claim_batch(self, item_type, pid, batch_size):
+        """Claim up to batch_size items of the given type."""
+        result = None
+        attempts = 0
+
+        while result is None:
+            try:
+                with transaction.atomic():
+                    new_items_queryset = self.new_items(item_type)
+
+                    chosen = self.scheduler.choose_scan(item_type,
+                                                        new_items_queryset)
+                    if chosen is None:
+                        # Nothing in the queue
+                        return []
+                    scan_pk, scan_class = chosen
+
+                    # Get the first unprocessed items of the wanted type and
+                    # from the chosen scan
+                    result = list(new_items_queryset.filter(
+                        url__scan=scan_pk).select_for_update(
+                        nowait=True).order_by('pk')[:batch_size])
+                    if not result:
+                        # Other processors got there first
+                        attempts += 1
+                        if attempts >= self.claim_attempts:
+                            return []
+                        result = None
+                        continue
+
+                    # Change status of the found items
+                    ltime = timezone.localtime(timezone.now())
+                    ConversionQueueItem.objects.filter(
+                        pk__in=[item.pk for item in result]
+                    ).update(status=ConversionQueueItem.PROCESSING,
+                             process_id=pid, process_start_time=ltime)
+                    for item in result:
+                        item.status = ConversionQueueItem.PROCESSING
+                        item.process_id = pid
+                        item.process_start_time = ltime
+            except (DatabaseError, IntegrityError) as e:
+                # Database transaction failed, we just try again
+                datetime_print('Error message {0}'.format(e))
+                datetime_print('Transaction failed while getting queue item of type {0}'.format(
+                    item_type)
+                )
+                result = None
+        self.scheduler.claimed(item_type, scan_class, result)
+        return result
+
+
+class PostgreSQLQueueBackend(QueueBackend):
+
+    """Queue backend using PostgreSQL row locking and notifications.
+
+    Items are claimed with a single UPDATE which skips rows locked by other
+    processors (SELECT ... FOR UPDATE SKIP LOCKED), so processors never
+    wait for or retry on each other. Idle processors LISTEN on a channel per
+    item type and are woken by a NOTIFY when new items are queued, instead
+    of sleeping. Items are claimed from the scan chosen by the
+    FairScheduler, in the order they were queued. If the chosen scan's
+    items have all been claimed by other processors in the meantime, the
+    scheduler chooses again, up to claim_attempts times.
+    """
+
+    channel_prefix = 'os2webscanner_queue_'
+
+    def __init__(self):
+        """Initialize the backend."""
+        super().__init__()
+        self.listening = set()
+        self.listening_connection = None
+
+    def claim_batch(self, item_type, pid, batch_size):
+        """Claim up to batch_size items of the given type."""
+        for attempt in range(self.claim_attempts):
+            chosen = self.scheduler.choose_scan(item_type,
+                                                self.new_items(item_type))
+            if chosen is None:
+                return []
+            scan_pk, scan_class = chosen
+            items = self.claim_from_scan(item_type, pid, batch_size, scan_pk)
+            if items:
+                self.scheduler.claimed(item_type, scan_class, items)
+                return items
+            # Other processors got there first
+        return []
+
+    def claim_from_scan(self, item_type, pid, batch_size, scan_pk):
+        """Claim up to batch_size items of the given type from the scan."""
+        pause_filter = ""
+        if item_type != "ocr":
+            pause_filter = "AND NOT s.pause_non_ocr_conversions"
+        params = [ConversionQueueItem.PROCESSING, pid,
+                  timezone.localtime(timezone.now()), item_type,
+                  ConversionQueueItem.NEW, scan_pk, batch_size]
+        sql = """
+            UPDATE {items} SET status = %s, process_id = %s,
+                process_start_time = %s
+            WHERE id IN (
+                SELECT q.id FROM {items} q
+                JOIN {urls} u ON u.id = q.url_id
+                JOIN {scans} s ON s.id = u.scan_id
+                WHERE q.type = %s AND q.status = %s {pause_filter}
+                    AND s.id = %s
+                ORDER BY q.id
+                LIMIT %s
+                FOR UPDATE OF q SKIP LOCKED
+            )
+            RETURNING id
+        """.format(
+            items=ConversionQueueItem._meta.db_table,
+            urls=Url._meta.db_table,
+            scans=Scan._meta.db_table,
+            pause_filter=pause_filter
+        )
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, params)
+                    ids = [row[0] for row in cursor.fetchall()]
+        except (DatabaseError, IntegrityError) as e:
+            datetime_print('Error message {0}'.format(e))
+            datetime_print('Transaction failed while getting queue item of type {0}'.format(
+                item_type)
+            )
+            return []
+        if not ids:
+            return []
+        return list(ConversionQueueItem.objects.select_related(
+            'url__scan').filter(pk__in=ids).order_by('pk'))
+
+    def wait(self, item_type, timeout):
+        """Wait for a notification about new items of the given type."""
+        channel = self.channel_prefix + item_type
+        connection.ensure_connection()
+        pg_connection = connection.connection
+        if pg_connection is not self.listening_connection:
+            # New database connection, so we have to LISTEN again
+            self.listening = set()
+            self.listening_connection = pg_connection
+        if channel not in self.listening:
+            with connection.cursor() as cursor:
+                cursor.execute('LISTEN "%s"' % channel)
+            self.listening.add(channel)
+
+        if not pg_connection.notifies:
+            select.select([pg_connection], [], [], timeout)
+            pg_connection.poll()
+        del pg_connection.notifies[:]
+
+    def notify(self, item_type):
+        """Wake processors waiting for items of the given type."""
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)',
+                           [self.channel_prefix + item_type, ''])
+
+
+QueueBackend.register_backend('database', DatabaseQueueBackend)
+QueueBackend.register_backend('postgresql', PostgreSQLQueueBackend)
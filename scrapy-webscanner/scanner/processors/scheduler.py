@@ -0,0 +1,200 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+"""Fair scheduling of the conversion queue between scans and organizations.
+"""
+
+import time
+
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from os2webscanner.models.conversionqueueitem_model import ConversionQueueItem
+
+from .utils import datetime_print
+
+
+class FairScheduler(object):
+
+    """Chooses the scan a queue processor claims its next items from.
+
+    Scans are either interactive, i.e. run synchronously for the file upload
+    page or the RPC interface while a user waits, or scheduled. Interactive
+    scans go first, but a class of scans is raised a priority level for
+    every aging_interval seconds it has waited without being served by the
+    processor, so a steady stream of interactive scans doesn't starve the
+    scheduled ones.
+
+    Within a class, the processors are shared between organizations in
+    proportion to their queue weights: the organization with the fewest
+    items being processed per weight goes first. Within an organization,
+    the scan with the fewest items being processed goes first, and of
+    equals, the one with the oldest item.
+
+    The time claimed items waited in the queue is logged per class every
+    report_interval seconds.
+    """
+
+    INTERACTIVE = 'interactive'
+    SCHEDULED = 'scheduled'
+
+    class_priorities = {INTERACTIVE: 1, SCHEDULED: 0}
+    aging_interval = 60
+    report_interval = 60
+
+    def __init__(self):
+        """Initialize the scheduler."""
+        now = time.time()
+        self.last_served = dict((c, now) for c in self.class_priorities)
+        # Maps a class to the [number, total, maximum] of wait times
+        self.wait_times = {}
+        self.last_report = now
+
+    def candidates(self, queryset):
+        """Return the scans with items in the queryset of claimable items.
+
+        Returns a list of dicts with the scan, organization, weight and
+        class of each scan, and the number and oldest creation time of its
+        items.
+        """
+        rows = queryset.values(
+            'url__scan', 'url__scan__scanner__organization',
+            'url__scan__scanner__organization__queue_weight',
+            'url__scan__scanner__do_run_synchronously'
+        ).annotate(waiting=Count('pk'), oldest=Min('created_time'))
+        return [{
+            'scan': row['url__scan'],
+            'organization': row['url__scan__scanner__organization'],
+            'weight': row['url__scan__scanner__organization__queue_weight'],
+            'class': (self.INTERACTIVE
+                      if row['url__scan__scanner__do_run_synchronously']
+                      else self.SCHEDULED),
+            'waiting': row['waiting'],
+            'oldest': row['oldest'],
+        } for row in rows]
+
+    def processing(self, item_type):
+        """Return the number of items of the type being processed.
+
+        Returns two dicts, mapping scans and organizations to their number
+        of items being processed.
+        """
+        rows = ConversionQueueItem.objects.filter(
+            type=item_type,
+            status=ConversionQueueItem.PROCESSING
+        ).values(
+            'url__scan', 'url__scan__scanner__organization'
+        ).annotate(processing=Count('pk'))
+        scans = {}
+        organizations = {}
+        for row in rows:
+            organization = row['url__scan__scanner__organization']
+            scans[row['url__scan']] = row['processing']
+            organizations[organization] = (
+                organizations.get(organization, 0) + row['processing']
+            )
+        return scans, organizations
+
+    def choose(self, candidates, processing_scans, processing_organizations,
+               now=None):
+        """Return the candidate to claim items from, or None if none.
+
+        candidates are as returned by candidates, and processing_scans and
+        processing_organizations as returned by processing.
+        """
+        if not candidates:
+            return None
+        if now is None:
+            now = time.time()
+
+        classes = set(c['class'] for c in candidates)
+        for scan_class in self.last_served:
+            if scan_class not in classes:
+                # Nothing is waiting, so the class isn't aging
+                self.last_served[scan_class] = now
+        scan_class = max(classes, key=lambda c: (
+            self.class_priorities[c]
+            + (now - self.last_served[c]) / self.aging_interval,
+            self.class_priorities[c]
+        ))
+        candidates = [c for c in candidates if c['class'] == scan_class]
+
+        def oldest(candidate):
+            # Items from before creation times were recorded go first
+            return (candidate['oldest'] is not None,
+                    candidate['oldest'] or 0)
+
+        def share(candidate):
+            weight = max(candidate['weight'] or 1, 1)
+            return processing_organizations.get(
+                candidate['organization'], 0
+            ) / weight
+
+        organization = min(candidates,
+                           key=lambda c: (share(c), oldest(c)))['organization']
+        return min((c for c in candidates
+                    if c['organization'] == organization),
+                   key=lambda c: (processing_scans.get(c['scan'], 0),
+                                  oldest(c)))
+
+    def choose_scan(self, item_type, queryset):
+        """Return the scan to claim items of the type from.
+
+        queryset holds the claimable items of the type. Returns a
+        (scan id, class) tuple, or None if there are no claimable items.
+        """
+        candidates = self.candidates(queryset)
+        if not candidates:
+            return None
+        processing_scans, processing_organizations = self.processing(
+            item_type
+        )
+        candidate = self.choose(candidates, processing_scans,
+                                processing_organizations)
+        return candidate['scan'], candidate['class']
+
+    def claimed(self, item_type, scan_class, items):
+        """Record that items of the class were claimed."""
+        now = time.time()
+        if items:
+            self.last_served[scan_class] = now
+        claim_time = timezone.now()
+        stats = self.wait_times.setdefault(scan_class, [0, 0.0, 0.0])
+        for item in items:
+            if item.created_time is None:
+                continue
+            wait = (claim_time - item.created_time).total_seconds()
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] = max(stats[2], wait)
+
+        if now - self.last_report >= self.report_interval:
+            self.report(item_type)
+            self.last_report = now
+
+    def report(self, item_type):
+        """Log the wait times since the last report and reset them."""
+        lines = []
+        for scan_class in sorted(self.wait_times):
+            count, total, maximum = self.wait_times[scan_class]
+            if count:
+                lines.append("%s %d items, mean %.1f s, max %.1f s" % (
+                    scan_class, count, total / count, maximum
+                ))
+        if lines:
+            datetime_print("Queue wait times for %s items: %s" % (
+                item_type, "; ".join(lines)
+            ))
+        self.wait_times = {}
@@ -0,0 +1,82 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+"""A RAM-backed spool for small files queued for conversion."""
+
+import os
+import time
+
+from django.conf import settings
+
+
+class Spool(object):
+
+    """Decides where files queued for conversion are written.
+
+    Files of at most SPOOL_MAX_FILE_SIZE bytes are written to the scan's
+    directory in SPOOL_DIR, a RAM-backed file system, as long as the spool
+    holds less than SPOOL_MAX_SIZE bytes, and larger files to the scan's
+    directory on disk. A queue item's temp dir, where its conversion writes
+    its output, is always on disk, as the output, e.g. of an archive or of
+    the images of a scanned PDF file, can be many times larger than the
+    file, so the spool only ever holds the queued files.
+
+    The size of the spool is measured by adding up the sizes of the files in
+    it, at most every usage_interval seconds per process. Files written by
+    the process in between are added to the last measurement.
+    """
+
+    usage_interval = 1
+
+    # The last measured size of the spool and when it was measured
+    _usage = 0
+    _usage_time = 0
+
+    @classmethod
+    def usage(cls):
+        """Return the number of bytes in the spool."""
+        now = time.time()
+        if now - cls._usage_time >= cls.usage_interval:
+            total = 0
+            for root, dirnames, filenames in os.walk(settings.SPOOL_DIR):
+                for name in filenames:
+                    try:
+                        total += os.lstat(os.path.join(root, name)).st_size
+                    except OSError:
+                        # Deleted while we looked
+                        pass
+            cls._usage = total
+            cls._usage_time = now
+        return cls._usage
+
+    @classmethod
+    def tmp_dir(cls, url_object, size):
+        """Return the directory to write a file of size bytes from the URL to.
+        """
+        spool_dir = url_object.scan.spool_dir
+        if (spool_dir is None
+                or size > getattr(settings, 'SPOOL_MAX_FILE_SIZE', 0)
+                or cls.usage() + size > getattr(settings, 'SPOOL_MAX_SIZE',
+                                                0)):
+            return url_object.tmp_dir
+        tmp_dir = os.path.join(spool_dir, 'url_item_%d' % url_object.pk)
+        try:
+            if not os.path.exists(tmp_dir):
+                os.makedirs(tmp_dir)
+        except OSError:
+            # No usable spool, so fall back to the disk
+            return url_object.tmp_dir
+        cls._usage += size
+        return tmp_dir
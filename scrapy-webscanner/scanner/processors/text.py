@@ -19,6 +19,7 @@ from os2webscanner.utils import get_codec_and_string
 
 from ..scanner.scanner import Scanner
 from .processor import Processor
+from .match_sink import MatchSink
 import os
 import logging
 
@@ -42,22 +43,39 @@ class TextProcessor(Processor):
     def process(self, data, url_object, page_no=None):
         """Process the text, by executing rules and saving matches."""
         try:
-            encoding, data = get_codec_and_string(data)
+            data = self.extract_text(data)
         except UnicodeDecodeError as ude:
             logging.error('UnicodeDecodeError in handle_error_method: {}'.format(ude))
             logging.error('Error happened for file: {}'.format(url_object.url))
             return False
 
-        scanner = Scanner(url_object.scan.pk)
+        scanner = Scanner.for_scan(url_object.scan)
 
-        matches = scanner.execute_rules(data)
-        for match in matches:
-            match['url'] = url_object
-            match['scan'] = url_object.scan
-            if page_no:
-                match['page_no'] = page_no
-            match.save()
+        self.store_matches(scanner.execute_rules(data), url_object, page_no)
         return True
 
+    def process_stream(self, read, url_object, page_no=None):
+        """Process text read in pieces, by executing rules and saving matches.
+        """
+        scanner = Scanner.for_scan(url_object.scan)
+
+        self.store_matches(scanner.execute_rules_stream(read), url_object,
+                           page_no)
+        return True
+
+    def extract_text(self, data):
+        """Return the text for the rules to be executed on.
+
+        Raises UnicodeDecodeError if the data can't be decoded.
+        """
+        encoding, data = get_codec_and_string(data)
+        return data
+
+    def store_matches(self, matches, url_object, page_no=None):
+        """Save the matches found in the URL."""
+        with MatchSink(url_object, page_no) as sink:
+            for match in matches:
+                sink.add(match)
+
 
 Processor.register_processor(TextProcessor.item_type, TextProcessor)
@@ -15,16 +15,73 @@
 # source municipalities ( http://www.os2web.dk/ )
 """Zip file processors."""
 
+import io
+import os
+import bz2
+import gzip
+import lzma
+import zlib
+import tarfile
+import zipfile
+import mimetypes
+import functools
+
 from .processor import Processor
-import subprocess
+
+# Signatures and openers of single compressed files
+_compressors = (
+    (b'\x1f\x8b', lambda f: gzip.GzipFile(fileobj=f)),
+    (b'BZh', lambda f: bz2.BZ2File(f)),
+    (b'\xfd7zXZ\x00', lambda f: lzma.LZMAFile(f)),
+)
+
+# Errors from reading broken or unsupported archives and members
+_archive_errors = (zipfile.BadZipFile, tarfile.TarError, zlib.error,
+                   lzma.LZMAError, EOFError, OSError, RuntimeError,
+                   NotImplementedError)
+
+
+class ArchiveLimitExceeded(Exception):
+
+    """Raised when extracting an archive exceeds one of the limits."""
+
+    pass
 
 
 class ZipProcessor(Processor):
 
-    """A processor which can handle zip-compressed files using unzip."""
+    """A processor which extracts zip, tar and compressed files.
+
+    The members of the archive are read one at a time without extracting
+    the archive to disk. Members which are processed in memory, like text,
+    HTML and CSV files, are processed directly if they are no larger than
+    inline_size bytes, and archives in the archive are extracted in turn, up
+    to max_depth levels deep. Only the members which need converting by
+    other processors are written to the temp dir, to be added to the queue.
+
+    To guard against zip bombs, at most max_members members are extracted,
+    and at most max_ratio times the size of the archive, or max_size bytes
+    if that is less, are extracted in all, including nested archives.
+    """
 
     item_type = "zip"
 
+    # Processor types of the members which are processed in memory
+    inline_types = ('text', 'html', 'csv')
+    # Largest member processed in memory, in bytes
+    inline_size = 10 * 1024 * 1024
+    # How deep archives in archives are extracted
+    max_depth = 3
+    # Largest number of members extracted
+    max_members = 10000
+    # Largest total size extracted, in bytes and relative to the archive
+    max_size = 4 * 1024 * 1024 * 1024
+    max_ratio = 100
+    # Extracting less than this is always allowed, however small the archive
+    min_size = 10 * 1024 * 1024
+
+    chunk_size = 64 * 1024
+
     def handle_spider_item(self, data, url_object):
         """Add the item to the queue."""
         return self.add_to_queue(data, url_object)
@@ -34,11 +91,187 @@ class ZipProcessor(Processor):
         return self.convert_queue_item(item)
 
     def convert(self, item, tmp_dir):
-        """Extract the item using unzip."""
-        return_code = subprocess.call(
-            ["unzip", "-o", "-q", "-d", tmp_dir, item.file_path]
-        )
-        return return_code == 0
+        """Process the members of the archive.
+
+        Members which are not processed in memory are written to the temp
+        dir. Returns False if the file is not an archive, or if extracting
+        it exceeds one of the limits, so its MD5 sum is not stored as that
+        of a fully scanned file.
+        """
+        archive_size = os.path.getsize(item.file_path)
+        state = {
+            'members': 0,
+            'size': 0,
+            'max_size': min(self.max_size,
+                            max(self.min_size, archive_size * self.max_ratio)),
+        }
+        try:
+            with open(item.file_path, 'rb') as f:
+                self.extract(item, f, os.path.basename(item.file_path),
+                             tmp_dir, 0, state)
+        except ArchiveLimitExceeded as e:
+            item.url.scan.log_occurrence(
+                "ARCHIVE LIMIT EXCEEDED: {0}, URL: {1}".format(
+                    e, item.url.url
+                )
+            )
+            return False
+        except _archive_errors as e:
+            item.url.scan.log_occurrence(
+                "ARCHIVE ERROR: {0}, URL: {1}".format(e, item.url.url)
+            )
+            return False
+        return True
+
+    def members(self, f, name):
+        """Yield the name and a function opening each file in the archive.
+
+        Supports zip and tar archives, the latter optionally compressed, and
+        single gzip, bzip2 and xz compressed files.
+        """
+        if zipfile.is_zipfile(f):
+            with zipfile.ZipFile(f) as archive:
+                for info in archive.infolist():
+                    if info.filename.endswith('/'):
+                        continue
+                    yield info.filename, functools.partial(archive.open,
+                                                           info)
+            return
+
+        f.seek(0)
+        try:
+            archive = tarfile.open(fileobj=f, mode='r:*')
+        except tarfile.TarError:
+            archive = None
+        if archive is not None:
+            with archive:
+                for info in archive:
+                    # Skip directories, links and devices
+                    if info.isfile():
+                        yield info.name, functools.partial(
+                            archive.extractfile, info
+                        )
+            return
+
+        f.seek(0)
+        head = f.read(8)
+        f.seek(0)
+        for signature, opener in _compressors:
+            if head.startswith(signature):
+                yield os.path.splitext(name)[0], functools.partial(opener, f)
+                return
+        raise zipfile.BadZipFile("Unsupported archive format")
+
+    def extract(self, item, f, name, tmp_dir, depth, state):
+        """Process the members of the archive read from f."""
+        for member_name, open_member in self.members(f, name):
+            state['members'] += 1
+            if state['members'] > self.max_members:
+                raise ArchiveLimitExceeded(
+                    "more than %d files" % self.max_members
+                )
+            try:
+                with open_member() as member:
+                    self.extract_member(item, member_name, member, tmp_dir,
+                                        depth, state)
+            except ArchiveLimitExceeded:
+                raise
+            except _archive_errors as e:
+                item.url.scan.log_occurrence(
+                    "ARCHIVE ERROR: {0} in {1}, URL: {2}".format(
+                        e, member_name, item.url.url
+                    )
+                )
+
+    def extract_member(self, item, name, member, tmp_dir, depth, state):
+        """Process a member of an archive, or write it to the temp dir."""
+        file_name = os.path.basename(name)
+        head = self.read(member, self.chunk_size, state)
+        mime_type, encoding = mimetypes.guess_type(file_name)
+        if encoding is not None:
+            # Compressed file
+            processor_type = self.item_type
+        else:
+            if mime_type is None:
+                mime_type = self.mime_magic.from_buffer(head)
+            processor_type = Processor.mimetype_to_processor_type(mime_type)
+
+        if processor_type is None:
+            return
+        if processor_type == 'ocr' and not item.url.scan.do_ocr:
+            return
+        if processor_type == self.item_type and depth >= self.max_depth:
+            item.url.scan.log_occurrence(
+                "ARCHIVE LIMIT EXCEEDED: more than {0} nested archives at {1}"
+                ", URL: {2}".format(self.max_depth, name, item.url.url)
+            )
+            return
+
+        if processor_type in self.inline_types + (self.item_type,):
+            data = head + self.read(member, self.inline_size + 1 - len(head),
+                                    state)
+            if len(data) <= self.inline_size:
+                if processor_type == self.item_type:
+                    self.extract(item, io.BytesIO(data), file_name, tmp_dir,
+                                 depth + 1, state)
+                else:
+                    self.process_member(item, name, processor_type, data)
+                return
+            head = data
+
+        # Write the member to the temp dir
+        file_path = os.path.join(tmp_dir,
+                                 "%d_%s" % (state['members'], file_name))
+        with open(file_path, 'wb') as out:
+            out.write(head)
+            while True:
+                data = self.read(member, self.chunk_size, state)
+                if not data:
+                    break
+                out.write(data)
+
+        if processor_type == self.item_type:
+            # Large nested archive
+            try:
+                with open(file_path, 'rb') as f:
+                    self.extract(item, f, file_name, tmp_dir, depth + 1,
+                                 state)
+            finally:
+                os.remove(file_path)
+
+    def process_member(self, item, name, processor_type, data):
+        """Process a member in memory with the processor of its type.
+
+        The data is decoded like Processor.process_file decodes files, as
+        the processors expect text. Errors are logged, and don't stop the
+        extraction of the rest of the archive.
+        """
+        try:
+            encoding = self.encoding_magic.from_buffer(data)
+            if encoding in ('binary', 'unknown-8bit'):
+                encoding = 'iso-8859-1'
+            try:
+                text = data.decode(encoding)
+            except (LookupError, UnicodeDecodeError):
+                text = data.decode('iso-8859-1', errors='replace')
+            processor = Processor.processor_by_type(processor_type)
+            processor.process(text, item.url)
+        except Exception as e:
+            item.url.scan.log_occurrence(
+                "ARCHIVE ERROR: {0} in {1}, URL: {2}".format(
+                    e, name, item.url.url
+                )
+            )
+
+    def read(self, member, size, state):
+        """Read up to size bytes of the member, counting them."""
+        data = member.read(size)
+        state['size'] += len(data)
+        if state['size'] > state['max_size']:
+            raise ArchiveLimitExceeded(
+                "more than %d bytes extracted" % state['max_size']
+            )
+        return data
 
 
 Processor.register_processor(ZipProcessor.item_type, ZipProcessor)
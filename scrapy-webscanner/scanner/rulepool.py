@@ -0,0 +1,135 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+"""Executing the rules on HTML and text from the spider in worker processes.
+"""
+
+import os
+import threading
+import multiprocessing
+
+from django import db
+
+from .items import MatchItem
+from .processors.processor import Processor
+from .scanner.scanner import Scanner
+
+# The Scanner of a worker process, with the scan's rules compiled
+_scanner = None
+
+
+def _init_worker(scan_id):
+    """Compile the scan's rules in a new worker process."""
+    global _scanner
+    _scanner = Scanner(scan_id)
+    # The rules are loaded, so the worker doesn't need the database
+    db.connection.close()
+
+
+def _execute_rules(item_type, data):
+    """Execute the rules on the data of the type.
+
+    Returns the matches as dicts, as they are sent back to the parent.
+    """
+    text = Processor.processor_by_type(item_type).extract_text(data)
+    return [dict(match) for match in _scanner.execute_rules(text)]
+
+
+class RulePool(object):
+
+    """A pool of worker processes executing a scan's rules.
+
+    The spider downloads HTML and text in a single process, so executing
+    the rules on them there leaves the other cores idle and the downloader
+    waiting. The pool takes the data and returns the matches instead.
+
+    Each worker compiles the scan's rules when it starts. The workers are
+    spawned rather than forked, as the spider process runs threads and has
+    a database connection open, so they set up Django from scratch.
+
+    The pool is saturated when max_jobs jobs, jobs_per_worker per worker,
+    are waiting or running; see RulePoolBackpressure.
+
+    A job whose worker dies, e.g. at the hands of the OOM killer, is never
+    done, so it is given up on after timeout seconds.
+    """
+
+    item_types = ('html', 'text')
+    jobs_per_worker = 4
+    timeout = 300
+
+    def __init__(self, scan_id, workers=None):
+        """Start the pool for the scan, with a worker per available core
+        unless the number of workers is given."""
+        if workers is None:
+            workers = len(os.sched_getaffinity(0))
+        self.workers = workers
+        self.max_jobs = workers * self.jobs_per_worker
+        # The number of jobs submitted and not yet done or given up on, and
+        # the keys of those jobs
+        self.jobs = 0
+        self.running = set()
+        self.next_key = 0
+        self.jobs_lock = threading.Lock()
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(workers, initializer=_init_worker,
+                                 initargs=(scan_id,))
+
+    @property
+    def saturated(self):
+        """Whether the pool has all the jobs it should have."""
+        return self.jobs >= self.max_jobs
+
+    def submit(self, item_type, data):
+        """Submit the data of the type for the rules to be executed on.
+
+        Returns a job to pass to get_matches.
+        """
+        with self.jobs_lock:
+            key = self.next_key
+            self.next_key += 1
+            self.running.add(key)
+            self.jobs = len(self.running)
+        result = self.pool.apply_async(
+            _execute_rules, (item_type, data),
+            callback=lambda result: self._done(key),
+            error_callback=lambda error: self._done(key)
+        )
+        return key, result
+
+    def _done(self, key):
+        with self.jobs_lock:
+            self.running.discard(key)
+            self.jobs = len(self.running)
+
+    def get_matches(self, job):
+        """Wait for the job and return its matches as MatchItems.
+
+        Raises the exception the job raised, if any, or
+        multiprocessing.TimeoutError if it isn't done within timeout
+        seconds.
+        """
+        key, result = job
+        try:
+            matches = result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            self._done(key)
+            raise
+        return [MatchItem(**match) for match in matches]
+
+    def close(self):
+        """Stop the workers."""
+        self.pool.terminate()
+        self.pool.join()
@@ -22,6 +22,7 @@ import os
 import codecs
 
 from .rule import Rule
+from .nameindex import load_index
 from os2webscanner.models.sensitivity_level import Sensitivity
 from ..items import MatchItem
 
@@ -54,28 +55,35 @@ def match_full_address(text):
     matches = set()
     it = full_address_regex.finditer(text, overlapped=False)
     for m in it:
-        street_address = m.group("street_name")
-        house_number = m.group("house_number")
-        try:
-            zip_code = m.group("zip_code")
-        except IndexError:
-            zip_code = ''
-        try:
-            city = m.group("city")
-        except IndexError:
-            city = ''
-
-        if house_number is not None:
-            house_number = house_number.lstrip()
-        else:
-            house_number = ''
-        matched_text = m.group(0)
-        matches.add(
-            (street_address, house_number, zip_code, city, matched_text)
-        )
+        matches.add(split_full_address(m))
     return matches
 
 
+def split_full_address(m):
+    """Return the parts of a match of full_address_regex.
+
+    Returns a (street name, house number, zip code, city, matched text)
+    tuple.
+    """
+    street_address = m.group("street_name")
+    house_number = m.group("house_number")
+    try:
+        zip_code = m.group("zip_code")
+    except IndexError:
+        zip_code = ''
+    try:
+        city = m.group("city")
+    except IndexError:
+        city = ''
+
+    if house_number is not None:
+        house_number = house_number.lstrip()
+    else:
+        house_number = ''
+    matched_text = m.group(0)
+    return street_address, house_number, zip_code, city, matched_text
+
+
 def load_name_file(file_name):
     r"""Load a data file containing persons names in uppercase.
 
@@ -126,63 +134,68 @@ class AddressRule(Rule):
         The whitelist should contains a multi-line string, with one name per
         line.
         """
-        # Load first and last names from data files
-        self.street_names = load_name_file(
-            self._data_dir + '/' + self._street_name_file
-        )
-        # Convert to sets for efficient lookup
-        self.street_names = set(self.street_names)
+        # Load street names from the shared street name index
+        self.street_names = self.load_indexes()
         self.whitelist = load_whitelist(whitelist)
         self.blacklist = load_whitelist(blacklist)
 
-    def execute(self, text):
-        """Execute the Name rule."""
-        matches = set()
-        unmatched_text = text
-
-        # Check for whole addresses, i.e. at least street name + house
-        # number.
-        addresses = match_full_address(text)
-        for address in addresses:
-            # Match each name against the list of first and last names
-            street_name = address[0].upper()
-            house_number = address[1].upper() if address[1] else ''
-            zip_code = address[2].upper() if address[2] else ''
-            city = address[3].upper()if address[3] else ''
-
-            street_address = "%s %s" % (street_name, house_number)
-            full_address = "%s %s, %s %s" % (street_name, house_number,
-                                             zip_code, city)
-
-            if (
-                street_address in self.whitelist or
-                full_address in self.whitelist
-            ):
-                continue
-            blacklisted = (street_name in self.blacklist or
-                           street_address in self.blacklist or
-                           full_address in self.blacklist)
-            street_match = street_name[:20] in self.street_names
-
-            if blacklisted or (street_match and house_number):
-                sensitivity = Sensitivity.HIGH
-            elif street_match:
-                # Real street name, but not blacklisted
-                sensitivity = Sensitivity.LOW
+    @classmethod
+    def load_indexes(cls):
+        """Return the street name index, building it if needed."""
+        return load_index(
+            'street_names',
+            [cls._data_dir + '/' + cls._street_name_file],
+            load_name_file
+        )
+
+    def get_patterns(self):
+        """Return the full address pattern."""
+        return [('full_address', full_address_regex)]
+
+    def handle_match(self, key, m, context):
+        """Check a whole address, i.e. at least street name + house number.
+        """
+        address = split_full_address(m)
+        # Each distinct address is only matched once
+        if address in context.seen:
+            return
+        context.seen.add(address)
+
+        # Match each name against the list of first and last names
+        street_name = address[0].upper()
+        house_number = address[1].upper() if address[1] else ''
+        zip_code = address[2].upper() if address[2] else ''
+        city = address[3].upper()if address[3] else ''
+
+        street_address = "%s %s" % (street_name, house_number)
+        full_address = "%s %s, %s %s" % (street_name, house_number,
+                                         zip_code, city)
+
+        if (
+            street_address in self.whitelist or
+            full_address in self.whitelist
+        ):
+            return
+        blacklisted = (street_name in self.blacklist or
+                       street_address in self.blacklist or
+                       full_address in self.blacklist)
+        street_match = street_name[:20] in self.street_names
+
+        if blacklisted or (street_match and house_number):
+            sensitivity = Sensitivity.HIGH
+        elif street_match:
+            # Real street name, but not blacklisted
+            sensitivity = Sensitivity.LOW
+        else:
+            if zip_code or city:
+                # No real street name, but apparently an address
+                sensitivity = Sensitivity.OK
             else:
-                if zip_code or city:
-                    # No real street name, but apparently an address
-                    sensitivity = Sensitivity.OK
-                else:
-                    continue
-
-            # Store the original matching text
-            matched_text = address[4]
-
-            # Update remaining, i.e. unmatched text
-            unmatched_text = unmatched_text.replace(matched_text, "", 1)
-
-            matches.add(
-                MatchItem(matched_data=matched_text, sensitivity=sensitivity)
-            )
-        return matches
+                return
+
+        # Store the original matching text
+        matched_text = address[4]
+
+        context.matches.append(
+            MatchItem(matched_data=matched_text, sensitivity=sensitivity)
+        )
@@ -54,6 +54,19 @@ class CPRRule(Rule):
                              whitelist=self.whitelist)
         return matches
 
+    def get_patterns(self):
+        """Return the CPR pattern."""
+        return [(self.name, cpr_regex)]
+
+    def handle_match(self, key, match, context):
+        """Validate the CPR number matched."""
+        match_item = match_cpr(match, context.text,
+                               do_modulus11=self.do_modulus11,
+                               ignore_irrelevant=self.ignore_irrelevant,
+                               whitelist=self.whitelist)
+        if match_item is not None:
+            context.matches.append(match_item)
+
 # TODO: Improve
 
 
@@ -177,37 +190,51 @@ def match_cprs(text, do_modulus11=True, ignore_irrelevant=True,
 
     If mask_digits is False, then the matches will contain full CPR numbers.
     """
-    it = cpr_regex.finditer(text)
     matches = set()
-    for m in it:
-        cpr = m.group(1).replace(' ', '') + m.group(2)
-        if cpr in whitelist:
-            continue
-        valid_date = date_check(cpr, ignore_irrelevant)
-        if do_modulus11:
-            try:
-                valid_modulus11 = modulus11_check(cpr)
-            except ValueError:
-                valid_modulus11 = True
-        else:
-            valid_modulus11 = True
-        original_cpr = m.group(0)
-        if mask_digits:
-            # Mask last 6 digits
-            cpr = cpr[0:4] + "XXXXXX"
-        # Calculate context.
-        low, high = m.span()
-        if low < 50:
-            # Sanity
-            low = 50
-        match_context = text[low - 50:high + 50]
-        match_context = regex.sub(cpr_regex, "XXXXXX-XXXX", match_context)
-
-        if valid_date and valid_modulus11:
-            matches.add(MatchItem(
-                matched_data=cpr,
-                sensitivity=Sensitivity.HIGH,
-                match_context=match_context,
-                original_matched_data=original_cpr,
-            ))
+    for m in cpr_regex.finditer(text):
+        match_item = match_cpr(m, text, do_modulus11=do_modulus11,
+                               ignore_irrelevant=ignore_irrelevant,
+                               mask_digits=mask_digits, whitelist=whitelist)
+        if match_item is not None:
+            matches.add(match_item)
     return matches
+
+
+def match_cpr(m, text, do_modulus11=True, ignore_irrelevant=True,
+              mask_digits=True, whitelist=[]):
+    """Return a MatchItem for the match of cpr_regex in the given text.
+
+    Returns None if the matched number is not a valid CPR number or is
+    whitelisted.
+    """
+    cpr = m.group(1).replace(' ', '') + m.group(2)
+    if cpr in whitelist:
+        return None
+    valid_date = date_check(cpr, ignore_irrelevant)
+    if do_modulus11:
+        try:
+            valid_modulus11 = modulus11_check(cpr)
+        except ValueError:
+            valid_modulus11 = True
+    else:
+        valid_modulus11 = True
+    original_cpr = m.group(0)
+    if mask_digits:
+        # Mask last 6 digits
+        cpr = cpr[0:4] + "XXXXXX"
+    # Calculate context.
+    low, high = m.span()
+    if low < 50:
+        # Sanity
+        low = 50
+    match_context = text[low - 50:high + 50]
+    match_context = regex.sub(cpr_regex, "XXXXXX-XXXX", match_context)
+
+    if valid_date and valid_modulus11:
+        return MatchItem(
+            matched_data=cpr,
+            sensitivity=Sensitivity.HIGH,
+            match_context=match_context,
+            original_matched_data=original_cpr,
+        )
+    return None
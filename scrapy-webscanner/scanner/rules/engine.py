@@ -0,0 +1,272 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+"""Execution of several rules in a single pass over the text."""
+
+import regex
+
+from django.conf import settings
+
+from .rule import RuleContext
+
+# Whitespace to end windows at when executing a stream
+_whitespace_regex = regex.compile(r"\s")
+
+# Flags which can be applied to a part of a pattern with a scoped flag group
+_scoped_flags = (
+    (regex.IGNORECASE, 'i'),
+    (regex.MULTILINE, 'm'),
+    (regex.DOTALL, 's'),
+)
+# Flags which all patterns have in common and can be ignored
+_common_flags = regex.UNICODE | regex.VERSION0
+
+# Patterns using backreferences or global inline flags can't be embedded in
+# a combined pattern, as group numbers change and flags would leak.
+_unembeddable_regex = regex.compile(
+    r"\\[1-9]|\\g<|\(\?P=|\(\?[aiLmsux]+\)"
+)
+
+
+def _embed(pattern, group_name):
+    """Return the pattern as an alternative capturing it in a named group.
+
+    Returns None if the pattern can't be part of a combined pattern.
+    """
+    flags = pattern.flags & ~_common_flags
+    scoped = ''
+    for flag, letter in _scoped_flags:
+        if flags & flag:
+            scoped += letter
+            flags &= ~flag
+    if flags or _unembeddable_regex.search(pattern.pattern):
+        return None
+    sub_pattern = pattern.pattern
+    if scoped:
+        sub_pattern = '(?%s:%s)' % (scoped, sub_pattern)
+    sub_pattern = '(?P<%s>%s)' % (group_name, sub_pattern)
+    try:
+        regex.compile(sub_pattern)
+    except (regex.error, TypeError):
+        return None
+    return sub_pattern
+
+
+class RuleEngine:
+
+    """Executes a set of rules in a single pass over the text.
+
+    The patterns of all the rules are combined into one alternation, which
+    is matched overlapped to find every position where at least one of the
+    patterns matches. At each such position the patterns are matched in
+    turn and the matches are handed to the rule owning the pattern for
+    validation. As with finditer, the matches of each pattern never overlap
+    each other, so the rules find the same matches as when executed on
+    their own.
+
+    Patterns which can't be combined are matched with their own finditer,
+    and rules which don't use patterns are executed separately.
+
+    With the backtracking regex module, the combined pattern is slower than
+    matching the patterns one at a time, as it can't skip ahead to where
+    each of the patterns may start: benchmarks/benchmark_rules.py measures
+    scanning the combined pattern alone as slower than the finditers of all
+    the patterns together, before any match is validated, and the single
+    pass as 2.5 to 3 times slower than the rules one at a time on 100 kB
+    and more. The single pass is therefore only used if single_pass is
+    True, which defaults to the RULE_ENGINE_SINGLE_PASS setting. Otherwise
+    all patterns are matched with their own finditer.
+    """
+
+    # The size of the windows a stream is executed in, and the overlap
+    # between them, in characters. The overlap must be at least the length
+    # of the longest match (matched data is at most 4096 characters long)
+    # plus the context around it (50 characters for CPR matches).
+    window_size = 1024 * 1024
+    window_overlap = 8192
+
+    def __init__(self, rules, single_pass=None):
+        """Compile the combined pattern of the given rules."""
+        if single_pass is None:
+            single_pass = getattr(settings, 'RULE_ENGINE_SINGLE_PASS', False)
+        self.rules = list(rules)
+        # (rule, key, pattern) triples of the combined and separate patterns
+        self.entries = []
+        self.separate_entries = []
+        self.separate_rules = []
+
+        alternatives = []
+        for rule in self.rules:
+            patterns = rule.get_patterns()
+            if patterns is None:
+                self.separate_rules.append(rule)
+                continue
+            for key, pattern in patterns:
+                group_name = '_engine%d' % len(self.entries)
+                sub_pattern = None
+                if single_pass:
+                    sub_pattern = _embed(pattern, group_name)
+                if sub_pattern is None:
+                    self.separate_entries.append((rule, key, pattern))
+                else:
+                    self.entries.append((rule, key, pattern))
+                    alternatives.append(sub_pattern)
+
+        self.group_indexes = dict(
+            ('_engine%d' % i, i) for i in range(len(self.entries))
+        )
+        self.combined_regex = None
+        if alternatives:
+            try:
+                self.combined_regex = regex.compile('|'.join(alternatives))
+            except regex.error:
+                # Fall back to matching the patterns one at a time
+                self.separate_entries = self.entries + self.separate_entries
+                self.entries = []
+
+    def execute(self, text):
+        """Execute the rules on the text.
+
+        Returns a dict mapping each rule to the set of its matches.
+        """
+        state = self._start()
+        self._execute_window(state, text, 0, 0, len(text))
+        return self._results(state)
+
+    def execute_stream(self, read):
+        """Execute the rules on a text read in pieces.
+
+        The read function is called with a number of characters to read,
+        like the read method of a file opened in text mode, and returns an
+        empty string at the end of the text. The text is executed in windows
+        of about window_size characters, each with window_overlap characters
+        of the neighbouring windows on both sides, so only a few windows are
+        kept in memory at a time. Windows end at whitespace where possible.
+
+        As long as no match is longer than the overlap, the matches are the
+        same as when executing the rules on the whole text.
+
+        Returns a dict mapping each rule to the set of its matches.
+        """
+        state = self._start()
+        data = ''
+        data_offset = 0
+        start = 0
+        at_end = False
+        while True:
+            # Read until there is a full window after start
+            while (not at_end and len(data) - start <
+                   self.window_size + self.window_overlap):
+                chunk = read(self.window_size)
+                if chunk:
+                    data += chunk
+                else:
+                    at_end = True
+
+            if at_end and len(data) - start <= self.window_size:
+                end = len(data)
+            else:
+                end = start + self.window_size
+                space = _whitespace_regex.search(
+                    data, end, end + self.window_overlap
+                )
+                if space is not None:
+                    end = space.end()
+            self._execute_window(state, data, data_offset, start, end)
+            if end == len(data) and at_end:
+                break
+
+            # Drop what is no longer needed as context
+            keep = max(0, end - self.window_overlap)
+            data = data[keep:]
+            data_offset += keep
+            start = end - keep
+        return self._results(state)
+
+    def _start(self):
+        """Return the state of a new execution."""
+        return {
+            'contexts': dict((rule, RuleContext('')) for rule in self.rules),
+            # Position in the whole text from which each pattern may match
+            # again
+            'next_start': [0] * len(self.entries),
+            'separate_next_start': [0] * len(self.separate_entries),
+        }
+
+    def _handle_match(self, rule, key, m, context):
+        """Hand the match to the rule and keep track of how far it reached.
+        """
+        count = len(context.matches)
+        rule.handle_match(key, m, context)
+        if len(context.matches) > count:
+            context.match_end = max(context.match_end,
+                                    context.offset + m.end())
+
+    def _execute_window(self, state, text, offset, start, end):
+        """Execute the rules on the window text[start:end].
+
+        The position of text in the whole text is given by offset. Only
+        matches starting inside the window are used.
+        """
+        contexts = state['contexts']
+        for context in contexts.values():
+            context.text = text
+            context.offset = offset
+            context.start = start
+            context.end = end
+            context.window_matches = len(context.matches)
+
+        if self.entries:
+            next_start = state['next_start']
+            # Overlapped matching finds a match at every position where one
+            # of the patterns matches, not only after the previous match
+            for candidate in self.combined_regex.finditer(text, start,
+                                                          overlapped=True):
+                position = candidate.start()
+                if position >= end:
+                    break
+                # Alternatives before the one which matched can't match here
+                first = self.group_indexes.get(candidate.lastgroup, 0)
+                for i in range(first, len(self.entries)):
+                    if offset + position < next_start[i]:
+                        continue
+                    rule, key, pattern = self.entries[i]
+                    m = pattern.match(text, position)
+                    if m is None:
+                        continue
+                    next_start[i] = offset + max(m.end(), position + 1)
+                    self._handle_match(rule, key, m, contexts[rule])
+
+        next_start = state['separate_next_start']
+        for i, (rule, key, pattern) in enumerate(self.separate_entries):
+            for m in pattern.finditer(text,
+                                      max(start, next_start[i] - offset)):
+                if m.start() >= end:
+                    break
+                next_start[i] = offset + max(m.end(), m.start() + 1)
+                self._handle_match(rule, key, m, contexts[rule])
+
+        for rule in self.rules:
+            if rule in self.separate_rules:
+                contexts[rule].matches.extend(rule.execute(text[start:end]))
+            else:
+                rule.finish(contexts[rule])
+
+    def _results(self, state):
+        """Return the matches of each rule."""
+        return dict(
+            (rule, set(context.matches))
+            for rule, context in state['contexts'].items()
+        )
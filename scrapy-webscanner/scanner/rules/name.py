@@ -22,6 +22,7 @@ import os
 import codecs
 
 from .rule import Rule
+from .nameindex import load_index, NameIndexUnion
 from os2webscanner.models.sensitivity_level import Sensitivity
 from ..items import MatchItem
 
@@ -40,22 +41,30 @@ def match_full_name(text):
     matches = set()
     it = full_name_regex.finditer(text, overlapped=False)
     for m in it:
-        first = m.group("first")
-        try:
-            middle = m.group("middle")
-        except IndexError:
-            middle = ''
-        if middle != '':
-            middle_split = tuple(
-                regex.split('\s+', middle.lstrip(), regex.UNICODE))
-        else:
-            middle_split = ()
-        last = m.group("last").lstrip()
-        matched_text = m.group(0)
-        matches.add((first, middle_split, last, matched_text))
+        matches.add(split_full_name(m))
     return matches
 
 
+def split_full_name(m):
+    """Return the parts of a match of full_name_regex.
+
+    Returns a (first, middle names, last, matched text) tuple.
+    """
+    first = m.group("first")
+    try:
+        middle = m.group("middle")
+    except IndexError:
+        middle = ''
+    if middle != '':
+        middle_split = tuple(
+            regex.split('\s+', middle.lstrip(), regex.UNICODE))
+    else:
+        middle_split = ()
+    last = m.group("last").lstrip()
+    matched_text = m.group(0)
+    return first, middle_split, last, matched_text
+
+
 def load_name_file(file_name):
     r"""Load a data file containing persons names in uppercase.
 
@@ -112,113 +121,153 @@ class NameRule(Rule):
         The whitelist should contains a multi-line string, with one name per
         line.
         """
-        # Load first and last names from data files
-        self.last_names = load_name_file(
-            self._data_dir + '/' + self._last_name_file)
-        self.first_names = []
-        for f in self._first_name_files:
-            self.first_names.extend(load_name_file(self._data_dir + '/' + f))
-
-        # Convert to sets for efficient lookup
-        self.last_names = set(self.last_names)
-        self.first_names = set(self.first_names)
-        self.all_names = self.last_names.union(self.first_names)
+        # Load first and last names from the shared name indexes
+        self.first_names, self.last_names = self.load_indexes()
+        self.all_names = NameIndexUnion(self.last_names, self.first_names)
         self.whitelist = load_whitelist(whitelist)
         self.blacklist = load_whitelist(blacklist)
 
-    def execute(self, text):
-        """Execute the Name rule."""
-        matches = set()
-        unmatched_text = text
-        # Determine if a name matches one of the lists
-        match = lambda n, list: n.upper() in self.blacklist or (
-            n.upper() in list and not n.upper() in self.whitelist
+    @classmethod
+    def load_indexes(cls):
+        """Return the first and last name indexes, building them if needed.
+
+        The indexes are built from the data files the first time they are
+        needed and then only memory-mapped by the following processes.
+        """
+        first_names = load_index(
+            'first_names',
+            [cls._data_dir + '/' + f for f in cls._first_name_files],
+            load_name_file
+        )
+        last_names = load_index(
+            'last_names',
+            [cls._data_dir + '/' + cls._last_name_file],
+            load_name_file
+        )
+        return first_names, last_names
+
+    def get_patterns(self):
+        """Return the full name pattern."""
+        return [('full_name', full_name_regex)]
+
+    def _is_name(self, n, names):
+        """Determine if a name matches one of the lists."""
+        return n.upper() in self.blacklist or (
+            n.upper() in names and not n.upper() in self.whitelist
         )
 
-        # First, check for whole names, i.e. at least Firstname + Lastname
-        names = match_full_name(text)
-        for name in names:
-            # Match each name against the list of first and last names
-            first_name = name[0]
-            middle_names = [n for n in name[1]]
-            last_name = name[2] if name[2] else ""
+    def handle_match(self, key, m, context):
+        """Check a whole name, i.e. at least Firstname + Lastname."""
+        name = split_full_name(m)
+        # Each distinct name is only matched once
+        if name in context.seen:
+            return
+        context.seen.add(name)
+        match = self._is_name
 
-            # Store the original matching text
-            matched_text = name[3]
+        # Match each name against the list of first and last names
+        first_name = name[0]
+        middle_names = [n for n in name[1]]
+        last_name = name[2] if name[2] else ""
 
+        # Store the original matching text
+        matched_text = name[3]
+
+        first_match = match(first_name, self.first_names)
+        last_match = match(last_name, self.last_names)
+        middle_match = any(
+            [match(n, self.all_names) for n in middle_names]
+        )
+        # But what if the name is Word Firstname Lastname?
+        while middle_match and not first_match:
+            old_name = first_name
+            first_name = middle_names.pop(0)
             first_match = match(first_name, self.first_names)
+            middle_match = any(
+                [match(n, self.all_names) for n in middle_names]
+            )
+            matched_text = matched_text.lstrip(old_name)
+            matched_text = matched_text.lstrip()
+        # The matched text is what is left at the end of the match
+        matched_start = m.end() - len(matched_text)
+        # Or Firstname Lastname Word?
+        while middle_match and not last_match:
+            old_name = last_name
+            last_name = middle_names.pop()
             last_match = match(last_name, self.last_names)
             middle_match = any(
                 [match(n, self.all_names) for n in middle_names]
             )
-            # But what if the name is Word Firstname Lastname?
-            while middle_match and not first_match:
-                old_name = first_name
-                first_name = middle_names.pop(0)
-                first_match = match(first_name, self.first_names)
-                middle_match = any(
-                    [match(n, self.all_names) for n in middle_names]
-                )
-                matched_text = matched_text.lstrip(old_name)
-                matched_text = matched_text.lstrip()
-            # Or Firstname Lastname Word?
-            while middle_match and not last_match:
-                old_name = last_name
-                last_name = middle_names.pop()
-                last_match = match(last_name, self.last_names)
-                middle_match = any(
-                    [match(n, self.all_names) for n in middle_names]
-                )
-                matched_text = matched_text.rstrip(old_name)
-                matched_text = matched_text.rstrip()
+            matched_text = matched_text.rstrip(old_name)
+            matched_text = matched_text.rstrip()
 
-            if middle_names:
-                full_name = "%s %s %s" % (
-                    first_name, " ".join(middle_names), last_name
-                )
-            else:
-                full_name = "%s %s" % (first_name, last_name)
-
-            if full_name in self.whitelist:
-                continue
-
-            # Check if name is blacklisted.
-            # The name is blacklisted if there exists a string in the
-            # blacklist which is contained as a substring of the name.
-            is_match = lambda str: str in full_name.upper()
-            is_blacklisted = any(map(is_match, self.blacklist))
-            # Name match is always high sensitivity
-            # and occurs only when first and last name are in the name lists
-            # Set sensitivity according to how many of the names were found
-            # in the names lists
-            if (first_match and last_match) or is_blacklisted:
-                sensitivity = Sensitivity.HIGH
-            elif first_match or last_match or middle_match:
-                sensitivity = Sensitivity.LOW
-            else:
-                #sensitivity = Sensitivity.OK
-                continue
-
-            # Update remaining, i.e. unmatched text
-            unmatched_text = unmatched_text.replace(matched_text, "", 1)
-
-            matches.add(
-                MatchItem(matched_data=matched_text, sensitivity=sensitivity)
+        if middle_names:
+            full_name = "%s %s %s" % (
+                first_name, " ".join(middle_names), last_name
             )
+        else:
+            full_name = "%s %s" % (first_name, last_name)
+
+        if full_name in self.whitelist:
+            return
+
+        # Check if name is blacklisted.
+        # The name is blacklisted if there exists a string in the
+        # blacklist which is contained as a substring of the name.
+        is_match = lambda str: str in full_name.upper()
+        is_blacklisted = any(map(is_match, self.blacklist))
+        # Name match is always high sensitivity
+        # and occurs only when first and last name are in the name lists
+        # Set sensitivity according to how many of the names were found
+        # in the names lists
+        if (first_match and last_match) or is_blacklisted:
+            sensitivity = Sensitivity.HIGH
+        elif first_match or last_match or middle_match:
+            sensitivity = Sensitivity.LOW
+        else:
+            #sensitivity = Sensitivity.OK
+            return
+
+        # Remember where the name is, so it is skipped when looking for
+        # standalone names
+        context.spans.append((context.offset + matched_start,
+                              context.offset + matched_start +
+                              len(matched_text)))
+        context.matches.append(
+            MatchItem(matched_data=matched_text, sensitivity=sensitivity)
+        )
+
+    def finish(self, context):
+        """Check for standalone names in the text not matched so far."""
+        # The part of the window not finished yet, including any full names
+        # reaching into the next window
+        start = max(context.start, context.position - context.offset)
+        end = max(context.end, context.match_end - context.offset)
+        context.position = context.offset + end
+
         # Full name match done. Now check if there's any standalone names in
-        # the remaining, i.e. so far unmatched string.
+        # the remaining, i.e. so far unmatched string, made up of the gaps
+        # between the full names.
+        gaps = []
+        for span_start, span_end in context.spans:
+            span_start -= context.offset
+            span_end -= context.offset
+            gaps.append(context.text[start:span_start])
+            start = span_end
+        gaps.append(context.text[start:end])
+        context.spans = []
+        unmatched_text = "".join(gaps)
         name_regex = regex.compile(_name)
         it = name_regex.finditer(unmatched_text, overlapped=False)
         for m in it:
             matched = m.group(0)
-            if match(matched.upper(), self.all_names):
+            if self._is_name(matched.upper(), self.all_names):
                 # Check blacklist - only exact matches
                 if matched.upper() in self.blacklist:
                     sensitivity = Sensitivity.HIGH
                 else:
                     sensitivity = Sensitivity.HIGH
-                matches.add(
+                context.matches.append(
                     MatchItem(matched_data=matched,
                               sensitivity=Sensitivity.LOW)
                 )
-        return matches
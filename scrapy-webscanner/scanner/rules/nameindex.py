@@ -0,0 +1,167 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+"""Read-only, memory-mapped indexes of the name and street name lists.
+
+An index file is a sorted table of UTF-8 encoded strings with an
+open-addressing hash table on top, for constant time lookups:
+
+    magic | count | slot count | offsets (count + 1) | slots | string data
+
+Each slot holds the position of a string plus one, or zero if it is empty.
+The files are built once from the data files and then memory-mapped by
+every process using them, so the pages are shared between all the queue
+processors instead of each keeping its own set of strings.
+"""
+
+import os
+import mmap
+import zlib
+import array
+import struct
+
+from django.conf import settings
+
+_magic = b'OS2NIDX2'
+_header = struct.Struct('=8sII')
+_item_size = array.array('I').itemsize
+
+# Indexes which have already been mapped in this process, by file name
+_indexes = {}
+
+
+def get_index_dir():
+    """Return the directory where index files are stored."""
+    return os.path.join(settings.VAR_DIR, 'rule_data')
+
+
+def build_index(names, index_file):
+    """Write an index file containing the given names.
+
+    The file is written to a temporary file first and then moved into place,
+    so processes never see a partially written index.
+    """
+    encoded = sorted(set(name.encode('utf-8') for name in names))
+    offsets = array.array('I', [0])
+    for name in encoded:
+        offsets.append(offsets[-1] + len(name))
+
+    # Keep the hash table at most half full
+    slot_count = 1
+    while slot_count < 2 * len(encoded):
+        slot_count *= 2
+    slots = array.array('I', [0]) * slot_count
+    for i, name in enumerate(encoded):
+        slot = zlib.crc32(name) & (slot_count - 1)
+        while slots[slot]:
+            slot = (slot + 1) & (slot_count - 1)
+        slots[slot] = i + 1
+
+    tmp_file = '%s.%d.tmp' % (index_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        f.write(_header.pack(_magic, len(encoded), slot_count))
+        f.write(offsets.tobytes())
+        f.write(slots.tobytes())
+        f.write(b''.join(encoded))
+    os.rename(tmp_file, index_file)
+
+
+class NameIndex(object):
+
+    """A read-only set of strings backed by a memory-mapped index file."""
+
+    def __init__(self, index_file):
+        """Map the index file into memory."""
+        with open(index_file, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count, slot_count = _header.unpack_from(self._map)
+        if magic != _magic:
+            raise ValueError("Not a name index file: %s" % index_file)
+        view = memoryview(self._map)
+        offsets_end = _header.size + (self._count + 1) * _item_size
+        slots_end = offsets_end + slot_count * _item_size
+        self._offsets = view[_header.size:offsets_end].cast('I')
+        self._slots = view[offsets_end:slots_end].cast('I')
+        self._mask = slot_count - 1
+        self._data_start = slots_end
+
+    def _get(self, i):
+        """Return the encoded string at position i."""
+        return self._map[self._data_start + self._offsets[i]:
+                         self._data_start + self._offsets[i + 1]]
+
+    def __contains__(self, name):
+        """Return whether the name is in the index."""
+        if not isinstance(name, str) or not self._count:
+            return False
+        key = name.encode('utf-8')
+        slot = zlib.crc32(key) & self._mask
+        position = self._slots[slot]
+        while position:
+            if self._get(position - 1) == key:
+                return True
+            slot = (slot + 1) & self._mask
+            position = self._slots[slot]
+        return False
+
+    def __len__(self):
+        """Return the number of names in the index."""
+        return self._count
+
+    def __iter__(self):
+        """Iterate over the names in sorted order."""
+        for i in range(self._count):
+            yield self._get(i).decode('utf-8')
+
+
+class NameIndexUnion(object):
+
+    """A read-only union of several name indexes."""
+
+    def __init__(self, *indexes):
+        """Initialize the union with the given indexes."""
+        self.indexes = indexes
+
+    def __contains__(self, name):
+        """Return whether the name is in any of the indexes."""
+        return any(name in index for index in self.indexes)
+
+
+def load_index(index_name, source_files, loader):
+    """Return the NameIndex with the given name, building it if needed.
+
+    The index is (re)built from the source files using the loader function,
+    which takes a file name and returns a list of names, if it doesn't exist
+    or is older than any of the source files.
+    """
+    index_dir = get_index_dir()
+    index_file = os.path.join(index_dir, index_name + '.idx')
+    index = _indexes.get(index_file)
+    if index is not None:
+        return index
+
+    source_mtime = max(os.path.getmtime(f) for f in source_files)
+    if (not os.path.exists(index_file) or
+            os.path.getmtime(index_file) < source_mtime):
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir, exist_ok=True)
+        names = []
+        for source_file in source_files:
+            names.extend(loader(source_file))
+        build_index(names, index_file)
+
+    index = NameIndex(index_file)
+    _indexes[index_file] = index
+    return index
@@ -69,18 +69,18 @@ class RegexRule(Rule):
             print('Returning< '+compound_rule+' >')
             return compound_rule
 
-    def execute(self, text):
-        """Execute the rule on the text."""
-        matches = set()
-        re_matches = self.regex.finditer(text)
-        for match in re_matches:
-            matched_data = match.group(0)
-            if len(matched_data) > 1024:
-                # TODO: Get rid of magic number
-                matched_data = match.group(1)
-            matches.add(MatchItem(matched_data=matched_data,
-                                  sensitivity=self.sensitivity))
-        return matches
+    def get_patterns(self):
+        """Return the compound pattern of the rule."""
+        return [(self.name, self.regex)]
+
+    def handle_match(self, key, match, context):
+        """Add the match of the compound pattern."""
+        matched_data = match.group(0)
+        if len(matched_data) > 1024:
+            # TODO: Get rid of magic number
+            matched_data = match.group(1)
+        context.matches.append(MatchItem(matched_data=matched_data,
+                                         sensitivity=self.sensitivity))
 
     def is_all_match(self, matches):
         """
@@ -16,13 +16,81 @@
 """Base classes for rules."""
 
 
+class RuleContext:
+
+    """The state of executing a rule on a single text.
+
+    Long texts are executed in windows (see RuleEngine.execute_stream), in
+    which case text only holds the current window. The part of the window
+    which the rule is responsible for is text[start:end]; the rest is
+    context shared with the neighbouring windows.
+    """
+
+    def __init__(self, text):
+        """Initialize the context for the given text."""
+        self.text = text
+        # Position of text in the whole text
+        self.offset = 0
+        self.start = 0
+        self.end = len(text)
+        # The matches found so far, and the index of the first match found
+        # in the current window
+        self.matches = []
+        self.window_matches = 0
+        # Values the rule has already seen, for rules ignoring duplicates
+        self.seen = set()
+        # Spans in the whole text of matches, in order, which the rule should
+        # skip when finishing the window
+        self.spans = []
+        # End in the whole text of the furthest match found so far, which
+        # may be past the end of the current window
+        self.match_end = 0
+        # Position in the whole text up to which the rule has finished
+        self.position = 0
+
+
 class Rule:
 
-    """Represents a rule which can be executed on text and returns matches."""
+    """Represents a rule which can be executed on text and returns matches.
+
+    Rules based on regular expressions return their patterns from
+    get_patterns and validate each match of the patterns in handle_match.
+    This lets the RuleEngine execute several rules in one pass over the
+    text. Other rules override execute instead.
+    """
 
     def execute(self, text):
         """Execute the rule on the given text.
 
         Return a list of MatchItem's.
         """
+        patterns = self.get_patterns()
+        if patterns is None:
+            raise NotImplementedError
+        context = RuleContext(text)
+        for key, pattern in patterns:
+            for m in pattern.finditer(text):
+                self.handle_match(key, m, context)
+        self.finish(context)
+        return set(context.matches)
+
+    def get_patterns(self):
+        """Return a list of (key, compiled pattern) pairs for the rule.
+
+        Returns None if the rule doesn't use patterns.
+        """
+        return None
+
+    def handle_match(self, key, match, context):
+        """Validate a match of the pattern with the given key.
+
+        Valid matches are added as MatchItem's to context.matches.
+        """
         raise NotImplementedError
+
+    def finish(self, context):
+        """Finish executing the rule once all patterns have been matched.
+
+        Called once for each window of the text.
+        """
+        pass
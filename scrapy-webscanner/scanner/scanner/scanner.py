@@ -15,12 +15,14 @@
 # source municipalities ( http://www.os2web.dk/ )
 
 """Contains a WebScanner."""
+import time
 from urllib.parse import urlparse
 
 from ..rules.name import NameRule
 from ..rules.address import AddressRule
 from ..rules.regexrule import RegexRule
 from ..rules.cpr import CPRRule
+from ..rules.engine import RuleEngine
 
 from ..processors.processor import Processor
 from os2webscanner.models.domain_model import Domain
@@ -30,6 +32,12 @@ from os2webscanner.models.scan_model import Scan
 class Scanner:
     """Represents a scanner which can scan data using configured rules."""
 
+    # Scanners with compiled rules, cached per process. Maps a scan id to a
+    # [rules fingerprint, Scanner, time the fingerprint was checked] list.
+    _cache = {}
+    # Seconds between checking whether the rules of a cached scanner changed
+    fingerprint_interval = 10
+
     def __init__(self, scan_id):
         """Load the scanner settings from the given scan ID."""
         # Get scan object from DB
@@ -37,10 +45,50 @@ class Scanner:
         self.scan_object = Scan.objects.get(pk=scan_id)
 
         self.rules = self._load_rules()
+        self.engine = RuleEngine(self.rules)
         self.valid_domains = self.scan_object.domains.filter(
             validation_status=Domain.VALID
         )
 
+    @classmethod
+    def for_scan(cls, scan_object):
+        """Return a Scanner for the scan, reusing already compiled rules.
+
+        Scanners are cached per process, keyed by scan id and the scan's
+        rules fingerprint, so the rules are only built once per scan unless
+        the rule configuration changes. The fingerprint, which takes queries
+        to compute, is checked at most every fingerprint_interval seconds.
+        Scanners for finished scans are not cached.
+        """
+        cached = cls._cache.get(scan_object.pk)
+        now = time.time()
+        if (cached is not None
+                and now - cached[2] < cls.fingerprint_interval):
+            return cached[1]
+        fingerprint = scan_object.rules_fingerprint
+        if cached is not None and cached[0] == fingerprint:
+            cached[2] = now
+            return cached[1]
+
+        scanner = cls(scan_object.pk)
+        if scan_object.status in (Scan.DONE, Scan.FAILED):
+            cls._cache.pop(scan_object.pk, None)
+        else:
+            cls._cache[scan_object.pk] = [fingerprint, scanner, now]
+        return scanner
+
+    @classmethod
+    def evict_finished_scans(cls):
+        """Remove cached scanners for scans which have finished."""
+        if not cls._cache:
+            return
+        finished_scan_ids = Scan.objects.filter(
+            pk__in=list(cls._cache.keys()),
+            status__in=(Scan.DONE, Scan.FAILED)
+        ).values_list('pk', flat=True)
+        for scan_id in finished_scan_ids:
+            del cls._cache[scan_id]
+
     def _load_rules(self):
         """Load rules based on WebScanner settings."""
         rules = []
@@ -131,17 +179,30 @@ class Scanner:
     def execute_rules(self, text):
         """Execute the scanner's rules on the given text.
 
+        All rules are executed together by the scanner's RuleEngine.
         Returns a list of matches.
         """
+        return self._collect_matches(self.engine.execute(text))
+
+    def execute_rules_stream(self, read):
+        """Execute the scanner's rules on a text read in pieces.
+
+        The text is read with the read function, e.g. the read method of a
+        file, and executed in overlapping windows, so large texts don't have
+        to be kept in memory. Returns a list of matches.
+        """
+        return self._collect_matches(self.engine.execute_stream(read))
+
+    def _collect_matches(self, results):
+        """Return a list of matches from the results of the rule engine."""
         matches = []
         for rule in self.rules:
-            print('-------Rule to be executed {0}-------'.format(rule))
-            rule_matches = rule.execute(text)
-            # TODO: Temporary fix. CPRRule needs to be a regexrule
-            if isinstance(rule, CPRRule):
+            rule_matches = results[rule]
+            if not isinstance(rule, RegexRule):
+                # Associate the rule with each match
                 for match in rule_matches:
                     match['matched_rule'] = rule.name
-                    matches.extend(rule_matches)
+                matches.extend(rule_matches)
             else:
                 #skip a ruleset where not all the rules match
                 if not rule.is_all_match(rule_matches):
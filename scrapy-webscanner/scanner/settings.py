@@ -52,6 +52,13 @@ DOWNLOADER_MIDDLEWARES = {
     'scanner.middlewares.LastModifiedCheckMiddleware': 1200,
 }
 
+EXTENSIONS = {
+    'scanner.extensions.ConversionQueueBackpressure': 500,
+    'scanner.extensions.RulePoolBackpressure': 510,
+}
+
+# Web scans override this and other settings with their crawl profile, see
+# CRAWL_PROFILES in the Django settings
 LOG_LEVEL = 'DEBUG'
 
 # Crawl responsibly by identifying yourself (and your website) on the
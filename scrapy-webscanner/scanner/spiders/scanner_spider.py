@@ -36,12 +36,12 @@ from ..linkextractor import LxmlLinkExtractor
 from .base_spider import BaseScannerSpider
 
 from ..processors.processor import Processor
+from ..writer import ScanWriter
 
 from os2webscanner.utils import capitalize_first
 
-from os2webscanner.utils import get_codec_and_string, secure_save
+from os2webscanner.utils import get_codec_and_string
 from os2webscanner.models.url_model import Url
-from os2webscanner.models.referrerurl_model import ReferrerUrl
 
 
 class ScannerSpider(BaseScannerSpider):
@@ -62,6 +62,11 @@ class ScannerSpider(BaseScannerSpider):
 
         self.start_urls = []
 
+        # Stores the URLs and referrers found, and scans the data, off the
+        # reactor thread
+        self.writer = ScanWriter(self.scanner,
+                                 getattr(runner, 'rule_pool', None))
+
         self.setup_spider()
 
     def setup_spider(self):
@@ -93,6 +98,10 @@ class ScannerSpider(BaseScannerSpider):
                 self.do_last_modified_check_head_request = getattr(
                     scan_object.webscan, "do_last_modified_check_head_request"
                 )
+                self.do_last_modified_check_conditional_get = getattr(
+                    scan_object.webscan,
+                    "do_last_modified_check_conditional_get"
+                )
                 self.link_extractor = LxmlLinkExtractor(
                     deny_extensions=(),
                     tags=('a', 'area', 'frame', 'iframe', 'script'),
@@ -100,8 +109,6 @@ class ScannerSpider(BaseScannerSpider):
                 )
                 self.referrers = {}
                 self.broken_url_objects = {}
-                # Dict to cache referrer URL objects
-                self.referrer_url_objects = {}
                 self.external_urls = set()
             elif hasattr(scan_object, 'filescan'):
                 for path in self.allowed_domains:
@@ -116,6 +123,7 @@ class ScannerSpider(BaseScannerSpider):
                 )
                 # Not used on type filescan
                 self.do_last_modified_check_head_request = False
+                self.do_last_modified_check_conditional_get = False
 
     def start_requests(self):
         """Return requests for all starting URLs AND sitemap URLs."""
@@ -258,7 +266,7 @@ class ScannerSpider(BaseScannerSpider):
                          status_code=status_code,
                          status_message=status_message)
 
-        secure_save(broken_url)
+        self.writer.add_url(broken_url)
 
         if hasattr(self.scanner.scan_object, 'webscan'):
             self.broken_url_objects[url] = broken_url
@@ -291,16 +299,11 @@ class ScannerSpider(BaseScannerSpider):
 
     def associate_url_referrer(self, referrer, url_object):
         """Associate referrer with Url object."""
-        referrer_url_object = self._get_or_create_referrer(referrer)
-        url_object.referrers.add(referrer_url_object)
+        self.writer.add_referrer(url_object, referrer)
 
-    def _get_or_create_referrer(self, referrer):
-        """Create or get existing ReferrerUrl object."""
-        if referrer not in self.referrer_url_objects:
-            self.referrer_url_objects[referrer] = ReferrerUrl(
-                url=referrer, scan=self.scanner.scan_object.webscan)
-            self.referrer_url_objects[referrer].save()
-        return self.referrer_url_objects[referrer]
+    def closed(self, reason):
+        """Store what is still waiting to be stored."""
+        self.writer.close()
 
     def scan(self, response):
         """Scan a response, returning any matches."""
@@ -328,9 +331,8 @@ class ScannerSpider(BaseScannerSpider):
 
         url_object = Url(url=response.request.url, mime_type=mime_type,
                          scan=self.scanner.scan_object)
-        url_object.save()
-
-        self.scanner.scan(data, url_object)
+        # The URL is stored and the data scanned by the writer
+        self.writer.add_url(url_object, data)
 
     def check_encoding(self, mime_type, response):
         if hasattr(response, "encoding"):
@@ -0,0 +1,226 @@
+# The contents of this file are subject to the Mozilla Public License
+# Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#    http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS"basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# OS2Webscanner was developed by Magenta in collaboration with OS2 the
+# Danish community of open source municipalities (http://www.os2web.dk/).
+#
+# The code is currently governed by OS2 the Danish community of open
+# source municipalities ( http://www.os2web.dk/ )
+"""Batched storage of what the scanner spider finds."""
+
+import queue
+import logging
+import threading
+import multiprocessing
+
+from django import db
+from django.db import IntegrityError, transaction
+
+from os2webscanner.models.url_model import Url
+from os2webscanner.models.referrerurl_model import ReferrerUrl
+from os2webscanner.utils import secure_save
+
+from .processors.processor import Processor
+from .processors.match_sink import MatchSink
+
+
+class ScanWriter(object):
+
+    """Stores URLs and referrers for a spider on a worker thread.
+
+    The spider adds URLs, optionally with their downloaded data, and links
+    from referrers to URLs. A worker thread stores them in the order they
+    were added, up to batch_size entries at a time: first the new URLs with
+    a single INSERT, then it scans their data, storing the matches found in
+    the batch together, and finally the new referrers and the links with an
+    INSERT each. So the reactor thread is not held up by database round
+    trips and rule execution. Given a RulePool, the worker hands HTML and
+    text to it instead of executing the rules itself.
+
+    At most max_pending entries wait to be stored. Adding more blocks the
+    spider until the worker catches up, so a slow database slows down the
+    crawl instead of filling the memory with downloaded data.
+
+    Once the writer is closed, entries are stored right away, on the
+    calling thread.
+    """
+
+    batch_size = 100
+    max_pending = 500
+
+    # Kinds of entries
+    URL = 'url'
+    REFERRER = 'referrer'
+
+    def __init__(self, scanner, pool=None):
+        """Initialize the writer for the Scanner and the RulePool, if any."""
+        self.scanner = scanner
+        self.pool = pool
+        self.queue = queue.Queue(self.max_pending)
+        self.thread = None
+        self.closed = False
+        # Entries added and not yet stored
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        # Maps referrer URLs to their ReferrerUrl objects
+        self.referrer_url_objects = {}
+        # The (Url id, referrer URL) links stored
+        self.links = set()
+
+    def add_url(self, url_object, data=None):
+        """Store the Url object, and scan the data downloaded from it."""
+        self.add((self.URL, url_object, data))
+
+    def add_referrer(self, url_object, referrer):
+        """Link the Url object to the referrer URL."""
+        self.add((self.REFERRER, url_object, referrer))
+
+    def add(self, entry):
+        """Add the entry to be stored."""
+        if self.closed:
+            self.write([entry])
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run,
+                                           name='scan-writer', daemon=True)
+            self.thread.start()
+        with self.pending_lock:
+            self.pending += 1
+        self.queue.put(entry)
+
+    def run(self):
+        """Store the added entries in batches until closed."""
+        try:
+            stopping = False
+            while not stopping:
+                entry = self.queue.get()
+                if entry is None:
+                    break
+                entries = [entry]
+                while len(entries) < self.batch_size:
+                    try:
+                        entry = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if entry is None:
+                        stopping = True
+                        break
+                    entries.append(entry)
+                try:
+                    self.write(entries)
+                except Exception:
+                    logging.exception("Storing %d entries failed" %
+                                      len(entries))
+                with self.pending_lock:
+                    self.pending -= len(entries)
+        finally:
+            db.connection.close()
+
+    def close(self):
+        """Store the remaining entries and stop the worker thread."""
+        if self.closed:
+            return
+        if self.thread is not None:
+            logging.info("Storing %d remaining entries" % self.pending)
+            self.queue.put(None)
+            self.thread.join()
+        self.closed = True
+
+    def write(self, entries):
+        """Store the entries."""
+        url_entries = [e for e in entries if e[0] == self.URL]
+        self.write_urls([url_object for kind, url_object, data
+                         in url_entries if url_object.pk is None])
+
+        with MatchSink.deferred():
+            jobs = []
+            for kind, url_object, data in url_entries:
+                if data is None or url_object.pk is None:
+                    continue
+                item_type = Processor.mimetype_to_processor_type(
+                    url_object.mime_type
+                )
+                if (self.pool is not None
+                        and item_type in self.pool.item_types):
+                    jobs.append(
+                        (url_object, self.pool.submit(item_type, data))
+                    )
+                    continue
+                try:
+                    self.scanner.scan(data, url_object)
+                except Exception:
+                    logging.exception("Scanning %s failed" % url_object.url)
+
+            text_processor = Processor.processor_by_type('text')
+            for url_object, job in jobs:
+                try:
+                    matches = self.pool.get_matches(job)
+                except multiprocessing.TimeoutError:
+                    logging.error("Scanning %s timed out, skipping it" %
+                                  url_object.url)
+                    continue
+                except Exception:
+                    logging.exception("Scanning %s failed" % url_object.url)
+                    continue
+                text_processor.store_matches(matches, url_object)
+
+        self.write_referrers([(url_object, referrer)
+                              for kind, url_object, referrer in entries
+                              if kind == self.REFERRER])
+
+    def write_urls(self, url_objects):
+        """Insert the Url objects, setting their ids."""
+        if not url_objects:
+            return
+        if db.connection.features.can_return_ids_from_bulk_insert:
+            try:
+                with transaction.atomic():
+                    Url.objects.bulk_create(url_objects)
+                return
+            except IntegrityError:
+                for url_object in url_objects:
+                    url_object.pk = None
+        # Insert one at a time, so one bad URL doesn't lose the rest
+        for url_object in url_objects:
+            secure_save(url_object)
+
+    def write_referrers(self, links):
+        """Insert the referrers not yet stored, and the (Url object,
+        referrer URL) links between them."""
+        new_referrers = []
+        for url_object, referrer in links:
+            if referrer not in self.referrer_url_objects:
+                referrer_url_object = ReferrerUrl(
+                    url=referrer, scan=self.scanner.scan_object.webscan
+                )
+                self.referrer_url_objects[referrer] = referrer_url_object
+                new_referrers.append(referrer_url_object)
+        if new_referrers:
+            if db.connection.features.can_return_ids_from_bulk_insert:
+                ReferrerUrl.objects.bulk_create(new_referrers)
+            else:
+                for referrer_url_object in new_referrers:
+                    referrer_url_object.save()
+
+        through_model = Url.referrers.through
+        rows = []
+        for url_object, referrer in links:
+            if url_object.pk is None:
+                # The URL couldn't be stored
+                continue
+            if (url_object.pk, referrer) in self.links:
+                continue
+            self.links.add((url_object.pk, referrer))
+            rows.append(through_model(
+                url_id=url_object.pk,
+                referrerurl_id=self.referrer_url_objects[referrer].pk
+            ))
+        if rows:
+            through_model.objects.bulk_create(rows)
@@ -18,10 +18,20 @@
 """Unit tests for the scanner."""
 
 # Include the Django app
+import io
 import os
+import json
+import hashlib
+import datetime
 import sys
 import shutil
 import tempfile
+import zipfile
+import threading
+import multiprocessing
+import select
+import signal
+import time
 
 base_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.append(base_dir + "/webscanner_site")
@@ -30,18 +40,40 @@ os.environ["DJANGO_SETTINGS_MODULE"] = "webscanner.settings"
 import django
 django.setup()
 
+from django.conf import settings as django_settings
+from django.db import connection
+from django.test import TestCase, override_settings
+
 import re
 
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import Request, Response
+from scrapy.utils.project import get_project_settings
+
 import linkchecker
+import run
 
 import unittest
-from scanner.rules import cpr, name
+from scanner.rules import cpr, name, nameindex, engine
 from scanner.spiders import scanner_spider
-from scanner.processors import pdf, libreoffice, html
+from scanner import (extensions, writer, lastmodified, rulepool,
+                     middlewares)
+from scanner.items import MatchItem
+from scanner.scanner.scanner import Scanner
+from scanner.processors import (pdf, libreoffice, html, dedup, image_header,
+                                autoscaler, prefork, scheduler, spool,
+                                heartbeat, queue_backend, match_sink)
+from scanner.processors.zip import ZipProcessor
 
 from os2webscanner.models.conversionqueueitem_model import ConversionQueueItem
 from os2webscanner.models.url_model import Url
 from os2webscanner.models.scan_model import Scan
+from os2webscanner.models.statistic_model import Statistic
+from os2webscanner.models.organization_model import Organization
+from os2webscanner.models.webscanner_model import WebScanner
+from os2webscanner.models.urllastmodified_model import UrlLastModified
+from os2webscanner.models.match_model import Match
+from os2webscanner.models.sensitivity_level import Sensitivity
 
 
 class FileExtractorTest(unittest.TestCase):
@@ -115,6 +147,41 @@ class NameTest(unittest.TestCase):
                              invalid_name + " is valid")
 
 
+class NameIndexTest(unittest.TestCase):
+
+    """Test the memory-mapped name index."""
+
+    def test_lookup(self):
+        """Test looking up names in an index."""
+        names = ['JENSEN', 'HANSEN', 'ØSTERGÅRD', 'JENSEN', 'Å']
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index_file = os.path.join(temp_dir, 'names.idx')
+            nameindex.build_index(names, index_file)
+            index = nameindex.NameIndex(index_file)
+
+            self.assertEqual(len(index), 4)
+            for n in names:
+                self.assertIn(n, index)
+            for n in ['JENSE', 'JENSENS', 'jensen', '', 'Ø']:
+                self.assertNotIn(n, index)
+            self.assertEqual(list(index), sorted(set(names)))
+
+    def test_union(self):
+        """Test looking up names in a union of indexes."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            first_file = os.path.join(temp_dir, 'first.idx')
+            last_file = os.path.join(temp_dir, 'last.idx')
+            nameindex.build_index(['JENS'], first_file)
+            nameindex.build_index(['JENSEN'], last_file)
+            union = nameindex.NameIndexUnion(
+                nameindex.NameIndex(first_file),
+                nameindex.NameIndex(last_file)
+            )
+            self.assertIn('JENS', union)
+            self.assertIn('JENSEN', union)
+            self.assertNotIn('HANS', union)
+
+
 class CPRTest(unittest.TestCase):
 
     """Test the CPR rule."""
@@ -177,6 +244,929 @@ class CPRTest(unittest.TestCase):
         self.assertTrue(cpr.modulus11_check("0101660123"))
 
 
+class RuleEngineTest(unittest.TestCase):
+
+    """Test executing rules with the rule engine."""
+
+    def test_execute(self):
+        """Test that the engine finds the same matches as each rule, with
+        and without a single pass."""
+        text = """
+            Jens Jensen bor på Nørregade 12, 1165 København K.
+            CPR 211062-5629 eller 2006359917, ring til Lars Larsen.
+            """
+        rules = [
+            cpr.CPRRule(do_modulus11=True, ignore_irrelevant=False),
+            name.NameRule(),
+        ]
+        for single_pass in (False, True):
+            results = engine.RuleEngine(
+                rules, single_pass=single_pass
+            ).execute(text)
+            self.assertTrue(results[rules[0]])
+            for rule in rules:
+                self.assertEqual(
+                    sorted(m['matched_data'] for m in results[rule]),
+                    sorted(m['matched_data'] for m in rule.execute(text))
+                )
+
+    def test_stream(self):
+        """Test that executing in windows finds the same matches."""
+        text = "Jens Jensen har CPR 211062-5629, ikke 211062-5628. " * 200
+        rules = [
+            cpr.CPRRule(do_modulus11=True, ignore_irrelevant=False),
+            name.NameRule(),
+        ]
+        rule_engine = engine.RuleEngine(rules)
+        rule_engine.window_size = 1000
+        rule_engine.window_overlap = 100
+        results = rule_engine.execute(text)
+        stream_results = rule_engine.execute_stream(io.StringIO(text).read)
+        self.assertEqual(len(results[rules[0]]), 200)
+        for rule in rules:
+            self.assertEqual(
+                sorted((m['matched_data'], m.get('match_context'))
+                       for m in stream_results[rule]),
+                sorted((m['matched_data'], m.get('match_context'))
+                       for m in results[rule])
+            )
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_membership(self):
+        sums = [hashlib.md5(str(i).encode('utf-8')).hexdigest()
+                for i in range(2000)]
+        bloom_filter = dedup.BloomFilter(1000)
+        for md5 in sums[:1000]:
+            bloom_filter.add(md5)
+        for md5 in sums[:1000]:
+            self.assertIn(md5, bloom_filter)
+        false_positives = sum(md5 in bloom_filter for md5 in sums[1000:])
+        self.assertLess(false_positives, 50)
+
+
+class ImageHeaderTest(unittest.TestCase):
+
+    def read_header(self, data):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            return image_header.read_image_header(f.name)
+
+    def test_read_image_header(self):
+        png = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR'
+               b'\x00\x00\x02\x80\x00\x00\x01\xe0\x08\x02\x00\x00\x00')
+        self.assertEqual(self.read_header(png), ('image/png', 640, 480))
+        gif = b'GIF89a\x40\x00\x07\x00' + b'\x00' * 20
+        self.assertEqual(self.read_header(gif), ('image/gif', 64, 7))
+        self.assertIsNone(self.read_header(b'Not an image' * 4))
+        bmp = (b'BM' + b'\x00' * 12 + b'\x28\x00\x00\x00'
+               b'\x20\x00\x00\x00\xf0\xff\xff\xff' + b'\x00' * 8)
+        self.assertEqual(self.read_header(bmp), ('image/bmp', 32, 16))
+        self.assertIsNone(self.read_header(b'BMW 320i, 1987, 250.000 km' * 2))
+
+
+class SpoolTest(unittest.TestCase):
+
+    def test_tmp_dir(self):
+        spool_dir = tempfile.mkdtemp()
+        url = Url(pk=5, scan=Scan(pk=3))
+        try:
+            with override_settings(SPOOL_DIR=spool_dir,
+                                   SPOOL_MAX_FILE_SIZE=100,
+                                   SPOOL_MAX_SIZE=150):
+                spool.Spool._usage_time = 0
+                spooled = os.path.join(spool_dir, 'scan_3', 'url_item_5')
+                self.assertEqual(spool.Spool.tmp_dir(url, 100), spooled)
+                # Too large for a file, then for the spool
+                self.assertEqual(spool.Spool.tmp_dir(url, 101), url.tmp_dir)
+                self.assertEqual(spool.Spool.tmp_dir(url, 60), url.tmp_dir)
+                self.assertEqual(spool.Spool.tmp_dir(url, 50), spooled)
+            with override_settings(SPOOL_DIR=None):
+                self.assertEqual(spool.Spool.tmp_dir(url, 1), url.tmp_dir)
+        finally:
+            shutil.rmtree(spool_dir)
+
+
+class ConversionQueueBackpressureTest(unittest.TestCase):
+
+    class Signals(object):
+
+        def connect(self, receiver, signal):
+            pass
+
+    def test_get_full_types(self):
+        crawler = type('Crawler', (object,), {'signals': self.Signals()})
+        backpressure = extensions.ConversionQueueBackpressure(crawler)
+        watermarks = {'default': (100, 50), 'ocr': (20, 10)}
+        with override_settings(CONVERSION_QUEUE_WATERMARKS=watermarks):
+            full = backpressure.get_full_types({'ocr': 21, 'pdf': 100},
+                                               set())
+            self.assertEqual(full, {'ocr'})
+            full = backpressure.get_full_types({'ocr': 11, 'pdf': 101},
+                                               full)
+            self.assertEqual(full, {'ocr', 'pdf'})
+            full = backpressure.get_full_types({'ocr': 10, 'pdf': 51}, full)
+            self.assertEqual(full, {'pdf'})
+
+    def test_pause_reasons(self):
+        engine = type('Engine', (object,), {'paused': False})()
+        engine.pause = lambda: setattr(engine, 'paused', True)
+        engine.unpause = lambda: setattr(engine, 'paused', False)
+        crawler = type('Crawler', (object,), {'engine': engine})()
+        extensions.pause(crawler, 'conversion_queue')
+        extensions.pause(crawler, 'rule_pool')
+        extensions.resume(crawler, 'conversion_queue')
+        self.assertTrue(engine.paused)
+        extensions.resume(crawler, 'rule_pool')
+        self.assertFalse(engine.paused)
+
+
+class LastModifiedIndexTest(unittest.TestCase):
+
+    def test_changes(self):
+        index = lastmodified.LastModifiedIndex(None)
+        url = 'http://example.com/'
+        date = datetime.datetime(2018, 1, 1)
+        index.entries[index.key(url)] = [1, None, '']
+        self.assertIn(url, index)
+        self.assertNotIn('http://example.com/other', index)
+        self.assertIsNone(index.get_last_modified(url))
+        index.set_last_modified(url, date)
+        self.assertEqual(index.get_last_modified(url), date)
+        self.assertEqual(index.get_id(url), 1)
+        self.assertEqual(index.changed, {index.key(url)})
+        index.set_last_modified(url, date, '"abc"')
+        self.assertEqual(index.get_etag(url), '"abc"')
+        index.set_last_modified(url, None)
+        self.assertEqual(index.get_etag(url), '"abc"')
+
+    def test_links_coalesced(self):
+        index = lastmodified.LastModifiedIndex(None)
+        a, b, c = ['http://example.com/%s' % name for name in 'abc']
+        for pk, url in enumerate([a, b, c]):
+            index.entries[index.key(url)] = [pk, None, '']
+        index.set_links(a, [b, c])
+        index.set_links(a, [b, b])
+        self.assertEqual(index.new_links, {index.key(a): {index.key(b)}})
+        self.assertFalse(index.new_objects)
+
+
+class LastModifiedLinksTest(TestCase):
+
+    """Test storing the links of a LastModifiedIndex in the database."""
+
+    @classmethod
+    def setUpTestData(cls):
+        organization = Organization.objects.create(
+            name="LastModifiedLinksTest"
+        )
+        cls.scanner = WebScanner.objects.create(
+            name="LastModifiedLinksTest", organization=organization,
+            schedule=""
+        )
+
+    def stored_links(self):
+        return set(UrlLastModified.links.through.objects.filter(
+            from_urllastmodified__scanner=self.scanner
+        ).values_list('from_urllastmodified__url',
+                      'to_urllastmodified__url'))
+
+    def test_store_links(self):
+        a, b, c, d = ['http://example.com/%s' % name for name in 'abcd']
+        index = lastmodified.LastModifiedIndex(self.scanner)
+        index.set_links(a, [b, c])
+        index.flush()
+        self.assertEqual(self.stored_links(), {(a, b), (a, c)})
+
+        index = lastmodified.LastModifiedIndex(self.scanner)
+        index.load()
+        index.set_links(a, [c, d])
+        index.set_links(b, [a])
+        index.flush()
+        self.assertEqual(self.stored_links(), {(a, c), (a, d), (b, a)})
+        self.assertEqual(sorted(index.get_links(a)), [c, d])
+        self.assertEqual(
+            UrlLastModified.objects.filter(scanner=self.scanner).count(), 4
+        )
+
+
+class CrawlProfileTest(TestCase):
+
+    """Test applying the crawl profiles to the Scrapy settings."""
+
+    @classmethod
+    def setUpTestData(cls):
+        organization = Organization.objects.create(name="CrawlProfileTest")
+        cls.scanner = WebScanner.objects.create(
+            name="CrawlProfileTest", organization=organization, schedule=""
+        )
+
+    def apply(self, profile):
+        scan = self.scanner.create_scan()
+        scan.crawl_profile = profile
+        scan.save()
+        app = run.ScannerApp.__new__(run.ScannerApp)
+        app.scan_id = scan.pk
+        app.scan_object = Scan.objects.get(pk=scan.pk)
+        settings = get_project_settings()
+        app.apply_crawl_profile(settings)
+        crawl_settings = json.loads(
+            Statistic.objects.get(scan=scan).crawl_settings
+        )
+        return settings, crawl_settings
+
+    def test_default(self):
+        """Test that the default profile keeps the project settings."""
+        project_settings = get_project_settings()
+        settings, crawl_settings = self.apply(WebScanner.DEFAULT)
+        self.assertEqual(crawl_settings['CRAWL_PROFILE'], WebScanner.DEFAULT)
+        for name in django_settings.CRAWL_PROFILES[WebScanner.DEFAULT]:
+            self.assertEqual(settings.get(name), project_settings.get(name))
+            self.assertEqual(crawl_settings[name], settings.get(name))
+
+    def test_gentle(self):
+        settings, crawl_settings = self.apply(WebScanner.GENTLE)
+        self.assertEqual(crawl_settings['CRAWL_PROFILE'], WebScanner.GENTLE)
+        for name, value in django_settings.CRAWL_PROFILES[
+                WebScanner.GENTLE].items():
+            self.assertEqual(settings.get(name), value)
+            self.assertEqual(crawl_settings[name], value)
+        self.assertTrue(settings.getbool('AUTOTHROTTLE_ENABLED'))
+
+    def test_unknown(self):
+        """Test that an unknown profile falls back to the default."""
+        settings, crawl_settings = self.apply('unknown')
+        self.assertEqual(crawl_settings['CRAWL_PROFILE'], WebScanner.DEFAULT)
+        self.assertFalse(settings.getbool('AUTOTHROTTLE_ENABLED'))
+
+
+class MatchSinkTest(TestCase):
+
+    """Test storing matches in bulk."""
+
+    @classmethod
+    def setUpTestData(cls):
+        organization = Organization.objects.create(name="MatchSinkTest")
+        scanner = WebScanner.objects.create(
+            name="MatchSinkTest", organization=organization, schedule=""
+        )
+        cls.url = Url.objects.create(url='http://example.com/',
+                                     scan=scanner.create_scan())
+
+    def match(self, i):
+        return MatchItem(matched_data='%06d-0000' % i, matched_rule='cpr',
+                         sensitivity=Sensitivity.HIGH,
+                         match_context='CPR %06d-0000' % i)
+
+    def stored(self):
+        return sorted(Match.objects.filter(url=self.url).values_list(
+            'matched_data', 'page_no'
+        ))
+
+    def test_flush(self):
+        """Test that matches are stored in batches and when the sink is
+        closed."""
+        with match_sink.MatchSink(self.url, 3) as sink:
+            sink.batch_size = 2
+            sink.add(self.match(1))
+            self.assertEqual(self.stored(), [])
+            with self.assertNumQueries(1):
+                sink.add(self.match(2))
+            self.assertEqual(self.stored(),
+                             [('000001-0000', 3), ('000002-0000', 3)])
+            sink.add(self.match(3))
+            self.assertEqual(len(self.stored()), 2)
+        self.assertEqual(self.stored(), [
+            ('000001-0000', 3), ('000002-0000', 3), ('000003-0000', 3)
+        ])
+        self.assertEqual(
+            Match.objects.filter(scan=self.url.scan).count(), 3
+        )
+
+    def test_deferred(self):
+        """Test that the matches of several sinks are stored together at the
+        end of a deferred block."""
+        # Nothing is stored before the end of the block
+        with self.assertNumQueries(1):
+            with match_sink.MatchSink.deferred():
+                for i in range(3):
+                    with match_sink.MatchSink(self.url) as sink:
+                        sink.add(self.match(2 * i))
+                        sink.add(self.match(2 * i + 1))
+        self.assertEqual(self.stored(),
+                         [('%06d-0000' % i, None) for i in range(6)])
+
+
+class ConditionalGetTest(unittest.TestCase):
+
+    """Test the conditional GET mode of the LastModifiedCheckMiddleware."""
+
+    class Stats(object):
+
+        def __init__(self):
+            self.values = {}
+
+        def inc_value(self, key):
+            self.values[key] = self.values.get(key, 0) + 1
+
+    url = 'http://example.com/page'
+
+    def setUp(self):
+        engine = type('Engine', (object,), {})()
+        engine.requests = []
+        engine.crawl = lambda request, spider: engine.requests.append(
+            request
+        )
+        crawler = type('Crawler', (object,), {'stats': self.Stats(),
+                                              'engine': engine})
+        self.middleware = middlewares.LastModifiedCheckMiddleware(crawler)
+        self.middleware.get_stored_links = lambda url, spider: [
+            'http://example.com/link'
+        ]
+
+        index = lastmodified.LastModifiedIndex(None)
+        index.entries[index.key(self.url)] = [
+            1, datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc),
+            '"abc"'
+        ]
+        scan_object = type('Scan', (object,), {'webscan': True})
+        self.spider = type('Spider', (object,), {
+            'do_last_modified_check': True,
+            'do_last_modified_check_conditional_get': True,
+            'last_modified_index': index,
+            'scanner': type('Scanner', (object,),
+                            {'scan_object': scan_object}),
+        })()
+
+    def test_add_conditional_headers(self):
+        request = Request(self.url)
+        self.assertIsNone(self.middleware.process_request(request,
+                                                          self.spider))
+        self.assertEqual(request.headers['If-None-Match'], b'"abc"')
+        self.assertEqual(request.headers['If-Modified-Since'],
+                         b'Mon, 01 Jan 2018 00:00:00 GMT')
+        self.assertTrue(request.meta['conditional_get'])
+
+        # Validators copied from a redirected request are removed
+        request = Request('http://example.com/other',
+                          headers={'If-None-Match': '"abc"'})
+        self.assertIsNone(self.middleware.process_request(request,
+                                                          self.spider))
+        self.assertNotIn('If-None-Match', request.headers)
+        self.assertNotIn('If-Modified-Since', request.headers)
+        self.assertFalse(request.meta['conditional_get'])
+
+    def test_not_modified(self):
+        """Test that a 304 response is skipped as an unmodified page."""
+        request = Request(self.url)
+        self.middleware.process_request(request, self.spider)
+        response = Response(self.url, status=304, request=request)
+        with self.assertRaises(IgnoreRequest):
+            self.middleware.process_response(request, response, self.spider)
+        engine = self.middleware.crawler.engine
+        self.assertEqual([r.url for r in engine.requests],
+                         ['http://example.com/link'])
+        self.assertEqual(self.middleware.stats.values, {
+            'last_modified_check/pages_not_modified': 1,
+            'last_modified_check/pages_skipped': 1,
+        })
+
+        # A 304 to a request which wasn't conditional is passed on
+        request = Request(self.url, meta={'conditional_get': False})
+        response = Response(self.url, status=304, request=request)
+        self.assertIs(self.middleware.process_response(request, response,
+                                                       self.spider),
+                      response)
+
+
+class ScanWriterTest(unittest.TestCase):
+
+    def test_batches(self):
+        batches = []
+        scan_writer = writer.ScanWriter(None)
+        scan_writer.batch_size = 3
+        scan_writer.write = batches.append
+        entries = [(writer.ScanWriter.URL, n, None) for n in range(10)]
+        for entry in entries:
+            scan_writer.add(entry)
+        scan_writer.close()
+        self.assertEqual(sum(batches, []), entries)
+        self.assertTrue(all(len(batch) <= 3 for batch in batches))
+        self.assertEqual(scan_writer.pending, 0)
+        # Once closed, entries are stored right away
+        scan_writer.add(entries[0])
+        self.assertEqual(batches[-1], [entries[0]])
+
+
+class ScannerCacheTest(TestCase):
+
+    """Test reusing the compiled rules of a scan."""
+
+    @classmethod
+    def setUpTestData(cls):
+        organization = Organization.objects.create(name="ScannerCacheTest")
+        scanner = WebScanner.objects.create(
+            name="ScannerCacheTest", organization=organization, schedule=""
+        )
+        cls.scan_pk = scanner.create_scan().pk
+
+    def setUp(self):
+        Scanner._cache.clear()
+
+    def tearDown(self):
+        Scanner._cache.clear()
+
+    def expire(self, scan):
+        """Make the next for_scan check the rules fingerprint."""
+        Scanner._cache[scan.pk][2] -= Scanner.fingerprint_interval
+
+    def test_for_scan(self):
+        scan = Scan.objects.get(pk=self.scan_pk)
+        scanner = Scanner.for_scan(scan)
+        self.assertEqual(len(scanner.rules), 1)
+        with self.assertNumQueries(0):
+            self.assertIs(Scanner.for_scan(scan), scanner)
+
+        # Unchanged rules
+        self.expire(scan)
+        self.assertIs(Scanner.for_scan(scan), scanner)
+
+        # Changed rules are only noticed after fingerprint_interval seconds
+        scan.do_cpr_scan = False
+        scan.save()
+        self.assertIs(Scanner.for_scan(scan), scanner)
+        self.expire(scan)
+        changed = Scanner.for_scan(scan)
+        self.assertIsNot(changed, scanner)
+        self.assertEqual(changed.rules, [])
+        self.assertIs(Scanner.for_scan(scan), changed)
+
+    def test_finished_scan(self):
+        """Test that scanners for finished scans aren't cached."""
+        scan = Scan.objects.get(pk=self.scan_pk)
+        scanner = Scanner.for_scan(scan)
+        scan.status = Scan.DONE
+        scan.save()
+        self.expire(scan)
+        scan.do_cpr_modulus11 = not scan.do_cpr_modulus11
+        self.assertIsNot(Scanner.for_scan(scan), scanner)
+        self.assertNotIn(scan.pk, Scanner._cache)
+
+
+class RulePoolTest(unittest.TestCase):
+
+    class Result(object):
+
+        def get(self, timeout):
+            raise multiprocessing.TimeoutError()
+
+    def test_timeout(self):
+        pool = rulepool.RulePool.__new__(rulepool.RulePool)
+        pool.running = {1, 2}
+        pool.jobs = 2
+        pool.jobs_lock = threading.Lock()
+        # The worker of job 1 died
+        with self.assertRaises(multiprocessing.TimeoutError):
+            pool.get_matches((1, self.Result()))
+        self.assertEqual(pool.jobs, 1)
+        # A job given up on doesn't count once it is done after all
+        pool._done(1)
+        self.assertEqual(pool.jobs, 1)
+
+
+class AutoscalerTest(unittest.TestCase):
+
+    def test_targets(self):
+        bounds = {'ocr': (1, 16), 'text': (1, 8), 'csv': (1, 4)}
+        host = {'cpus': 8, 'load': 1.0, 'memory': 0.5}
+        queue = {'ocr': (20000, 3600), 'text': (10, 5)}
+        running = {'ocr': 4, 'text': 8, 'csv': 4}
+        # Idle types lose a processor at a time
+        scaler = autoscaler.Autoscaler(bounds, max_processes=40)
+        self.assertEqual(scaler.targets(running, queue, host),
+                         {'ocr': 16, 'text': 7, 'csv': 3})
+        # The budget goes to the type with the most items waiting
+        scaler = autoscaler.Autoscaler(bounds, max_processes=12)
+        self.assertEqual(scaler.targets(running, queue, host),
+                         {'ocr': 10, 'text': 1, 'csv': 1})
+        # No processors are added without headroom
+        host['load'] = 20.0
+        scaler = autoscaler.Autoscaler(bounds, max_processes=40)
+        self.assertEqual(scaler.targets(running, queue, host),
+                         {'ocr': 4, 'text': 7, 'csv': 3})
+
+
+class DatabaseQueueBackendTest(TestCase):
+
+    """Test claiming, acknowledging and failing conversion queue items."""
+
+    backend_class = queue_backend.DatabaseQueueBackend
+
+    @classmethod
+    def setUpTestData(cls):
+        organization = Organization.objects.create(name="QueueBackendTest")
+        scanner = WebScanner.objects.create(
+            name="QueueBackendTest", organization=organization, schedule=""
+        )
+        for i in range(2):
+            url = Url.objects.create(url='http://example.com/%d' % i,
+                                     scan=scanner.create_scan())
+            for j in range(3):
+                ConversionQueueItem.objects.create(
+                    url=url, file='/tmp/%d_%d.txt' % (i, j), type='text'
+                )
+
+    def setUp(self):
+        self.backend = self.backend_class()
+
+    def claim_all(self, pid):
+        """Claim items until there are none left."""
+        claimed = []
+        while True:
+            items = self.backend.claim_batch('text', pid, 2)
+            if not items:
+                return claimed
+            claimed.extend(items)
+
+    def test_claim(self):
+        """Test that an item is only claimed once."""
+        first = self.backend.claim_batch('text', 10, 2)
+        second = self.backend.claim_batch('text', 11, 2)
+        self.assertEqual(len(first), 2)
+        self.assertTrue(second)
+        # The items of a batch are from the same scan
+        self.assertEqual(len(set(item.url.scan_id for item in first)), 1)
+        rest = self.claim_all(12)
+        pks = [item.pk for item in first + second + rest]
+        self.assertEqual(len(set(pks)), 6)
+        self.assertEqual(self.backend.claim('text', 13), None)
+
+        for pid, items in ((10, first), (11, second), (12, rest)):
+            for item in items:
+                self.assertEqual(item.status, ConversionQueueItem.PROCESSING)
+                self.assertEqual(item.process_id, pid)
+            self.assertEqual(
+                set(ConversionQueueItem.objects.filter(
+                    status=ConversionQueueItem.PROCESSING, process_id=pid
+                ).values_list('pk', flat=True)),
+                set(item.pk for item in items)
+            )
+
+    def test_ack_fail(self):
+        """Test that acknowledged items are deleted, and failed items are
+        marked as failed, and neither is claimed again."""
+        items = self.backend.claim_batch('text', 10, 2)
+        self.backend.ack(items[0])
+        self.backend.fail(items[1])
+        self.assertFalse(
+            ConversionQueueItem.objects.filter(pk=items[0].pk).exists()
+        )
+        self.assertEqual(
+            ConversionQueueItem.objects.get(pk=items[1].pk).status,
+            ConversionQueueItem.FAILED
+        )
+        self.assertEqual(items[1].status, ConversionQueueItem.FAILED)
+
+        rest = self.claim_all(11)
+        self.assertEqual(len(rest), 4)
+        self.assertFalse(set(item.pk for item in items) &
+                         set(item.pk for item in rest))
+        self.backend.ack_batch(rest[:2])
+        self.backend.fail_batch(rest[2:])
+        self.assertEqual(ConversionQueueItem.objects.filter(
+            status=ConversionQueueItem.FAILED
+        ).count(), 3)
+        self.assertEqual(ConversionQueueItem.objects.count(), 3)
+        self.assertEqual(self.claim_all(12), [])
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql',
+                     "Needs PostgreSQL")
+class PostgreSQLQueueBackendTest(DatabaseQueueBackendTest):
+
+    backend_class = queue_backend.PostgreSQLQueueBackend
+
+
+class FairSchedulerTest(unittest.TestCase):
+
+    def candidate(self, scan, organization, weight, scan_class, oldest):
+        return {'scan': scan, 'organization': organization,
+                'weight': weight, 'class': scan_class, 'waiting': 1,
+                'oldest': datetime.datetime(2018, 1, 1, 0, oldest)}
+
+    def test_choose(self):
+        fair = scheduler.FairScheduler()
+        now = fair.last_served[fair.SCHEDULED]
+        nightly = self.candidate(1, 1, 1, fair.SCHEDULED, 0)
+        upload = self.candidate(2, 1, 1, fair.INTERACTIVE, 30)
+        other = self.candidate(3, 2, 2, fair.SCHEDULED, 10)
+        # Interactive scans go first
+        self.assertEqual(
+            fair.choose([nightly, upload, other], {1: 3}, {1: 3}, now),
+            upload)
+        # The organization with fewest items processing per weight is next
+        self.assertEqual(
+            fair.choose([nightly, other], {1: 3, 3: 4}, {1: 3, 2: 4}, now),
+            other)
+        self.assertEqual(
+            fair.choose([nightly, other], {1: 3, 3: 8}, {1: 3, 2: 8}, now),
+            nightly)
+        # Scheduled scans age while interactive scans are served
+        fair.last_served[fair.INTERACTIVE] = now + 120
+        self.assertEqual(
+            fair.choose([nightly, upload], {}, {}, now + 120), nightly)
+
+
+class HeartbeatMonitorTest(unittest.TestCase):
+
+    def test_stalled(self):
+        var_dir = tempfile.mkdtemp()
+        try:
+            with override_settings(VAR_DIR=var_dir):
+                monitor = heartbeat.HeartbeatMonitor()
+                beat = {'pid': 10, 'worker': 11, 'type': 'ocr', 'item': 1,
+                        'progress': [1.5, 1000]}
+                monitor.update(beat, 0)
+                monitor.update(dict(beat, progress=[1.5, 2000]), 20)
+                monitor.update(beat, 40)
+                self.assertEqual(monitor.stalled(45), [])
+                # No progress for too long
+                monitor.update(beat, 71)
+                self.assertEqual(monitor.stalled(72)[0]['pid'], 10)
+                # No heartbeats, so no judgement
+                self.assertEqual(monitor.stalled(80), [])
+                # Processing another item
+                monitor.update(dict(beat, item=2), 81)
+                self.assertEqual(monitor.stalled(82), [])
+                monitor.close()
+        finally:
+            shutil.rmtree(var_dir)
+
+    def test_idle_progress(self):
+        var_dir = tempfile.mkdtemp()
+        try:
+            with override_settings(VAR_DIR=var_dir):
+                monitor = heartbeat.HeartbeatMonitor()
+                pid = os.fork()
+                if pid == 0:
+                    # An idle processor
+                    beats = heartbeat.Heartbeat(10, 'ocr')
+                    beats.interval = 0.1
+                    beats.start()
+                    time.sleep(2)
+                    os._exit(0)
+                progress = []
+                update = monitor.update
+                monitor.update = lambda message, now: (
+                    progress.append(message['progress']),
+                    update(message, now)
+                )
+                while len(progress) < 15:
+                    select.select([monitor], [], [], 1)
+                    monitor.receive()
+                os.waitpid(pid, 0)
+                monitor.close()
+                # The first heartbeats may be sent before the process idles
+                self.assertEqual(len(set(map(tuple, progress[5:]))), 1)
+        finally:
+            shutil.rmtree(var_dir)
+
+
+class ZygoteTest(unittest.TestCase):
+
+    class Processor(object):
+
+        max_memory = 512 * 1024 * 1024
+        max_lifetime = 60 * 60
+
+        def __init__(self, tmp_dir):
+            self.tmp_dir = tmp_dir
+
+        def setup_queue_processing(self, pid, name):
+            self.pid = pid
+            self.tmp_file = os.path.join(self.tmp_dir, name)
+
+        def process_queue(self):
+            with open(self.tmp_file, 'w') as f:
+                f.write(str(self.pid))
+            sys.exit(3)
+
+        def teardown_queue_processing(self):
+            with open(self.tmp_file, 'a') as f:
+                f.write(' teardown')
+
+        def teardown_worker(self, pid):
+            with open(os.path.join(self.tmp_dir, 'exited'), 'a') as f:
+                f.write('%d\n' % pid)
+
+    def read(self, tmp_dir, name):
+        with open(os.path.join(tmp_dir, name)) as f:
+            return f.read()
+
+    def wait_for(self, tmp_dir, name):
+        while not os.path.exists(os.path.join(tmp_dir, name)):
+            time.sleep(0.05)
+        # Wait for the pid to be written
+        while not self.read(tmp_dir, name):
+            time.sleep(0.05)
+        return int(self.read(tmp_dir, name).split()[0])
+
+    def exited(self, tmp_dir):
+        if not os.path.exists(os.path.join(tmp_dir, 'exited')):
+            return []
+        return sorted(map(int, self.read(tmp_dir, 'exited').split()))
+
+    def test_run_child(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            zygote = prefork.Zygote(self.Processor(tmp_dir),
+                                    ['child{worker}'])
+            pid = os.fork()
+            if pid == 0:
+                zygote.run_child(3)
+            pid, status = os.waitpid(pid, 0)
+            self.assertEqual(os.WEXITSTATUS(status), 3)
+            self.assertEqual(self.read(tmp_dir, 'child3'),
+                             '%d teardown' % pid)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    class IdleProcessor(Processor):
+
+        retiring = False
+
+        def process_queue(self):
+            with open(self.tmp_file, 'w') as f:
+                f.write(str(self.pid))
+            while not self.retiring:
+                time.sleep(0.05)
+
+    def start(self, zygote):
+        pid = os.fork()
+        if pid == 0:
+            zygote.pid = os.getpid()
+            zygote.check_interval = 0.05
+            try:
+                zygote.run()
+            finally:
+                os._exit(0)
+        return pid
+
+    def test_retire(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            zygote = prefork.Zygote(self.IdleProcessor(tmp_dir),
+                                    ['child{worker}'], workers=2)
+            pid = self.start(zygote)
+            workers = [self.wait_for(tmp_dir, 'child0'),
+                       self.wait_for(tmp_dir, 'child1')]
+            os.kill(pid, signal.SIGUSR1)
+            # The zygote exits after the workers instead of forking others
+            pid, status = os.waitpid(pid, 0)
+            self.assertEqual(os.WEXITSTATUS(status), 0)
+            for i, worker in enumerate(workers):
+                self.assertEqual(self.read(tmp_dir, 'child%d' % i),
+                                 '%d teardown' % worker)
+            self.assertEqual(self.exited(tmp_dir), sorted(workers))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_scale(self):
+        """Test changing the number of workers on the control pipe."""
+        tmp_dir = tempfile.mkdtemp()
+        control_read, control_write = os.pipe()
+        try:
+            zygote = prefork.Zygote(self.IdleProcessor(tmp_dir),
+                                    ['child{worker}'], control=control_read)
+            pid = self.start(zygote)
+            first = self.wait_for(tmp_dir, 'child0')
+            os.write(control_write, b'2\n')
+            second = self.wait_for(tmp_dir, 'child1')
+            # The youngest worker is retired
+            os.write(control_write, b'1\n')
+            while not self.exited(tmp_dir):
+                time.sleep(0.05)
+            self.assertEqual(self.exited(tmp_dir), [second])
+            os.kill(pid, signal.SIGUSR1)
+            os.waitpid(pid, 0)
+            self.assertEqual(self.exited(tmp_dir), sorted([first, second]))
+        finally:
+            os.close(control_read)
+            os.close(control_write)
+            shutil.rmtree(tmp_dir)
+
+    def test_recycle(self):
+        """Test that a worker using too much memory is replaced."""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            processor = self.IdleProcessor(tmp_dir)
+            processor.max_memory = 0
+            zygote = prefork.Zygote(processor, ['child{worker}'])
+            zygote.min_lifetime = 0
+            pid = self.start(zygote)
+            while len(self.exited(tmp_dir)) < 2:
+                time.sleep(0.05)
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class ZipProcessorTest(unittest.TestCase):
+
+    """Test the limits on extracting archives."""
+
+    class Scan(object):
+
+        do_ocr = False
+
+        def __init__(self):
+            self.occurrences = []
+
+        def log_occurrence(self, string):
+            self.occurrences.append(string)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.processor = ZipProcessor()
+        self.processor.min_size = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_zip(self, members):
+        """Return a zip file with the members given as names and data."""
+        f = io.BytesIO()
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for member_name, data in members:
+                archive.writestr(member_name, data)
+        return f.getvalue()
+
+    def convert(self, data):
+        """Convert the archive, returning the result and log messages."""
+        out_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        file_path = out_dir + '.zip'
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        scan = self.Scan()
+        url = type('Url', (object,), {'url': 'http://example.com/archive.zip',
+                                      'scan': scan})
+        item = type('Item', (object,), {'file_path': file_path, 'url': url})
+        result = self.processor.convert(item, out_dir)
+        return result, sorted(os.listdir(out_dir)), scan.occurrences
+
+    def test_extract(self):
+        data = self.make_zip([
+            ('a.pdf', os.urandom(1000)),
+            ('b.zip', self.make_zip([('c.pdf', os.urandom(1000))])),
+        ])
+        result, files, occurrences = self.convert(data)
+        self.assertTrue(result)
+        self.assertEqual(files, ['1_a.pdf', '3_c.pdf'])
+        self.assertEqual(occurrences, [])
+
+    def test_max_size(self):
+        """Test that a zip bomb is stopped at the size limit."""
+        self.processor.max_size = 1024 * 1024
+        self.processor.max_ratio = 10000
+        data = self.make_zip([('a.pdf', os.urandom(1000)),
+                              ('b.pdf', b'\0' * (2 * 1024 * 1024))])
+        result, files, occurrences = self.convert(data)
+        self.assertFalse(result)
+        self.assertEqual(len(occurrences), 1)
+        self.assertIn('ARCHIVE LIMIT EXCEEDED: more than 1048576 bytes',
+                      occurrences[0])
+
+    def test_max_ratio(self):
+        """Test that a highly compressed archive is stopped at the ratio."""
+        data = self.make_zip([('a.pdf', b'\0' * (1024 * 1024))])
+        result, files, occurrences = self.convert(data)
+        self.assertFalse(result)
+        self.assertEqual(len(occurrences), 1)
+        self.assertIn('more than %d bytes' % (len(data) * 100),
+                      occurrences[0])
+
+        # Incompressible data is well within the ratio
+        data = self.make_zip([('a.pdf', os.urandom(1024 * 1024))])
+        result, files, occurrences = self.convert(data)
+        self.assertTrue(result)
+        self.assertEqual(files, ['1_a.pdf'])
+
+    def test_max_depth(self):
+        """Test that archives nested too deep are not extracted."""
+        self.processor.max_depth = 1
+        data = self.make_zip([('a.pdf', os.urandom(1000))])
+        data = self.make_zip([('b.zip', data)])
+        data = self.make_zip([('c.zip', data), ('d.pdf', os.urandom(1000))])
+        result, files, occurrences = self.convert(data)
+        self.assertTrue(result)
+        self.assertEqual(files, ['3_d.pdf'])
+        self.assertEqual(len(occurrences), 1)
+        self.assertIn('more than 1 nested archives at b.zip', occurrences[0])
+
+
 class PDF2HTMLTest(unittest.TestCase):
 
     test_dir = base_dir + '/scrapy-webscanner/tests/data/'
@@ -190,7 +1180,10 @@ class PDF2HTMLTest(unittest.TestCase):
                                    status=ConversionQueueItem.NEW)
 
         with tempfile.TemporaryDirectory(dir=self.test_dir + 'tmp/') as temp_dir:
-            result = pdf.PDFProcessor.convert(self, item, temp_dir)
+            shutil.move(item.file_path, temp_dir)
+            result = pdf.PDFProcessor().convert_to_html(
+                item, os.path.join(temp_dir, filename)
+            )
 
         return result
 
@@ -213,6 +1206,13 @@ class PDF2HTMLTest(unittest.TestCase):
         self.assertEqual(result, True)
 
 
+class PDFTextTest(unittest.TestCase):
+
+    def test_read_pages(self):
+        pages = pdf.read_pages(io.StringIO('Side 1\n\fSide\n2\n\f\fSide 4\n\f'))
+        self.assertEqual(list(pages), ['Side 1\n', 'Side\n2\n', '', 'Side 4\n'])
+
+
 class LibreofficeTest(unittest.TestCase):
 
     test_dir = base_dir + '/scrapy-webscanner/tests/data/'
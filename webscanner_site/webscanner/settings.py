@@ -170,6 +170,127 @@ PAUSE_NON_OCR_ITEMS_THRESHOLD = 2000
 # PAUSE_NON_OCR_ITEMS_THRESHOLD.
 RESUME_NON_OCR_ITEMS_THRESHOLD = PAUSE_NON_OCR_ITEMS_THRESHOLD - 1000
 
+# The crawler of a scan is paused while the scan has more conversion queue
+# items of a type waiting than the type's high watermark, and resumed when
+# it has fewer than the low watermark of every type, so the queue and the
+# disk space it takes stay bounded when the queue processors can't keep up.
+# The watermarks are (high, low) numbers of items by processor type;
+# 'default' applies to types not listed.
+CONVERSION_QUEUE_WATERMARKS = {
+    'default': (1000, 500),
+    'ocr': (PAUSE_NON_OCR_ITEMS_THRESHOLD - 500,
+            RESUME_NON_OCR_ITEMS_THRESHOLD),
+}
+
+# The backend used by the queue processors to claim conversion queue items.
+# 'database' polls the database through the ORM and works with any database.
+# 'postgresql' claims items with SKIP LOCKED and wakes idle processors with
+# LISTEN/NOTIFY instead of polling, and requires PostgreSQL 9.5 or later.
+CONVERSION_QUEUE_BACKEND = 'database'
+
+# The number of conversion queue items each queue processor claims (and marks
+# as done or failed) at a time, by processor type. Types not listed claim one
+# item at a time. Larger batches save database round trips for cheap items.
+CONVERSION_QUEUE_BATCH_SIZES = {
+    'text': 10,
+    'html': 10,
+    'csv': 10,
+}
+
+# The process manager scales the number of queue processors of each type,
+# i.e. the workers forked by the process of the type, between these
+# (minimum, maximum) bounds according to the number of items waiting in the
+# queue of the type, and how long they have waited. Types not listed get
+# between 1 and 8 processors.
+PROCESS_MANAGER_PROCESSES = {
+    'html': (1, 8),
+    'libreoffice': (1, 8),
+    'ocr': (1, 16),
+    'pdf': (1, 8),
+    'zip': (1, 4),
+    'text': (1, 8),
+    'csv': (1, 4),
+}
+
+# The largest total number of queue processors the process manager runs.
+# None means two per CPU core.
+PROCESS_MANAGER_MAX_PROCESSES = None
+
+# Text files larger than this number of bytes are scanned in overlapping
+# windows as they are read, instead of being read into memory as a whole.
+STREAMING_SCAN_SIZE = 64 * 1024 * 1024
+
+# Whether to scan the text of PDF files page by page as it is extracted with
+# pdftotext, so matches get page numbers. If False, PDF files are converted
+# to HTML with pdftohtml and scanned by the HTML processor.
+PDF_DIRECT_TEXT_EXTRACTION = True
+
+# Files queued for conversion of at most SPOOL_MAX_FILE_SIZE bytes are
+# written to SPOOL_DIR, which should be on a RAM-backed file system like
+# tmpfs, as long as it holds less than SPOOL_MAX_SIZE bytes in all. Their
+# conversions write their output to the disk. Larger files, and all files
+# if SPOOL_DIR is None, are written to the scan's directory in VAR_DIR.
+SPOOL_DIR = '/dev/shm/os2webscanner'
+SPOOL_MAX_FILE_SIZE = 1024 * 1024
+SPOOL_MAX_SIZE = 256 * 1024 * 1024
+
+# Whether to match the patterns of all the rules of a scan in a single pass
+# over the text, using one combined regular expression. With the current
+# regex module this is slower than matching each pattern on its own, so it
+# is disabled by default; see scrapy-webscanner/benchmarks/benchmark_rules.py.
+RULE_ENGINE_SINGLE_PASS = False
+
+# The Scrapy settings of the crawl profiles web scanners can choose between.
+# They override those in scrapy-webscanner/scanner/settings.py for the scan,
+# and the effective settings are recorded in the scan's statistics.
+# "gentle" is for fragile or shared servers, "intranet-fast" for servers on
+# the local network which can take many concurrent requests.
+CRAWL_PROFILES = {
+    'gentle': {
+        'CONCURRENT_REQUESTS': 4,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 2,
+        'DOWNLOAD_DELAY': 0.5,
+        'AUTOTHROTTLE_ENABLED': True,
+        'AUTOTHROTTLE_START_DELAY': 1.0,
+        'AUTOTHROTTLE_MAX_DELAY': 30.0,
+        'AUTOTHROTTLE_TARGET_CONCURRENCY': 1.0,
+        'DOWNLOAD_TIMEOUT': 120,
+        'DOWNLOAD_MAXSIZE': 256 * 1024 * 1024,
+        'DNSCACHE_SIZE': 10000,
+        'LOG_LEVEL': 'INFO',
+        'COOKIES_DEBUG': False,
+    },
+    # The settings web scans were run with before there were crawl profiles
+    'default': {
+        'CONCURRENT_REQUESTS': 16,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 8,
+        'DOWNLOAD_DELAY': 0,
+        'AUTOTHROTTLE_ENABLED': False,
+        'DOWNLOAD_TIMEOUT': 180,
+        'DOWNLOAD_MAXSIZE': 1024 * 1024 * 1024,
+        'DNSCACHE_SIZE': 10000,
+        'LOG_LEVEL': 'DEBUG',
+        'COOKIES_DEBUG': True,
+    },
+    'intranet-fast': {
+        'CONCURRENT_REQUESTS': 64,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 32,
+        'DOWNLOAD_DELAY': 0,
+        'AUTOTHROTTLE_ENABLED': False,
+        'DOWNLOAD_TIMEOUT': 30,
+        'DOWNLOAD_MAXSIZE': 1024 * 1024 * 1024,
+        'DNSCACHE_SIZE': 100000,
+        'REACTOR_THREADPOOL_MAXSIZE': 20,
+        'LOG_LEVEL': 'INFO',
+        'COOKIES_DEBUG': False,
+    },
+}
+
+# The number of worker processes a scan executes the rules on HTML and text
+# pages in, instead of in the crawling process. None means one per available
+# CPU core, 0 means no workers.
+RULE_POOL_WORKERS = None
+
 # Directory to store files transmitted by RPC
 RPC_TMP_PREFIX = '/tmp/os2webscanner'
 